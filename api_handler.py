@@ -20,7 +20,7 @@ from urllib.parse import quote_plus, unquote_plus
 
 import uvicorn
 from fastapi import FastAPI, APIRouter, HTTPException, Request, Query, Depends
-from fastapi.responses import JSONResponse, HTMLResponse, Response
+from fastapi.responses import JSONResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from loguru import logger
@@ -29,11 +29,19 @@ from openvpn_status_parser import revertDatetimeFormat
 
 from config_handler import get_lucidum_dir, get_images, get_mongo_config, get_ecr_token, \
     get_ecr_url, get_ecr_client, get_aws_config, get_ecr_base, get_source_mapping_file_path
+from compose_service import get_compose_state
+from config_to_db_handler import run_config_to_db
+from docker_index_service import get_docker_index
+from runtime_pool_service import get_runtime_pool, close_runtime_pool
 from docker_service import start_docker_compose, stop_docker_compose, list_docker_compose_containers, \
     start_docker_compose_service, stop_docker_compose_service, restart_docker_compose, restart_docker_compose_service, \
     get_docker_compose_logs, run_docker_container, get_docker_container
 from exceptions import AppError
 from healthcheck_handler import get_health_information
+from image_gc_handler import start_image_gc_job
+from backup_scheduler_service import start_backup_scheduler
+from job_handler import get_job_manager, PULL_POOL, CONTAINER_POOL
+from progress_handler import list_progress, get_progress
 from install_handler import install_image_from_ecr, update_docker_compose_file, update_airflow_settings_file, \
     get_image_and_version
 import license_handler
@@ -239,24 +247,66 @@ def update_ecr_token(param: EcrModel):
     }
 
 
-@api_router.post("/installecr", tags=["installecr"])
-def installecr(component: InstallECRComponentModel):
-    components = [f"{component.component_name}:{component.component_version}"]
-    logger.info(
-        "ecr components: {}, copy default: {}, restart: {}, update files: {}",
-        components, component.copy_default, component.restart, component.update_files
-    )
+def install_ecr_components(components: list, copy_default: bool, restart: bool, update_files: bool):
     update_ecr_token_config()
     images = get_images(components)
     logger.info(json.dumps(images, indent=2))
-    install_image_from_ecr(images, component.copy_default, component.restart, update_files=component.update_files)
-
+    install_image_from_ecr(images, copy_default, restart, update_files=update_files)
     return {
         "status": "OK",
         "message": "success",
     }
 
 
+def submit_job(kind: str, params: dict, pool: str, func, *args, **kwargs) -> JSONResponse:
+    job_id = get_job_manager().submit(kind, params, pool, func, *args, **kwargs)
+    return JSONResponse(content={"status": "OK", "job_id": job_id}, status_code=202)
+
+
+@api_router.post("/installecr", tags=["installecr"])
+def installecr(component: InstallECRComponentModel, background: bool = False):
+    components = [f"{component.component_name}:{component.component_version}"]
+    logger.info(
+        "ecr components: {}, copy default: {}, restart: {}, update files: {}",
+        components, component.copy_default, component.restart, component.update_files
+    )
+    if background:
+        return submit_job(
+            "installecr", component.dict(), PULL_POOL, install_ecr_components,
+            components, component.copy_default, component.restart, component.update_files
+        )
+    return install_ecr_components(components, component.copy_default, component.restart, component.update_files)
+
+
+@api_router.get("/jobs/{job_id}", tags=["jobs"])
+def get_job(job_id: str):
+    job = get_job_manager().get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job
+
+
+@api_router.get("/jobs/{job_id}/logs", tags=["jobs"])
+def get_job_logs(job_id: str, follow: bool = True):
+    job_manager = get_job_manager()
+    if job_manager.get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return StreamingResponse(job_manager.follow_logs(job_id, follow), media_type="text/plain")
+
+
+@api_router.get("/progress", tags=["progress"])
+def get_progress_list(status: str = None):
+    return [state for state in list_progress() if status is None or state["status"] == status]
+
+
+@api_router.get("/progress/{progress_id}", tags=["progress"])
+def get_progress_state(progress_id: str):
+    state = get_progress(progress_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"Progress not found: {progress_id}")
+    return state
+
+
 @api_router.post("/update/version", tags=["update-version"])
 def update_files(component: UpdateComponentVersionModel):
     components = [{"name": component.component_name, "version": component.component_version}]
@@ -271,14 +321,18 @@ def update_files(component: UpdateComponentVersionModel):
     }
 
 
+def _get_compose_state(component_name: str = None):
+    compose_state = get_compose_state(get_lucidum_dir())
+    if component_name is not None and not compose_state.has_service(component_name):
+        raise HTTPException(status_code=404, detail=f"Component not found: {component_name}")
+    return compose_state
+
+
 def handle_start_action(component_name: str = None):
     lucidum_dir = get_lucidum_dir()
+    compose_state = _get_compose_state(component_name)
     if component_name is not None:
-        services = list_docker_compose_containers(lucidum_dir, services=True)
-        running_services = list_docker_compose_containers(lucidum_dir, services=True, filter_="status=running")
-        if component_name not in services.split():
-            raise HTTPException(status_code=404, detail=f"Component not found: {component_name}")
-        if component_name not in running_services.split():
+        if not compose_state.is_running(component_name):
             start_docker_compose_service(lucidum_dir, component_name)
     else:
         start_docker_compose(lucidum_dir)
@@ -287,12 +341,9 @@ def handle_start_action(component_name: str = None):
 
 def handle_stop_action(component_name: str = None):
     lucidum_dir = get_lucidum_dir()
+    compose_state = _get_compose_state(component_name)
     if component_name is not None:
-        services = list_docker_compose_containers(lucidum_dir, services=True)
-        running_services = list_docker_compose_containers(lucidum_dir, services=True, filter_="status=running")
-        if component_name not in services.split():
-            raise HTTPException(status_code=404, detail=f"Component not found: {component_name}")
-        if component_name in running_services.split():
+        if compose_state.is_running(component_name):
             stop_docker_compose_service(lucidum_dir, component_name)
     else:
         stop_docker_compose(lucidum_dir)
@@ -301,10 +352,8 @@ def handle_stop_action(component_name: str = None):
 
 def handle_restart_action(component_name: str = None):
     lucidum_dir = get_lucidum_dir()
+    _get_compose_state(component_name)
     if component_name is not None:
-        services = list_docker_compose_containers(lucidum_dir, services=True)
-        if component_name not in services.split():
-            raise HTTPException(status_code=404, detail=f"Component not found: {component_name}")
         restart_docker_compose_service(lucidum_dir, component_name)
     else:
         restart_docker_compose(lucidum_dir)
@@ -315,21 +364,25 @@ def handle_logs_action(component_name: str = None, tail: int = 2000):
     if not 0 <= tail <= 10000:
         raise HTTPException(status_code=400, detail="Parameter 'tail' should be in range 0-10000")
     lucidum_dir = get_lucidum_dir()
-    list_result = list_docker_compose_containers(lucidum_dir, services=True)
-    services = list_result.split()
+    compose_state = _get_compose_state(component_name)
     if component_name is not None:
-        if component_name not in services:
-            raise HTTPException(status_code=404, detail=f"Component not found: {component_name}")
         output = get_docker_compose_logs(lucidum_dir, component_name, tail)
     else:
-        tail_per_service = int(tail / len(services))
+        tail_per_service = int(tail / len(compose_state.get_services()))
         output = get_docker_compose_logs(lucidum_dir, tail=tail_per_service)
     return output
 
 
 @api_router.get("/docker-compose", tags=["docker-compose"])
 @api_router.get("/docker-compose/{component_name}", tags=["docker-compose"])
-def manage_docker_compose_actions(component_name: str = None, action: str = None, lines: int = 2000):
+def manage_docker_compose_actions(
+        component_name: str = None, action: str = None, lines: int = 2000, background: bool = False
+):
+    if action == "restart" and background:
+        return submit_job(
+            "docker-compose-restart", {"component_name": component_name}, CONTAINER_POOL,
+            handle_restart_action, component_name
+        )
     if action == "start":
         output = handle_start_action(component_name)
     elif action == "stop":
@@ -426,17 +479,42 @@ def get_connector_version(connector_type: str) -> Optional[str]:
     return connector_version
 
 
+def run_test_command(image: str, command: str, privileged: bool = False) -> bytes:
+    runtime_pool = get_runtime_pool()
+    if runtime_pool is None:
+        return run_docker_container(
+            image, stdout=True, stderr=True, remove=True, network="lucidum_default", privileged=privileged,
+            command=command
+        )
+    return runtime_pool.run(image, command, network="lucidum_default", privileged=privileged)
+
+
 @api_router.get("/connector/{connector_type}/test/{technology}")
-def run_connector_test_command(connector_type: str, technology: str, profile_db_id: str, trace_id: str):
+def run_connector_test_command(
+        connector_type: str, technology: str, profile_db_id: str, trace_id: str, background: bool = False
+):
     """Run connector test command.
         :param connector_type (str): api, gcp, aws, azure
         :param technology (str): ad_ldap, okta
         :param profile_db_id (str): ui connector config db id
         :param trace_id (str): trace_id for this API, unique for each API
+        :param background (bool): run test as a job and return its id
         """
     connector_version = get_connector_version(connector_type)
     if not connector_version:
         return JSONResponse(content={"status": "FAILED", "output": "can't find image version"}, status_code=404)
+    if background:
+        return submit_job(
+            "connector-test",
+            {"connector_type": connector_type, "technology": technology, "profile_db_id": profile_db_id,
+             "trace_id": trace_id, "version": connector_version},
+            CONTAINER_POOL, run_connector_test, connector_type, connector_version, technology, profile_db_id, trace_id
+        )
+    return run_connector_test(connector_type, connector_version, technology, profile_db_id, trace_id)
+
+
+def run_connector_test(connector_type: str, connector_version: str, technology: str, profile_db_id: str,
+                       trace_id: str):
     image = f"connector-{connector_type}:{connector_version}"
     # api and sdk connections has technology
     command = f'bash -c "python lucidum_{connector_type}.py test {technology} {profile_db_id}:{trace_id}"'
@@ -446,10 +524,7 @@ def run_connector_test_command(connector_type: str, technology: str, profile_db_
     docker_privileged = False
     if connector_type in ['sdk']:
         docker_privileged = True
-    out = run_docker_container(
-        image, stdout=True, stderr=True, remove=True, network="lucidum_default", privileged=docker_privileged,
-        command=command
-    )
+    out = run_test_command(image, command, docker_privileged)
     if trace_id:
         _db_client.client['test_database']['connector_test_result'].update_one({"trace_id": trace_id}, {
             "$set": {"last_tested_at": datetime.now(tz=timezone.utc)}})
@@ -468,10 +543,7 @@ def run_action_test_command(bridge: str, raw_config_name: str):
     image = f"action-manager:{action_version}"
     command = f'bash -c "python lucidum_action.py test --bridge \\"{bridge}\\" --config_name \\"{config_name}\\""'
     docker_privileged = False
-    out = run_docker_container(
-        image, stdout=True, stderr=True, remove=True, network="lucidum_default", privileged=docker_privileged,
-        command=command
-    )
+    out = run_test_command(image, command, docker_privileged)
     test_result = _db_client.client['test_database']['local_integration_configuration'].find_one(
                     {"bridge_name": bridge, "config_name": config_name})
     if test_result:
@@ -517,27 +589,18 @@ def get_local_action():
 
 
 @api_router.get("/connector/config-to-db")
-def run_connector_config_to_db():
+def run_connector_config_to_db(background: bool = False):
+    if background:
+        return submit_job("config-to-db", {}, CONTAINER_POOL, connector_config_to_db)
+    return connector_config_to_db()
+
+
+def connector_config_to_db():
     connectors = get_local_connectors()
     action = get_local_action()
     if action:
         connectors.append(action)
-    result = []
-    for connector in connectors:
-        if connector['type'] == 'action':
-            main_image = "action-manager"
-        else:
-            main_image = f"connector-{connector['type']}"
-        image = f"{main_image}:{connector['version']}"
-        command = f'bash -c "python lucidum_{connector["type"]}.py config-to-db"'
-        out = run_docker_container(
-            image, stdout=True, stderr=True, remove=True, network="lucidum_default", command=command
-        )
-        result.append({
-            "status": "OK",
-            "output": out.decode(),
-        })
-    return result
+    return run_config_to_db(connectors)
 
 
 @api_router.get("/images")
@@ -1158,10 +1221,19 @@ def get_action_results(hours_ago: int = 24) -> list:
 
 def startup_event() -> None:
     setup_logging()
+    get_docker_index(live=True)
+    get_job_manager().fail_interrupted_jobs()
+    start_image_gc_job()
+    start_backup_scheduler()
+
+
+def shutdown_event() -> None:
+    close_runtime_pool()
 
 
 def setup_startup_event(app_: FastAPI) -> None:
     app_.add_event_handler("startup", startup_event)
+    app_.add_event_handler("shutdown", shutdown_event)
 
 
 def default_exception_handler(request, exc) -> JSONResponse:
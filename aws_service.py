@@ -1,4 +1,5 @@
 import base64
+import json
 from datetime import datetime, timezone
 from urllib.parse import urlparse
 
@@ -6,6 +7,12 @@ import boto3
 
 
 class ECRClient:
+    manifest_media_types = [
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.oci.image.index.v1+json",
+    ]
 
     def __init__(self, region, access_key=None, secret_key=None) -> None:
         self._region = region
@@ -32,10 +39,44 @@ class ECRClient:
     def get_repositories(self):
         return self._paginate(lambda r: r["repositories"], self.client.describe_repositories)
 
-    def get_images(self, repository_name):
-        return self._paginate(
-            lambda r: r["imageDetails"], self.client.describe_images, repositoryName=repository_name
-        )
+    def get_images(self, repository_name, registry_id=None):
+        kwargs = {"repositoryName": repository_name}
+        if registry_id:
+            kwargs["registryId"] = registry_id
+        return self._paginate(lambda r: r["imageDetails"], self.client.describe_images, **kwargs)
+
+    def describe_image(self, repository_name, image_tag, registry_id=None):
+        kwargs = {"repositoryName": repository_name, "imageIds": [{"imageTag": image_tag}]}
+        if registry_id:
+            kwargs["registryId"] = registry_id
+        return self.client.describe_images(**kwargs)["imageDetails"][0]
+
+    def get_image_manifest(self, repository_name, image_id, registry_id=None):
+        kwargs = {
+            "repositoryName": repository_name,
+            "imageIds": [image_id],
+            "acceptedMediaTypes": self.manifest_media_types,
+        }
+        if registry_id:
+            kwargs["registryId"] = registry_id
+        images = self.client.batch_get_image(**kwargs)["images"]
+        if not images:
+            raise ValueError(f"Image manifest not found: {repository_name} {image_id}")
+        manifest = json.loads(images[0]["imageManifest"])
+        if "manifests" in manifest:
+            # manifest list, pick linux/amd64 image manifest
+            digest = next(
+                m["digest"] for m in manifest["manifests"]
+                if m.get("platform", {}).get("os") == "linux" and m.get("platform", {}).get("architecture") == "amd64"
+            )
+            return self.get_image_manifest(repository_name, {"imageDigest": digest}, registry_id)
+        return manifest
+
+    def get_layer_download_url(self, repository_name, layer_digest, registry_id=None):
+        kwargs = {"repositoryName": repository_name, "layerDigest": layer_digest}
+        if registry_id:
+            kwargs["registryId"] = registry_id
+        return self.client.get_download_url_for_layer(**kwargs)["downloadUrl"]
 
     def _get_auth_config(self):
         response = self.client.get_authorization_token()
@@ -1,32 +1,113 @@
+import io
+import json
+import re
 import subprocess
 import sys
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
 
 import os
+import psutil
+import shutil
 from loguru import logger
+from tabulate import tabulate
 
-from config_handler import get_db_config, get_mongo_config, get_lucidum_dir, get_backup_dir
-from docker_service import get_docker_container
+from config_handler import get_db_config, get_mongo_config, get_lucidum_dir, get_backup_dir, get_backup_config, \
+    get_retention_config
+from docker_service import get_docker_container, exec_stream, create_members_archive
 from exceptions import AppError
-from file_handler import get_file_handler, LocalFileHandler
+from file_handler import get_file_handler, gzip_chunks, get_compress_program, LocalFileHandler, Digests, \
+    set_bandwidth_limit, get_compression_levels, COMPRESSION_EXTENSIONS, READ_CHUNK_SIZE
+from progress_handler import Progress
+from incremental_backup_handler import IncrementalBackup, get_chunk_store, SNAPSHOTS_DIR, SNAPSHOT_SUFFIX, \
+    DEFAULT_WORKERS
+
+BACKUP_DATE_FORMAT = "%Y%m%d_%H%M%S"
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = ".manifest.json"
+COLLECTIONS_MANIFEST = "collections.json"
+COLLECTION_MEMBER_SUFFIX = ".archive.gz"
+DEFAULT_MONGO_DUMP_WORKERS = 4
+
+
+def _get_priority_prefix() -> str:
+    """Return nice and ionice prefix matching priority of this process for commands run by docker exec.
+
+    Commands executed within containers do not inherit priority of the process starting them, so
+    dumps of scheduled backups would run with default priority otherwise.
+    """
+    process = psutil.Process()
+    prefix = []
+    ionice = process.ionice()
+    if ionice.ioclass == psutil.IOPRIO_CLASS_IDLE:
+        prefix += ["ionice", "-c", "3"]
+    elif ionice.ioclass == psutil.IOPRIO_CLASS_BE:
+        prefix += ["ionice", "-c", "2", "-n", str(ionice.value)]
+    if process.nice() > 0:
+        prefix += ["nice", "-n", str(process.nice())]
+    return "".join(f"{arg} " for arg in prefix)
+
+
+def _get_component_versions() -> list:
+    from install_handler import get_image_and_version
+    try:
+        return sorted(get_image_and_version())
+    except Exception as e:
+        logger.warning("Cannot get component versions for backup manifest: {}", e)
+        return []
 
 
 class BaseBackupRunner:
     backup_filename_format = None
 
-    def __init__(self, name: str, file_handler, backup_dir: str = None, path: str = None) -> None:
+    def __init__(
+        self, name: str, file_handler, backup_dir: str = None, path: str = None, manifest: bool = True
+    ) -> None:
         self.name = name
         self.file_handler = file_handler
         self.backup_dir = backup_dir
         self._path = path
+        self.manifest = manifest
+        self.progress = None
         self.datetime_now = datetime.now()
+        self.digests = Digests(["sha256", "blake3"] if get_backup_config().get("blake3") else ["sha256"])
         if self.backup_dir is not None:
             os.makedirs(backup_dir, exist_ok=True)
 
+    def write_manifest(self, codec: str) -> None:
+        """Write sidecar manifest with digests computed while backup file was written."""
+        if not self.manifest:
+            return
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "name": self.name,
+            "artifact": os.path.basename(self.backup_file),
+            "created_at": self.datetime_now.isoformat(),
+            "size": self.digests.size,
+            "digests": self.digests.hexdigests(),
+            "etag": self.file_handler.stat(self.backup_file)["etag"],
+            "codec": codec,
+            "component_versions": _get_component_versions(),
+        }
+        self.file_handler.write(f"{self.backup_file}{MANIFEST_SUFFIX}", json.dumps(manifest, indent=2).encode())
+
+    def track(self, chunks, counter: str = "read"):
+        return self.progress.track(chunks, counter) if self.progress is not None else chunks
+
+    def stage(self, name: str):
+        return self.progress.stage(name) if self.progress is not None else nullcontext()
+
+    def add_written(self, filepath: str) -> None:
+        if self.progress is not None and os.path.isfile(filepath):
+            self.progress.add(os.path.getsize(filepath), "written")
+
     @property
     def backup_file(self):
-        backup_file = self.backup_filename_format.format(date=self.datetime_now.strftime('%Y%m%d_%H%M%S'))
+        backup_file = self.backup_filename_format.format(date=self.datetime_now.strftime(BACKUP_DATE_FORMAT))
         if self._path:
             backup_file = self.file_handler.get_file_path(self._path, backup_file)
         else:
@@ -39,17 +120,35 @@ class BaseBackupRunner:
 
 
 class MySQLBackupRunner(BaseBackupRunner):
-    backup_filename_format = "mysql_dump_{date}.sql"
+    backup_filename_format = "mysql_dump_{date}.sql.gz"
+
+    def __init__(
+        self,
+        name: str,
+        file_handler,
+        backup_dir: str = None,
+        path: str = None,
+        compress: bool = True,
+        manifest: bool = True
+    ) -> None:
+        super().__init__(name, file_handler, backup_dir, path, manifest)
+        self.compress = compress
+        if not compress:
+            self.backup_filename_format = "mysql_dump_{date}.sql"
 
     def __call__(self):
         container = get_docker_container("mysql")
-        dump_cmd = "mysqldump --no-tablespaces --user={mysql_user} {mysql_db}"
+        dump_cmd = _get_priority_prefix() + "mysqldump --no-tablespaces --user={mysql_user} {mysql_db}"
         db_config = get_db_config()
         logger.info("Dumping data for '{}' into {} file...", self.name, self.backup_file)
-        result = container.exec_run(dump_cmd.format(**db_config), environment={"MYSQL_PWD": db_config["mysql_pwd"]})
-        if result.exit_code:
-            raise AppError(result.output.decode('utf-8'))
-        self.file_handler.write(self.backup_file, result.output)
+        # dump is streamed straight to destination, so memory usage does not depend on database size
+        chunks = exec_stream(container, dump_cmd.format(**db_config), environment={"MYSQL_PWD": db_config["mysql_pwd"]})
+        chunks = self.track(chunks, "read")
+        if self.compress:
+            chunks = gzip_chunks(chunks)
+        with self.stage("dump"):
+            self.file_handler.write_stream(self.backup_file, self.track(chunks, "written"), self.digests)
+        self.write_manifest("gzip" if self.compress else "none")
         logger.info("'{}' backup data is saved to {}", self.name, self.backup_file)
         return self.backup_file
 
@@ -66,9 +165,10 @@ class MongoBackupRunner(BaseBackupRunner):
         backup_dir: str = None,
         path: str = None,
         collection: str = None,
-        exclude_collections: list = None
+        exclude_collections: list = None,
+        manifest: bool = True
     ) -> None:
-        super().__init__(name, file_handler, backup_dir, path)
+        super().__init__(name, file_handler, backup_dir, path, manifest)
         self.collection = collection
         self.exclude_collections = exclude_collections
 
@@ -83,12 +183,15 @@ class MongoBackupRunner(BaseBackupRunner):
             dump_cmd = f"{dump_cmd} {' '.join(excludes)}"
         logger.info("Dumping data for '{}' into {} file...", self.name, self.backup_file)
         try:
-            result = container.exec_run(dump_cmd.format(**get_mongo_config()))
+            with self.stage("dump"):
+                result = container.exec_run(_get_priority_prefix() + dump_cmd.format(**get_mongo_config()))
             if result.exit_code:
                 raise AppError(result.output.decode('utf-8'))
-            self.file_handler.copy_file(
-                os.path.join(self.host_dir.format(get_lucidum_dir()), filename), self.backup_file
-            )
+            dump_filepath = os.path.join(self.host_dir.format(get_lucidum_dir()), filename)
+            with self.stage("copy"):
+                self.file_handler.copy_file(dump_filepath, self.backup_file, self.digests)
+            self.add_written(dump_filepath)
+            self.write_manifest("gzip")
         finally:
             rm_result = container.exec_run(f"rm {self.container_dir}/{filename}", user='root')
             if rm_result.exit_code:
@@ -97,6 +200,85 @@ class MongoBackupRunner(BaseBackupRunner):
         return self.backup_file
 
 
+class MongoCollectionsBackupRunner(MongoBackupRunner):
+    """Dumps every mongo collection by its own mongodump process into tar of gzip archives.
+
+    Collections are dumped concurrently, 'mongo_dump_workers' of BACKUP_CONFIG at most, and
+    'collections.json' member lists document count and size of each of them, so a single
+    collection can be restored without restoring the others.
+    """
+    backup_filename_format = "mongo_collections_{date}.tar"
+    documents_pattern = re.compile(rb"done dumping \S+?\.(\S+) \((\d+) documents?\)")
+
+    def _get_collections(self) -> list:
+        from connector_handler import MongoDBClient
+        mongo_config = get_mongo_config()
+        db = MongoDBClient(**mongo_config).client[mongo_config["mongo_db"]]
+        if self.collection is not None:
+            return [self.collection]
+        excludes = set(self.exclude_collections or [])
+        return sorted(
+            name for name in db.list_collection_names() if not name.startswith("system.") and name not in excludes
+        )
+
+    def _dump_collection(self, container, staging_dir: str, collection: str) -> dict:
+        dump_cmd = "mongodump --username={mongo_user} --password={mongo_pwd} --authenticationDatabase=test_database --host={mongo_host} --port={mongo_port} --forceTableScan --archive --gzip --db={mongo_db}"
+        dump_cmd = f"{_get_priority_prefix()}{dump_cmd.format(**get_mongo_config())} --collection={collection}"
+        filepath = os.path.join(staging_dir, f"{collection}{COLLECTION_MEMBER_SUFFIX}")
+        stderr = []
+        started = time.monotonic()
+        LocalFileHandler().write_stream(filepath, self.track(exec_stream(container, dump_cmd, on_stderr=stderr.append)))
+        match = self.documents_pattern.search(b"".join(stderr))
+        logger.info("Collection '{}' is dumped in {:.1f}s", collection, time.monotonic() - started)
+        return {
+            "name": collection,
+            "member": os.path.basename(filepath),
+            "documents": int(match.group(2)) if match else None,
+            "size": os.path.getsize(filepath),
+        }
+
+    def _iter_members(self, staging_dir: str, manifest: dict):
+        data = json.dumps(manifest, indent=2).encode()
+        yield COLLECTIONS_MANIFEST, len(data), io.BytesIO(data)
+        for collection in manifest["collections"]:
+            filepath = os.path.join(staging_dir, collection["member"])
+            with open(filepath, "rb") as f:
+                yield collection["member"], collection["size"], f
+
+    def __call__(self):
+        container = get_docker_container("mongo")
+        collections = self._get_collections()
+        workers = get_backup_config().get("mongo_dump_workers", DEFAULT_MONGO_DUMP_WORKERS)
+        staging_dir = os.path.join(self.backup_dir, f"{str(uuid.uuid4())}_mongo_collections")
+        os.makedirs(staging_dir)
+        logger.info(
+            "Dumping {} collections for '{}' into {} file with {} workers...",
+            len(collections), self.name, self.backup_file, workers
+        )
+        try:
+            with self.stage("dump"), ThreadPoolExecutor(max_workers=max(1, min(workers, len(collections)))) as executor:
+                dumped = list(executor.map(
+                    lambda collection: self._dump_collection(container, staging_dir, collection), collections
+                ))
+            manifest = {
+                "version": MANIFEST_VERSION,
+                "db": get_mongo_config()["mongo_db"],
+                "created_at": self.datetime_now.isoformat(),
+                "collections": dumped,
+            }
+            with self.stage("upload"):
+                self.file_handler.write_stream(
+                    self.backup_file,
+                    self.track(create_members_archive(self._iter_members(staging_dir, manifest)), "written"),
+                    self.digests
+                )
+            self.write_manifest("none")
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        logger.info("'{}' backup data is saved to {}", self.name, self.backup_file)
+        return self.backup_file
+
+
 class LucidumDirBackupRunner(BaseBackupRunner):
     backup_filename_format = "lucidum_{date}.tar.gz"
     _items_to_exclude = [
@@ -115,31 +297,163 @@ class LucidumDirBackupRunner(BaseBackupRunner):
         "postgres"
     ]
 
+    def __init__(
+        self,
+        name: str,
+        file_handler,
+        backup_dir: str = None,
+        path: str = None,
+        compression: str = None,
+        compression_level: int = None
+    ) -> None:
+        super().__init__(name, file_handler, backup_dir, path)
+        config = get_backup_config()
+        self.compression = compression or config.get("compression", "gzip")
+        self.compression_level = compression_level or config.get("compression_level")
+        levels = get_compression_levels(self.compression)
+        if self.compression_level is not None and self.compression_level not in levels:
+            raise AppError(
+                f"Compression level {self.compression_level} is not supported by '{self.compression}' codec, "
+                f"supported levels: {', '.join(map(str, levels)) or 'none'}"
+            )
+        self.backup_filename_format = f"lucidum_{{date}}{COMPRESSION_EXTENSIONS[self.compression]}"
+
+    def _timed(self, timings: dict, stage: str, func, *args):
+        started = time.monotonic()
+        try:
+            with self.stage(stage):
+                return func(*args)
+        finally:
+            timings[stage] = time.monotonic() - started
+
+    def _run_tar(self, dump_cmd: list, staging_dir: str, dumps: list) -> int:
+        """Write output of tar into backup file while member names are fed to it from another thread."""
+        process = subprocess.Popen(dump_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        feed_errors = []
+
+        def _feed():
+            try:
+                process.stdin.write(b".\n")
+                process.stdin.flush()
+                dump_files = [dump.result() for dump in dumps]
+                process.stdin.write(f"-C{staging_dir}\n".encode())
+                for dump_file in dump_files:
+                    process.stdin.write(f"{os.path.basename(dump_file)}\n".encode())
+            except BaseException as e:
+                feed_errors.append(e)
+                process.terminate()
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        feeder = threading.Thread(target=_feed, name="tar-feeder", daemon=True)
+        feeder.start()
+        try:
+            # goes through write_stream, so backup bandwidth limit applies to archive itself
+            chunks = iter(lambda: process.stdout.read(READ_CHUNK_SIZE), b"")
+            self.file_handler.write_stream(self.backup_file, self.track(chunks, "written"), self.digests)
+        except BaseException:
+            process.terminate()
+            raise
+        finally:
+            process.stdout.close()
+            feeder.join()
+            return_code = process.wait()
+        if feed_errors:
+            raise feed_errors[0]
+        return return_code
+
+    def _archive(self, lucidum_dir: str, staging_dir: str, dumps: list, timings: dict) -> None:
+        """Archive lucidum tree while database dumps are running and append dumps once they are done."""
+        excludes = [f"--exclude={f}" for f in self._items_to_exclude]
+        dump_cmd = ["sudo", "tar", "-cf", "-"]
+        compress_program = get_compress_program(self.compression, self.compression_level)
+        if compress_program is not None:
+            dump_cmd.append(f"--use-compress-program={compress_program}")
+        # member names are read from stdin, so dumps can be added after tree is archived
+        dump_cmd += excludes + [f"--directory={lucidum_dir}", "--files-from=-"]
+        logger.info(
+            "Dumping data for '{}' into {} file with '{}' compression...",
+            self.name, self.backup_file, compress_program or "no"
+        )
+        completed = False
+        try:
+            return_code = self._timed(timings, "archive", self._run_tar, dump_cmd, staging_dir, dumps)
+            if return_code:
+                raise AppError(f"Archiving lucidum directory failed with {return_code} code")
+            completed = True
+        finally:
+            if not completed:
+                self.file_handler.delete_files([self.backup_file])
+        self.write_manifest(self.compression)
+
     def __call__(self):
+        started = time.monotonic()
         lucidum_dir = get_lucidum_dir()
         local_file_handler = LocalFileHandler()
-        mysql_backup_file = MySQLBackupRunner("mysql", local_file_handler, backup_dir=lucidum_dir)()
-        mongo_backup_file = MongoBackupRunner("mongo", local_file_handler, backup_dir=lucidum_dir)()
-        excludes = " ".join(f"--exclude={f}" for f in self._items_to_exclude)
-        backup_filepath = os.path.join(self.backup_dir, f"{str(uuid.uuid4())}_lucidum.tar.gz")
-        dump_cmd = f"sudo tar -czvf {backup_filepath} {excludes} --directory={lucidum_dir} ."
-        logger.info("Dumping data for '{}' into {} file...", self.name, self.backup_file)
+        staging_dir = os.path.join(self.backup_dir, f"{str(uuid.uuid4())}_dumps")
+        os.makedirs(staging_dir)
+        timings = {}
+        # lucidum archive is compressed as a whole
+        dump_runners = [
+            MySQLBackupRunner("mysql", local_file_handler, backup_dir=staging_dir, compress=False, manifest=False),
+            MongoBackupRunner("mongo", local_file_handler, backup_dir=staging_dir, manifest=False),
+        ]
         try:
-            subprocess.run(dump_cmd.split(), check=True)
-            self.file_handler.copy_file(backup_filepath, self.backup_file)
+            with ThreadPoolExecutor(max_workers=len(dump_runners)) as executor:
+                dumps = [
+                    executor.submit(self._timed, timings, f"{runner.name} dump", runner) for runner in dump_runners
+                ]
+                self._archive(lucidum_dir, staging_dir, dumps, timings)
         finally:
-            if os.path.isfile(mysql_backup_file):
-                os.remove(mysql_backup_file)
-            if os.path.isfile(mongo_backup_file):
-                os.remove(mongo_backup_file)
-            if os.path.isfile(backup_filepath):
-                os.remove(backup_filepath)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        timings["total"] = time.monotonic() - started
+        logger.info(
+            "'{}' backup stage timings: {}", self.name, ", ".join(f"{k} {v:.1f}s" for k, v in timings.items())
+        )
         logger.info("'{}' backup data is saved to {}", self.name, self.backup_file)
         return self.backup_file
 
 
+class LucidumDirIncrementalBackupRunner(LucidumDirBackupRunner):
+    """Backs up lucidum directory as snapshot of content-addressed chunk store.
+
+    Filepath is the chunk store root (local directory or S3 url), 'lucidum_store' within
+    backup directory is used by default. Only files changed since previous snapshot are read.
+    """
+    store_dirname = "lucidum_store"
+
+    @property
+    def store_root(self) -> str:
+        return (self._path or os.path.join(self.backup_dir, self.store_dirname)).rstrip("/")
+
+    @property
+    def snapshot_name(self) -> str:
+        return f"lucidum_{self.datetime_now.strftime(BACKUP_DATE_FORMAT)}"
+
+    @property
+    def backup_file(self):
+        return f"{self.store_root}/{SNAPSHOTS_DIR}/{self.snapshot_name}{SNAPSHOT_SUFFIX}"
+
+    def _archive(self, lucidum_dir: str, staging_dir: str, dumps: list, timings: dict) -> None:
+        logger.info("Dumping data for '{}' into {} snapshot...", self.name, self.backup_file)
+        workers = get_backup_config().get("incremental_workers", DEFAULT_WORKERS)
+        dump_files = [dump.result() for dump in dumps]
+        self._timed(timings, "snapshot", IncrementalBackup(
+            get_chunk_store(self.store_root), lucidum_dir, self._items_to_exclude, workers,
+            extra_files={os.path.basename(dump_file): dump_file for dump_file in dump_files}
+        ), self.snapshot_name)
+
+
 def get_backup_runner(
-    data_to_backup: str, filepath: str = None, collection: str = None, exclude_collections: list = None
+    data_to_backup: str,
+    filepath: str = None,
+    collection: str = None,
+    exclude_collections: list = None,
+    compression: str = None,
+    compression_level: int = None
 ):
     backup_dir = get_backup_dir()
     file_handler = get_file_handler(filepath) if filepath is not None else LocalFileHandler()
@@ -154,20 +468,103 @@ def get_backup_runner(
             collection=collection,
             exclude_collections=exclude_collections
         )
+    elif data_to_backup == "mongo-collections":
+        return MongoCollectionsBackupRunner(
+            data_to_backup,
+            file_handler,
+            backup_dir=backup_dir,
+            path=filepath,
+            collection=collection,
+            exclude_collections=exclude_collections
+        )
+    elif data_to_backup == "mongo-incremental":
+        from mongo_incremental_handler import MongoIncrementalBackupRunner
+        return MongoIncrementalBackupRunner(data_to_backup, file_handler, backup_dir=backup_dir, path=filepath)
+    elif data_to_backup == "lucidum-incremental":
+        return LucidumDirIncrementalBackupRunner(data_to_backup, file_handler, backup_dir=backup_dir, path=filepath)
     elif data_to_backup == "lucidum":
         return LucidumDirBackupRunner(
-            data_to_backup, file_handler, backup_dir=backup_dir, path=filepath
+            data_to_backup,
+            file_handler,
+            backup_dir=backup_dir,
+            path=filepath,
+            compression=compression,
+            compression_level=compression_level
         )
     else:
         raise AppError(f"Cannot backup data for {data_to_backup}")
 
 
 @logger.catch(onerror=lambda _: sys.exit(1))
-def backup(data: list, filepath: str, collection: str = None, exclude_collections: list = None):
+def backup(
+    data: list,
+    filepath: str,
+    collection: str = None,
+    exclude_collections: list = None,
+    compression: str = None,
+    compression_level: int = None,
+    bandwidth_limit: float = None
+):
+    bandwidth_limit = bandwidth_limit or get_backup_config().get("bandwidth_limit")
+    if bandwidth_limit:
+        logger.info("Backup writes and uploads are limited to {} MiB/s", bandwidth_limit)
+        set_bandwidth_limit(int(bandwidth_limit * 1024 ** 2))
     try:
-        backup_runners = [get_backup_runner(d, filepath, collection, exclude_collections) for d in data]
+        backup_runners = [
+            get_backup_runner(d, filepath, collection, exclude_collections, compression, compression_level)
+            for d in data
+        ]
         for backup_runner in backup_runners:
-            backup_runner()
+            with Progress(f"backup {backup_runner.name}") as progress:
+                backup_runner.progress = progress
+                backup_runner()
     except AppError as e:
         logger.exception(e)
         raise e
+    if get_retention_config().get("auto", True):
+        from retention_handler import apply_retention
+        try:
+            apply_retention(data, filepath)
+        except Exception as e:
+            logger.exception("Cannot apply retention policy after backup: {}", e)
+
+
+def verify_backup_file(filepath: str, deep: bool = False) -> tuple:
+    """Check backup file against its sidecar manifest, return status and message.
+
+    S3 objects whose size and ETag match the manifest are not downloaded unless deep check is
+    requested, otherwise content is hashed while it is read by parallel ranged requests.
+    """
+    file_handler = get_file_handler(filepath)
+    manifest = json.loads(file_handler.read(f"{filepath}{MANIFEST_SUFFIX}"))
+    stat = file_handler.stat(filepath)
+    if stat["size"] != manifest["size"]:
+        return "failed", f"size is {stat['size']}, {manifest['size']} expected"
+    if not deep and stat["etag"] is not None and stat["etag"] == manifest.get("etag"):
+        return "ok", "size and ETag match"
+    digests = Digests(list(manifest["digests"]))
+    for chunk in file_handler.iter_chunks(filepath):
+        digests.update(chunk)
+    actual = digests.hexdigests()
+    mismatched = [algorithm for algorithm, digest in actual.items() if manifest["digests"][algorithm] != digest]
+    if mismatched:
+        return "failed", f"{', '.join(mismatched)} digest mismatch"
+    return "ok", f"{', '.join(actual)} digest match"
+
+
+@logger.catch(onerror=lambda _: sys.exit(1))
+def verify(filepaths: list, deep: bool = False):
+    results = []
+    for filepath in filepaths:
+        started = time.monotonic()
+        try:
+            status, message = verify_backup_file(filepath, deep)
+        except Exception as e:
+            logger.exception("Cannot verify '{}' backup file", filepath)
+            status, message = "failed", str(e)
+        results.append([filepath, status, message, f"{time.monotonic() - started:.1f}s"])
+    logger.info("Backup verification:\n{}", tabulate(
+        results, headers=["File", "Status", "Message", "Time"], tablefmt="orgtbl"
+    ))
+    if any(result[1] == "failed" for result in results):
+        sys.exit(1)
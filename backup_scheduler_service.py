@@ -0,0 +1,220 @@
+import fcntl
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import os
+import psutil
+from loguru import logger
+
+from config_handler import get_backup_schedule_config, get_state_dir
+from exceptions import AppError
+
+SCHEDULER_LOCK_FILE = "backup_scheduler.lock"
+JOB_LOCK_FILE = "backup_job_{name}.lock"
+UPDATE_MANAGER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "update_manager.py")
+DEFAULT_IO_CLASS = "idle"
+DEFAULT_NICE = 10
+DEFAULT_MAX_LOAD = 1.5
+DEFAULT_LOAD_BACKOFF_SECONDS = 300
+DEFAULT_MAX_LOAD_DELAY = 3600
+IO_CLASSES = {"idle": psutil.IOPRIO_CLASS_IDLE, "best-effort": psutil.IOPRIO_CLASS_BE}
+# field name, minimum and maximum of cron expression fields
+CRON_FIELDS = [("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7)]
+
+
+def _parse_cron_field(field: str, minimum: int, maximum: int) -> set:
+    values = set()
+    for part in field.split(","):
+        value_range, _, step = part.partition("/")
+        if value_range == "*":
+            start, end = minimum, maximum
+        elif "-" in value_range:
+            start, end = (int(value) for value in value_range.split("-", 1))
+        else:
+            start = int(value_range)
+            end = maximum if step else start
+        if start < minimum or end > maximum or start > end:
+            raise AppError(f"Cron field value '{part}' is out of {minimum}-{maximum} range")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+class CronExpression:
+    """Five field cron expression supporting '*', lists, ranges and steps.
+
+    Like cron, day of month and day of week match if either of them matches when both are restricted.
+    """
+
+    def __init__(self, expression: str) -> None:
+        fields = expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise AppError(f"Cron expression '{expression}' must have {len(CRON_FIELDS)} fields")
+        self.expression = expression
+        try:
+            self.minutes, self.hours, self.days, self.months, weekdays = (
+                _parse_cron_field(field, minimum, maximum) for field, (_, minimum, maximum) in zip(fields, CRON_FIELDS)
+            )
+        except ValueError:
+            raise AppError(f"Cron expression '{expression}' is invalid")
+        # both 0 and 7 stand for sunday
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def _matches_day(self, date: datetime) -> bool:
+        day_matches = date.day in self.days
+        # cron counts weekdays from sunday
+        weekday_matches = (date.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+    def get_next(self, after: datetime) -> datetime:
+        """Return the first matching minute after given time."""
+        date = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = date + timedelta(days=366 * 5)
+        while date < limit:
+            if date.month not in self.months or not self._matches_day(date):
+                date = date.replace(hour=0, minute=0) + timedelta(days=1)
+            elif date.hour not in self.hours:
+                date = date.replace(minute=0) + timedelta(hours=1)
+            elif date.minute not in self.minutes:
+                date += timedelta(minutes=1)
+            else:
+                return date
+        raise AppError(f"Cron expression '{self.expression}' never matches")
+
+
+class BackupJob:
+    """Scheduled backup run by separate update manager process with lowered I/O and CPU priority.
+
+    Job lock is inherited by backup process, so a run is skipped while the previous one is
+    in progress, even if scheduler was restarted meanwhile. Database dumps run within their
+    containers by docker exec get the same nice and ionice priority, but 'cgroup' and 'io_max'
+    limits apply to host processes only, not to dumps running within containers.
+    """
+
+    def __init__(self, job: dict, config: dict) -> None:
+        self.name = job["name"]
+        self.cron = CronExpression(job["cron"])
+        self.job = job
+        self.config = {**config, **job}
+        self.next_run = self.cron.get_next(datetime.now())
+
+    def get_command(self) -> list:
+        command = [sys.executable, UPDATE_MANAGER_FILE, "backup"]
+        for data in self.job.get("data", ["lucidum"]):
+            command += ["--data", data]
+        if self.job.get("filepath"):
+            command += ["--filepath", self.job["filepath"]]
+        if self.job.get("compression"):
+            command += ["--compression", self.job["compression"]]
+        if self.job.get("compression_level") is not None:
+            command += ["--compression-level", str(self.job["compression_level"])]
+        if self.config.get("bandwidth_limit"):
+            command += ["--bandwidth-limit", str(self.config["bandwidth_limit"])]
+        return command
+
+    def _wait_for_load(self) -> None:
+        max_load = self.config.get("max_load", DEFAULT_MAX_LOAD)
+        backoff = self.config.get("load_backoff_seconds", DEFAULT_LOAD_BACKOFF_SECONDS)
+        deadline = time.monotonic() + self.config.get("max_load_delay", DEFAULT_MAX_LOAD_DELAY)
+        while True:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            if load <= max_load:
+                return
+            if time.monotonic() + backoff > deadline:
+                logger.warning("Host load is still {:.2f} per core, running '{}' backup anyway", load, self.name)
+                return
+            logger.info("Host load is {:.2f} per core, postponing '{}' backup by {}s", load, self.name, backoff)
+            time.sleep(backoff)
+
+    def _limit_process(self, pid: int) -> None:
+        process = psutil.Process(pid)
+        io_class = self.config.get("io_class", DEFAULT_IO_CLASS)
+        if io_class == "best-effort":
+            process.ionice(IO_CLASSES[io_class], value=self.config.get("io_priority", 7))
+        elif io_class in IO_CLASSES:
+            process.ionice(IO_CLASSES[io_class])
+        process.nice(self.config.get("nice", DEFAULT_NICE))
+        cgroup = self.config.get("cgroup")
+        if cgroup:
+            # cgroup v2 directory, its io.max lines look like '8:0 rbps=104857600 wbps=52428800'
+            os.makedirs(cgroup, exist_ok=True)
+            for io_max in self.config.get("io_max", []):
+                with open(os.path.join(cgroup, "io.max"), "w") as f:
+                    f.write(io_max)
+            with open(os.path.join(cgroup, "cgroup.procs"), "w") as f:
+                f.write(str(pid))
+
+    def run(self) -> None:
+        lock_file = open(os.path.join(get_state_dir(), JOB_LOCK_FILE.format(name=self.name)), "w")
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                logger.warning("Previous '{}' backup is still in progress, skipping this run", self.name)
+                return
+            self._wait_for_load()
+            logger.info("Starting scheduled '{}' backup...", self.name)
+            process = subprocess.Popen(self.get_command(), pass_fds=[lock_file.fileno()])
+        finally:
+            lock_file.close()
+        try:
+            self._limit_process(process.pid)
+        except Exception as e:
+            logger.warning("Cannot lower priority of '{}' backup process: {}", self.name, e)
+        return_code = process.wait()
+        if return_code:
+            logger.error("Scheduled '{}' backup failed with {} code", self.name, return_code)
+        else:
+            logger.info("Scheduled '{}' backup is finished", self.name)
+
+
+class BackupScheduler:
+    """Runs backup jobs of BACKUP_SCHEDULE_CONFIG on their cron expressions."""
+
+    def __init__(self) -> None:
+        config = get_backup_schedule_config()
+        self.jobs = [BackupJob(job, config) for job in config.get("jobs", [])]
+        self._stopped = threading.Event()
+
+    def _run_job(self, job: BackupJob) -> None:
+        try:
+            job.run()
+        except Exception as e:
+            logger.exception("Scheduled '{}' backup failed: {}", job.name, e)
+
+    def run_forever(self) -> None:
+        for job in self.jobs:
+            logger.info("Backup '{}' is scheduled on '{}', next run at {}", job.name, job.cron.expression, job.next_run)
+        while self.jobs and not self._stopped.is_set():
+            job = min(self.jobs, key=lambda j: j.next_run)
+            if self._stopped.wait(max(0.0, (job.next_run - datetime.now()).total_seconds())):
+                return
+            job.next_run = job.cron.get_next(datetime.now())
+            threading.Thread(target=self._run_job, args=(job,), name=f"backup-{job.name}", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def run_backup_scheduler() -> None:
+    """Run scheduler in foreground unless another process runs it already."""
+    with open(os.path.join(get_state_dir(), SCHEDULER_LOCK_FILE), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            logger.info("Backup scheduler is already running in another process")
+            return
+        BackupScheduler().run_forever()
+
+
+def start_backup_scheduler() -> None:
+    """Start scheduler in background if it is enabled, only one API worker ends up running it."""
+    if not get_backup_schedule_config().get("enabled"):
+        return
+    threading.Thread(target=run_backup_scheduler, name="backup-scheduler", daemon=True).start()
@@ -0,0 +1,44 @@
+import os
+
+from docker_index_service import get_docker_index
+
+
+class ComposeState:
+    """State of docker compose project containers.
+
+    State is read from docker index which tracks containers with compose labels through
+    docker SDK and events stream, so checking project services does not fork docker
+    compose CLI.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = os.path.realpath(directory)
+
+    def get_projects(self) -> list:
+        return [
+            project for project, working_dir in get_docker_index(live=True).get_projects().items()
+            if working_dir and os.path.realpath(working_dir) == self.directory
+        ]
+
+    def get_service_containers(self, service: str) -> list:
+        docker_index = get_docker_index(live=True)
+        containers = [
+            container for project in self.get_projects()
+            for container in docker_index.get_service_containers(project, service) if not container["oneoff"]
+        ]
+        return sorted(containers, key=lambda c: c["name"])
+
+    def get_services(self) -> set:
+        docker_index = get_docker_index(live=True)
+        services = {service for project in self.get_projects() for service in docker_index.get_project_services(project)}
+        return {service for service in services if self.get_service_containers(service)}
+
+    def has_service(self, service: str) -> bool:
+        return bool(self.get_service_containers(service))
+
+    def is_running(self, service: str) -> bool:
+        return any(container["state"] == "running" for container in self.get_service_containers(service))
+
+
+def get_compose_state(directory: str) -> ComposeState:
+    return ComposeState(directory)
@@ -1,4 +1,5 @@
 import base64
+import os
 from base64 import urlsafe_b64encode
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
@@ -62,6 +63,26 @@ def get_backup_dir() -> str:
     return required_field_check("BACKUP_DIR")
 
 
+def get_backup_config() -> dict:
+    return settings.get("BACKUP_CONFIG") or {}
+
+
+def get_s3_transfer_config() -> dict:
+    return settings.get("S3_TRANSFER_CONFIG") or {}
+
+
+def get_retention_config() -> dict:
+    return settings.get("RETENTION_CONFIG") or {}
+
+
+def get_backup_schedule_config() -> dict:
+    return settings.get("BACKUP_SCHEDULE_CONFIG") or {}
+
+
+def get_mongo_incremental_config() -> dict:
+    return settings.get("MONGO_INCREMENTAL_CONFIG") or {}
+
+
 def get_jinja_templates_dir() -> str:
     return required_field_check("JINJA_TEMPLATES_DIR")
 
@@ -118,6 +139,34 @@ def get_airflow_db_config():
     }
 
 
+def get_state_dir() -> str:
+    state_dir = settings.get("STATE_DIR", "state")
+    if not os.path.isabs(state_dir):
+        state_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), state_dir)
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def get_image_gc_config() -> dict:
+    return settings.get("IMAGE_GC_CONFIG") or {}
+
+
+def get_install_preflight_config() -> dict:
+    return settings.get("INSTALL_PREFLIGHT_CONFIG") or {}
+
+
+def get_runtime_pool_config() -> dict:
+    return settings.get("RUNTIME_POOL_CONFIG") or {}
+
+
+def get_jobs_config() -> dict:
+    return settings.get("JOBS_CONFIG") or {}
+
+
+def get_config_to_db_config() -> dict:
+    return settings.get("CONFIG_TO_DB_CONFIG") or {}
+
+
 def get_docker_compose_service_image_mapping_config() -> dict:
     return settings.get("DOCKER_COMPOSE_SERVICE_IMAGE_MAPPING")
 
@@ -211,20 +260,27 @@ def get_images_from_ecr():
     return images
 
 
+def _get_local_image_data(lucidum_dir, name, version):
+    image_data = {
+        "name": name,
+        "version": version,
+    }
+    image_data.update(get_image_path_mapping(lucidum_dir, name, version))
+    return image_data
+
+
 def get_local_images():
-    docker_client = get_docker_client()
+    from docker_index_service import get_docker_index
     lucidum_dir = get_lucidum_dir()
-    images = []
-    for image in docker_client.images.list():
-        for imageTag in image.tags:
-            data = imageTag.split(":")
-            image_data = {
-                "name": data[0],
-                "version": data[1],
-            }
-            image_data.update(get_image_path_mapping(lucidum_dir, data[0], data[1]))
-            images.append(image_data)
-    return images
+    return [_get_local_image_data(lucidum_dir, name, version) for name, version in get_docker_index().get_tags()]
+
+
+def get_local_image(component):
+    from docker_index_service import get_docker_index
+    if not get_docker_index().has_image(component):
+        return None
+    name, _, version = component.rpartition(":")
+    return _get_local_image_data(get_lucidum_dir(), name, version)
 
 def get_ecr_pw():
     ecr_token = settings.get('ECR_TOKEN', None)
@@ -0,0 +1,90 @@
+import time
+
+import os
+import psutil
+from loguru import logger
+from requests.exceptions import ConnectionError, ReadTimeout
+from tabulate import tabulate
+
+from config_handler import get_docker_client, get_config_to_db_config
+from executor_service import ContextThreadPoolExecutor
+
+DEFAULT_TIMEOUT = 900
+DEFAULT_CONTAINER_MEMORY = 512 * 1024 ** 2
+NETWORK = "lucidum_default"
+
+
+def get_connector_image(connector: dict) -> str:
+    main_image = "action-manager" if connector["type"] == "action" else f"connector-{connector['type']}"
+    return f"{main_image}:{connector['version']}"
+
+
+class ConfigToDbExecutor:
+    """Runs config-to-db command of every connector and action-manager concurrently.
+
+    Number of concurrent containers is limited by host CPU count and by available memory
+    divided by expected memory of one container, both can be overridden with
+    CONFIG_TO_DB_CONFIG. Every container is waited for with its own timeout, its output
+    and exit code are collected separately and it is removed afterwards.
+    """
+
+    def __init__(self, max_workers: int = None, timeout: int = None) -> None:
+        config = get_config_to_db_config()
+        self.max_workers = max_workers or config.get("max_workers")
+        self.timeout = timeout or config.get("timeout", DEFAULT_TIMEOUT)
+        self.container_memory = config.get("container_memory", DEFAULT_CONTAINER_MEMORY)
+        self._docker_client = get_docker_client()
+
+    def get_workers(self, count: int) -> int:
+        if self.max_workers:
+            return max(1, min(self.max_workers, count))
+        by_memory = psutil.virtual_memory().available // self.container_memory
+        return max(1, min(os.cpu_count() or 1, by_memory, count))
+
+    def _run_connector(self, connector: dict) -> dict:
+        image = get_connector_image(connector)
+        command = f'bash -c "python lucidum_{connector["type"]}.py config-to-db"'
+        result = {"type": connector["type"], "version": connector["version"], "image": image, "exit_code": None}
+        started = time.monotonic()
+        container = None
+        try:
+            container = self._docker_client.containers.run(image, command=command, network=NETWORK, detach=True)
+            try:
+                result["exit_code"] = container.wait(timeout=self.timeout)["StatusCode"]
+                result["status"] = "OK" if result["exit_code"] == 0 else "FAILED"
+            except (ReadTimeout, ConnectionError):
+                logger.warning("config-to-db of '{}' timed out after {}s", image, self.timeout)
+                container.kill()
+                result["status"] = "TIMEOUT"
+            result["output"] = container.logs(stdout=True, stderr=True).decode(errors="replace")
+        except Exception as e:
+            logger.warning("config-to-db error of '{}': {}", image, e)
+            result["status"] = "FAILED"
+            result["output"] = str(e)
+        finally:
+            if container is not None:
+                try:
+                    container.remove(force=True)
+                except Exception as e:
+                    logger.warning("Cannot remove '{}' container: {}", container.name, e)
+        result["seconds"] = round(time.monotonic() - started, 1)
+        logger.info("config-to-db of '{}' finished with {} in {}s", image, result["status"], result["seconds"])
+        return result
+
+    def __call__(self, connectors: list) -> list:
+        if not connectors:
+            return []
+        workers = self.get_workers(len(connectors))
+        logger.info("Running config-to-db of {} connectors with {} workers...", len(connectors), workers)
+        started = time.monotonic()
+        with ContextThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(self._run_connector, connectors))
+        logger.info("config-to-db summary ({:.1f}s):\n{}", time.monotonic() - started, tabulate(
+            [[r["image"], r["status"], r["exit_code"], r["seconds"]] for r in results],
+            headers=["Image", "Status", "Exit code", "Seconds"], tablefmt="orgtbl"
+        ))
+        return results
+
+
+def run_config_to_db(connectors: list) -> list:
+    return ConfigToDbExecutor()(connectors)
@@ -0,0 +1,301 @@
+import json
+import threading
+import time
+
+import os
+from dateutil import parser as dateutil_parser
+from docker.errors import NotFound
+from loguru import logger
+
+from config_handler import get_docker_client, get_state_dir
+from docker_service import get_docker_events_listener
+
+COMPOSE_PROJECT_LABEL = "com.docker.compose.project"
+COMPOSE_SERVICE_LABEL = "com.docker.compose.service"
+COMPOSE_WORKING_DIR_LABEL = "com.docker.compose.project.working_dir"
+COMPOSE_ONEOFF_LABEL = "com.docker.compose.oneoff"
+
+SNAPSHOT_FILE = "docker_index.json"
+SNAPSHOT_VERSION = 1
+# docker daemon keeps only this many events, replay may be incomplete if it is reached
+DAEMON_EVENTS_LIMIT = 256
+SNAPSHOT_WRITE_INTERVAL = 5
+
+# events which change anything kept in index
+IMAGE_ACTIONS = {"pull", "tag", "untag", "delete", "load", "import"}
+CONTAINER_ACTIONS = {
+    "create", "start", "restart", "stop", "die", "kill", "pause", "unpause", "rename", "oom", "update", "destroy",
+}
+
+_docker_index = None
+_docker_index_lock = threading.Lock()
+
+
+def _split_tag(tag: str) -> tuple:
+    name, _, version = tag.rpartition(":")
+    return name, version
+
+
+def _to_container(data: dict) -> dict:
+    labels = data.get("Labels") or {}
+    return {
+        "id": data["Id"],
+        "name": data["Names"][0].lstrip("/") if data.get("Names") else data["Id"][:12],
+        "image": data.get("Image"),
+        "image_id": data.get("ImageID"),
+        "project": labels.get(COMPOSE_PROJECT_LABEL),
+        "service": labels.get(COMPOSE_SERVICE_LABEL),
+        "working_dir": labels.get(COMPOSE_WORKING_DIR_LABEL),
+        "oneoff": labels.get(COMPOSE_ONEOFF_LABEL) == "True",
+        "state": data.get("State"),
+        "status": data.get("Status"),
+    }
+
+
+class DockerIndex:
+    """In-memory index of local docker images and containers.
+
+    Images are indexed by 'name:version' tag and by image id, containers by id and by
+    compose service. Index is built once and then kept current by docker events: either
+    live from events stream or by replaying events since the last persisted snapshot,
+    so short-lived CLI runs do not list every image again.
+    """
+
+    def __init__(self) -> None:
+        self._images = {}
+        self._tags = {}
+        self._containers = {}
+        self._services = {}
+        self._synced_at = None
+        self._snapshot_written_at = 0
+        self._live = False
+        self._lock = threading.RLock()
+
+    # ---------- building ----------
+
+    def build(self) -> None:
+        docker_client = get_docker_client()
+        synced_at = time.time()
+        images = docker_client.api.images()
+        containers = docker_client.api.containers(all=True)
+        with self._lock:
+            self._images, self._tags = {}, {}
+            for image in images:
+                self._set_image(image["Id"], image.get("RepoTags"), image["Created"], image.get("Size"))
+            self._set_containers(_to_container(c) for c in containers)
+            self._synced_at = synced_at
+        self.save_snapshot()
+
+    def _set_image(self, image_id: str, tags: list, created: int, size: int) -> None:
+        self._remove_image(image_id)
+        tags = [tag for tag in tags or [] if tag != "<none>:<none>"]
+        for tag in tags:
+            previous_id = self._tags.get(tag)
+            if previous_id is not None and previous_id in self._images:
+                self._images[previous_id]["tags"].remove(tag)
+            self._tags[tag] = image_id
+        self._images[image_id] = {"id": image_id, "tags": tags, "created": created, "size": size}
+
+    def _remove_image(self, image_id: str) -> None:
+        image = self._images.pop(image_id, None)
+        if image is not None:
+            for tag in image["tags"]:
+                if self._tags.get(tag) == image_id:
+                    del self._tags[tag]
+
+    def _set_containers(self, containers) -> None:
+        self._containers, self._services = {}, {}
+        for container in containers:
+            self._set_container(container)
+
+    def _set_container(self, container: dict) -> None:
+        self._remove_container(container["id"])
+        self._containers[container["id"]] = container
+        if container["project"] is not None:
+            self._services.setdefault((container["project"], container["service"]), set()).add(container["id"])
+
+    def _remove_container(self, container_id: str) -> None:
+        container = self._containers.pop(container_id, None)
+        if container is None or container["project"] is None:
+            return
+        key = (container["project"], container["service"])
+        container_ids = self._services.get(key, set())
+        container_ids.discard(container_id)
+        if not container_ids:
+            self._services.pop(key, None)
+
+    def _refresh_image(self, reference: str) -> None:
+        docker_client = get_docker_client()
+        try:
+            data = docker_client.api.inspect_image(reference)
+        except NotFound:
+            with self._lock:
+                image_id = reference if reference in self._images else self._tags.get(reference)
+                if image_id is not None:
+                    self._remove_image(image_id)
+            return
+        created = int(dateutil_parser.isoparse(data["Created"]).timestamp())
+        with self._lock:
+            self._set_image(data["Id"], data.get("RepoTags"), created, data.get("Size"))
+
+    def _refresh_container(self, container_id: str) -> None:
+        docker_client = get_docker_client()
+        containers = docker_client.api.containers(all=True, filters={"id": container_id})
+        with self._lock:
+            self._remove_container(container_id)
+            for container in containers:
+                self._set_container(_to_container(container))
+
+    # ---------- events ----------
+
+    def apply_event(self, event: dict) -> None:
+        event_type, action = event.get("Type"), event.get("Action", "").split(":", 1)[0]
+        if event_type == "image" and action in IMAGE_ACTIONS:
+            if action == "delete":
+                with self._lock:
+                    self._remove_image(event["id"])
+            else:
+                self._refresh_image(event["id"])
+        elif event_type == "container" and action in CONTAINER_ACTIONS:
+            if action == "destroy":
+                with self._lock:
+                    self._remove_container(event["id"])
+            else:
+                self._refresh_container(event["id"])
+        else:
+            return
+        with self._lock:
+            self._synced_at = max(self._synced_at or 0, event.get("timeNano", 0) / 1e9 or event.get("time", 0))
+        if time.time() - self._snapshot_written_at >= SNAPSHOT_WRITE_INTERVAL:
+            self.save_snapshot()
+
+    def replay_events(self) -> bool:
+        """Apply events happened since last sync, return False if they cannot be replayed completely."""
+        if self._synced_at is None:
+            return False
+        docker_client = get_docker_client()
+        until = time.time()
+        events = list(docker_client.events(
+            since=int(self._synced_at), until=int(until), decode=True,
+            filters={"type": ["image", "container"]}
+        ))
+        if len(events) >= DAEMON_EVENTS_LIMIT:
+            return False
+        for event in events:
+            self.apply_event(event)
+        with self._lock:
+            self._synced_at = until
+        if len(self._containers) != docker_client.info()["Containers"]:
+            return False
+        return True
+
+    def sync(self) -> None:
+        if self._live and get_docker_events_listener().connected:
+            return
+        if not self.replay_events():
+            logger.debug("Cannot replay docker events, rebuilding docker index")
+            self.build()
+        else:
+            self.save_snapshot()
+
+    @property
+    def live(self) -> bool:
+        return self._live
+
+    def subscribe(self) -> None:
+        if not self._live:
+            self._live = True
+            get_docker_events_listener().subscribe(self.apply_event, self.build)
+
+    # ---------- snapshot ----------
+
+    @staticmethod
+    def _get_snapshot_filepath() -> str:
+        return os.path.join(get_state_dir(), SNAPSHOT_FILE)
+
+    def save_snapshot(self) -> None:
+        with self._lock:
+            data = {
+                "version": SNAPSHOT_VERSION,
+                "synced_at": self._synced_at,
+                "images": list(self._images.values()),
+                "containers": list(self._containers.values()),
+            }
+        filepath = self._get_snapshot_filepath()
+        tmp_filepath = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_filepath, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_filepath, filepath)
+            self._snapshot_written_at = time.time()
+        except OSError as e:
+            logger.warning("Cannot save docker index snapshot: {}", e)
+
+    def load_snapshot(self) -> bool:
+        filepath = self._get_snapshot_filepath()
+        if not os.path.isfile(filepath):
+            return False
+        try:
+            with open(filepath) as f:
+                data = json.load(f)
+        except ValueError as e:
+            logger.warning("Cannot load docker index snapshot: {}", e)
+            return False
+        if data.get("version") != SNAPSHOT_VERSION:
+            return False
+        with self._lock:
+            self._images, self._tags = {}, {}
+            for image in data["images"]:
+                self._set_image(image["id"], image["tags"], image["created"], image["size"])
+            self._set_containers(data["containers"])
+            self._synced_at = data["synced_at"]
+        return True
+
+    # ---------- lookups ----------
+
+    def has_image(self, tag: str) -> bool:
+        with self._lock:
+            return tag in self._tags
+
+    def get_tags(self) -> list:
+        """Return (name, version) pairs of all tagged local images."""
+        with self._lock:
+            return [_split_tag(tag) for tag in self._tags]
+
+    def get_project_services(self, project: str) -> list:
+        with self._lock:
+            return [service for project_, service in self._services if project_ == project]
+
+    def get_service_containers(self, project: str, service: str) -> list:
+        """Return containers of compose service looked up by (project, service) key."""
+        with self._lock:
+            return [dict(self._containers[c]) for c in self._services.get((project, service), ())]
+
+    def get_projects(self) -> dict:
+        """Return working directories of compose projects by project name."""
+        with self._lock:
+            return {
+                project: self._containers[next(iter(container_ids))]["working_dir"]
+                for (project, _), container_ids in self._services.items()
+            }
+
+
+def get_docker_index(live: bool = False, sync: bool = False) -> DockerIndex:
+    """Return docker index synchronized with docker daemon.
+
+    Index is synchronized once per process, later calls return it as is unless sync is set,
+    which callers that changed docker images themselves should do. Live index is kept current
+    by docker events stream in background, it should be used by long running processes only.
+    """
+    global _docker_index
+    with _docker_index_lock:
+        if _docker_index is None:
+            _docker_index = DockerIndex()
+            _docker_index.load_snapshot()
+            sync = True
+        if live and not _docker_index.live:
+            _docker_index.subscribe()
+            sync = True
+        if sync:
+            _docker_index.sync()
+    return _docker_index
@@ -2,7 +2,7 @@ import sys
 
 from loguru import logger
 
-from config_handler import get_local_images
+from config_handler import get_local_image
 from docker_service import run_docker_container
 from exceptions import AppError
 
@@ -28,9 +28,7 @@ def run_command(image_data: dict, cmd: str):
 
 @logger.catch(onerror=lambda _: sys.exit(1))
 def run(component: str, cmd: str):
-    image_data = next(
-        (image for image in get_local_images() if f"{image['name']}:{image['version']}" == component), None
-    )
+    image_data = get_local_image(component)
     if not image_data:
         raise AppError(f"Component '{component}' was not found in image list")
     logger.info("Running command within '{}' component: {}", component, cmd)
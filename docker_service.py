@@ -1,18 +1,27 @@
+import socket
 import subprocess
+import threading
 import time
 
+import io
 import os
 import re
 import shutil
 import tarfile
 from docker.models.images import Image
-from io import BytesIO
+from docker.utils.socket import frames_iter
 from loguru import logger
 
 from config_handler import get_ecr_client, get_docker_client, get_aws_config, get_ecr_pw
+from executor_service import ContextThreadPoolExecutor
+from exceptions import AppError
+from file_handler import IterStream
 
+DEFAULT_CHUNK_SIZE = 1024 * 1024
 ECR_REGISTRY_PATTERN = r"\d{12}\.dkr\.ecr\.[a-z0-9-]+\.amazonaws\.com/.+"
 
+_docker_events_listener = None
+
 
 def get_docker_image(name):
     docker_client = get_docker_client()
@@ -74,12 +83,84 @@ def load_docker_images(filepath: str) -> list:
         return docker_client.images.load(f)
 
 
+def load_docker_images_from_stream(stream, chunk_size: int = DEFAULT_CHUNK_SIZE) -> list:
+    """Load docker images from given file-like object sending it to docker by chunks."""
+    docker_client = get_docker_client()
+    return docker_client.images.load(iter(lambda: stream.read(chunk_size), b""))
+
+
+def inspect_docker_images(image_ids, workers: int = 8) -> dict:
+    """Inspect given docker images concurrently and return their attributes by image id."""
+    docker_client = get_docker_client()
+    image_ids = list(image_ids)
+    with ContextThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(image_ids, executor.map(docker_client.api.inspect_image, image_ids)))
+
+
+def get_docker_root_dir() -> str:
+    docker_client = get_docker_client()
+    return docker_client.info()["DockerRootDir"]
+
+
 def remove_docker_image(image: str, **kwargs) -> None:
     docker_client = get_docker_client()
     logger.info("Removing '{}' image...", image)
     docker_client.images.remove(image, **kwargs)
 
 
+def _is_within_directory(directory: str, path: str) -> bool:
+    return os.path.commonpath([directory, path]) == directory
+
+
+def extract_tar_stream(stream, extract_dir: str) -> None:
+    """Extract tar stream member by member, skipping members which would escape extract_dir."""
+    extract_dir = os.path.realpath(extract_dir)
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extraction_filter = tarfile.data_filter
+        directories = []
+        for member in tar:
+            target = os.path.realpath(os.path.join(extract_dir, member.name))
+            if member.issym():
+                link_target = os.path.realpath(os.path.join(os.path.dirname(target), member.linkname))
+            elif member.islnk():
+                link_target = os.path.realpath(os.path.join(extract_dir, member.linkname))
+            else:
+                link_target = target
+            if member.isdev() or not _is_within_directory(extract_dir, target) or \
+                    not _is_within_directory(extract_dir, link_target):
+                logger.warning("Skipping unsafe archive member: {}", member.name)
+                continue
+            if member.islnk():
+                # tarfile would re-read the link target from the stream when linking fails, which
+                # is not possible in stream mode, so hard links are made from the extracted target
+                _extract_hard_link(os.path.join(extract_dir, member.name), link_target)
+                continue
+            if member.isdir():
+                directories.append(member)
+            tar.extract(member, extract_dir, set_attrs=not member.isdir())
+        # like extractall, directory attributes are set once their content is extracted, so read-only
+        # directories can still be filled and their mtime is not changed by files created within
+        extraction_filter = getattr(tar, "extraction_filter", None)
+        for member in sorted(directories, key=lambda m: m.name, reverse=True):
+            if extraction_filter is not None:
+                member = extraction_filter(member, extract_dir)
+            dirpath = os.path.join(extract_dir, member.name)
+            tar.chown(member, dirpath, False)
+            tar.utime(member, dirpath)
+            tar.chmod(member, dirpath)
+
+
+def _extract_hard_link(target: str, link_target: str) -> None:
+    if not os.path.isfile(link_target):
+        logger.warning("Skipping hard link to missing archive member: {}", link_target)
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.lexists(target):
+        os.unlink(target)
+    os.link(link_target, target)
+
+
 def copy_files_from_docker_container(image: Image, docker_path, host_path):
     if not os.path.exists(host_path):
         os.makedirs(host_path)
@@ -88,33 +169,140 @@ def copy_files_from_docker_container(image: Image, docker_path, host_path):
         return
     docker_client = get_docker_client()
     logger.info("Copy files from {} docker {} to host {}", image.tags, docker_path, host_path)
+    # container is only created to read its filesystem, it is never started
     container = docker_client.containers.create(image, 'bash')
-    filename = os.path.join(host_path, "docker.tar")
     try:
-        bits, _ = container.get_archive(f"{docker_path}/.")
-        with open(filename, 'wb') as f:
-            for chunk in bits:
-                f.write(chunk)
-        shutil.unpack_archive(filename, extract_dir=host_path)
+        bits, _ = container.get_archive(f"{docker_path}/.", chunk_size=DEFAULT_CHUNK_SIZE)
+        extract_tar_stream(io.BufferedReader(IterStream(bits), DEFAULT_CHUNK_SIZE), host_path)
     finally:
         logger.info("clean up")
         container.remove()
-        if os.path.isfile(filename):
-            os.remove(filename)
 
 
-def create_archive(filepath: str):
-    tar_stream = BytesIO()
-    tar = tarfile.TarFile(fileobj=tar_stream, mode='w')
+def copy_files_from_docker_images(files_to_copy: list, workers: int = 4) -> None:
+    """Copy files from several docker images concurrently.
+
+    :param files_to_copy: list of (image, docker path, host path) tuples
+    """
+    with ContextThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(copy_files_from_docker_container, *args) for args in files_to_copy]
+    for future in futures:
+        future.result()
+
+
+def create_members_archive(members, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Yield tar archive of (name, size, file object) members by chunks read from their file objects.
+
+    Members are consumed one after another, so they can be produced lazily and memory usage
+    is bounded by chunk size whatever members size is.
+    """
+    offset = 0
+    for name, size, fileobj in members:
+        tarinfo = tarfile.TarInfo(name=name)
+        tarinfo.size = size
+        tarinfo.mtime = time.time()
+        header = tarinfo.tobuf(format=tarfile.DEFAULT_FORMAT, encoding=tarfile.ENCODING, errors="surrogateescape")
+        yield header
+        remaining = size
+        while remaining:
+            chunk = fileobj.read(min(chunk_size, remaining))
+            if not chunk:
+                raise AppError(f"File '{name}' was truncated while archiving it")
+            remaining -= len(chunk)
+            yield chunk
+        # pad member data to block size
+        offset += len(header) + size
+        padding = tarfile.NUL * ((tarfile.BLOCKSIZE - offset % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE)
+        offset += len(padding)
+        yield padding
+    # write end of archive blocks and pad archive to record size
+    trailer = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+    offset += len(trailer)
+    trailer += tarfile.NUL * ((tarfile.RECORDSIZE - offset % tarfile.RECORDSIZE) % tarfile.RECORDSIZE)
+    yield trailer
+
+
+def create_archive(filepath: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Yield tar archive containing given file by chunks read straight from disk.
+
+    Memory usage is bounded by chunk size whatever the file size is, so result can be
+    passed to put_archive for files much larger than available memory.
+    """
     with open(filepath, "rb") as f:
-        file_data = f.read()
-    tarinfo = tarfile.TarInfo(name=os.path.basename(filepath))
-    tarinfo.size = len(file_data)
-    tarinfo.mtime = time.time()
-    tar.addfile(tarinfo, BytesIO(file_data))
-    tar.close()
-    tar_stream.seek(0)
-    return tar_stream
+        yield from create_members_archive(
+            [(os.path.basename(filepath), os.path.getsize(filepath), f)], chunk_size
+        )
+
+
+def exec_stream(container, cmd, environment: dict = None, user: str = "", on_stderr=None):
+    """Run command within container and yield its stdout by chunks as they are produced.
+
+    Stderr is kept apart from output and passed to on_stderr callback if it is given,
+    AppError with its tail is raised at the end if command exits with non-zero status.
+    """
+    api = container.client.api
+    exec_id = api.exec_create(container.id, cmd, stdout=True, stderr=True, environment=environment, user=user)
+    stderr = b""
+    for stdout_chunk, stderr_chunk in api.exec_start(exec_id, stream=True, demux=True):
+        if stderr_chunk:
+            stderr = (stderr + stderr_chunk)[-64 * 1024:]
+            if on_stderr is not None:
+                on_stderr(stderr_chunk)
+        if stdout_chunk:
+            yield stdout_chunk
+    exit_code = api.exec_inspect(exec_id)["ExitCode"]
+    if exit_code:
+        raise AppError(stderr.decode("utf-8", errors="replace") or f"Command exited with {exit_code} code")
+
+
+def exec_stdin(container, cmd, chunks, environment: dict = None, user: str = "", on_output=None) -> bytes:
+    """Run command within container feeding iterator of bytes chunks to its stdin, return its output.
+
+    Chunks are written straight to exec socket while output is read by separate thread and
+    passed to on_output callback if it is given, so nothing is staged on disk and neither side
+    blocks the other. AppError with output tail is raised if command exits with non-zero status
+    or input cannot be fully written.
+    """
+    api = container.client.api
+    exec_id = api.exec_create(
+        container.id, cmd, stdin=True, stdout=True, stderr=True, environment=environment, user=user
+    )
+    sock = api.exec_start(exec_id, socket=True)
+    raw_sock = getattr(sock, "_sock", sock)
+    output = []
+
+    def _read_output():
+        for _, data in frames_iter(sock, tty=False):
+            output.append(data)
+            if on_output is not None:
+                on_output(data)
+            if len(output) > 256:
+                del output[:128]
+
+    reader = threading.Thread(target=_read_output, name="exec-output", daemon=True)
+    reader.start()
+    write_error = None
+    try:
+        try:
+            for chunk in chunks:
+                raw_sock.sendall(chunk)
+        except OSError as e:
+            # command exited before reading whole input, its exit code and output tell why
+            write_error = e
+        raw_sock.shutdown(socket.SHUT_WR)
+        reader.join()
+    finally:
+        sock.close()
+    exec_info = api.exec_inspect(exec_id)
+    while exec_info["Running"]:
+        time.sleep(0.1)
+        exec_info = api.exec_inspect(exec_id)
+    output = b"".join(output)[-64 * 1024:]
+    if exec_info["ExitCode"]:
+        raise AppError(output.decode("utf-8", errors="replace") or f"Command exited with {exec_info['ExitCode']} code")
+    if write_error is not None:
+        raise AppError(f"Cannot write input of '{cmd}' command: {write_error}")
+    return output
 
 
 def list_docker_containers(**kwargs):
@@ -200,3 +388,58 @@ def get_docker_compose_logs(directory: str, service_name: str = None, tail: int
         stderr=subprocess.PIPE
     )
     return cp.stdout
+
+
+class DockerEventsListener:
+    """Dispatches docker daemon events to subscribers from a background thread.
+
+    Every subscriber is resynced after the events stream is (re)connected, so events
+    missed while the stream was down never leave in-memory state stale.
+    """
+    reconnect_delay = 5
+
+    def __init__(self) -> None:
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connected = threading.Event()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def subscribe(self, on_event, on_resync=None) -> None:
+        with self._lock:
+            self._subscribers.append((on_event, on_resync))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name="docker-events", daemon=True)
+                self._thread.start()
+
+    def _notify(self, callback, *args) -> None:
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.warning("Docker events subscriber failed: {}", e)
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                events = get_docker_client().events(decode=True)
+                self._connected.set()
+                for _, on_resync in list(self._subscribers):
+                    if on_resync is not None:
+                        self._notify(on_resync)
+                for event in events:
+                    for on_event, _ in list(self._subscribers):
+                        self._notify(on_event, event)
+            except Exception as e:
+                logger.warning("Docker events stream failed: {}", e)
+            self._connected.clear()
+            time.sleep(self.reconnect_delay)
+
+
+def get_docker_events_listener() -> DockerEventsListener:
+    global _docker_events_listener
+    if _docker_events_listener is None:
+        _docker_events_listener = DockerEventsListener()
+    return _docker_events_listener
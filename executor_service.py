@@ -0,0 +1,13 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """Thread pool running every task within context of the thread which submitted it.
+
+    Job id is bound to logger context, which worker threads do not inherit otherwise, so
+    logs of pools started by a job would be missing from its log.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -1,8 +1,40 @@
+import hashlib
+import io
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import boto3
 import os
 import shutil
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+from loguru import logger
+from psutil._common import bytes2human
+
+from config_handler import get_s3_transfer_config
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+COMPRESSION_CODECS = ["gzip", "zstd", "none"]
+COMPRESSION_EXTENSIONS = {"gzip": ".tar.gz", "zstd": ".tar.zst", "none": ".tar"}
+DEFAULT_COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+# non-seekable streams are buffered by whole parts, memory is about chunk size * concurrency
+DEFAULT_S3_MULTIPART_CHUNKSIZE = 16 * 1024 ** 2
+DEFAULT_S3_MAX_CONCURRENCY = 8
+READ_CHUNK_SIZE = 8 * 1024 ** 2
+S3_DELETE_BATCH_SIZE = 1000
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_bandwidth_limiter = None
 
 
 def is_s3_url(url):
@@ -11,14 +43,237 @@ def is_s3_url(url):
     return urlparse(url).scheme in ["s3", "s3n", "s3a"]
 
 
+def gzip_chunks(chunks, level: int = 6):
+    """Compress iterator of bytes chunks into gzip format on the fly."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def detect_compression(head: bytes) -> str:
+    """Detect compression codec by magic bytes at the beginning of data."""
+    if head[:2] == b"\x1f\x8b":
+        return "gzip"
+    if head[:4] == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    return "none"
+
+
+def is_tar_header(head: bytes) -> bool:
+    return head[257:262] == b"ustar"
+
+
+def _get_gzip_executable() -> str:
+    # pigz compresses with all cores and produces ordinary gzip stream
+    return "pigz" if shutil.which("pigz") else "gzip"
+
+
+def get_compression_levels(codec: str) -> list:
+    """Return compression levels accepted by compress program of given codec."""
+    if codec == "none":
+        return []
+    if codec == "gzip":
+        # pigz additionally has level 11 which uses zopfli
+        return list(range(1, 10)) + ([11] if _get_gzip_executable() == "pigz" else [])
+    return list(range(1, 20))
+
+
+def get_compress_program(codec: str, level: int = None):
+    """Return tar compress program for given codec or None if data should not be compressed."""
+    if codec == "none":
+        return None
+    level = level or DEFAULT_COMPRESSION_LEVELS[codec]
+    if codec == "gzip":
+        return f"{_get_gzip_executable()} -{level}"
+    return f"zstd -T0 -{level}"
+
+
+def get_decompress_program(codec: str):
+    if codec == "none":
+        return None
+    if codec == "gzip":
+        return f"{_get_gzip_executable()} -d"
+    return "zstd -d -T0"
+
+
+class Digests:
+    """Size, SHA-256 and optionally BLAKE3 of data fed by chunks."""
+
+    def __init__(self, algorithms: list = None) -> None:
+        self.size = 0
+        self._hashes = {}
+        for algorithm in algorithms or ["sha256"]:
+            if algorithm == "blake3":
+                if blake3 is None:
+                    logger.warning("'blake3' package is not installed, BLAKE3 digest is skipped")
+                    continue
+                self._hashes[algorithm] = blake3.blake3(max_threads=blake3.blake3.AUTO)
+            else:
+                self._hashes[algorithm] = hashlib.new(algorithm)
+
+    def update(self, data: bytes) -> None:
+        self.size += len(data)
+        for hash_ in self._hashes.values():
+            hash_.update(data)
+
+    def hexdigests(self) -> dict:
+        return {algorithm: hash_.hexdigest() for algorithm, hash_ in self._hashes.items()}
+
+
+def hash_chunks(chunks, digests: Digests):
+    for chunk in chunks:
+        digests.update(chunk)
+        yield chunk
+
+
+class HashingReader:
+    """Non-seekable reader which feeds everything read from file object into digests."""
+
+    def __init__(self, fileobj, digests: Digests) -> None:
+        self._fileobj = fileobj
+        self._digests = digests
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fileobj.read(size)
+        self._digests.update(data)
+        return data
+
+
+class BandwidthLimiter:
+    """Token bucket limiting throughput of data passed through it, shared by all threads."""
+
+    def __init__(self, bytes_per_second: int) -> None:
+        self.bytes_per_second = bytes_per_second
+        self._available = bytes_per_second
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(
+                self.bytes_per_second, self._available + (now - self._updated) * self.bytes_per_second
+            )
+            self._updated = now
+            self._available -= size
+            delay = -self._available / self.bytes_per_second if self._available < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+def set_bandwidth_limit(bytes_per_second: int = None) -> None:
+    """Limit throughput of local writes and S3 uploads of this process, None removes the limit."""
+    global _bandwidth_limiter
+    _bandwidth_limiter = BandwidthLimiter(bytes_per_second) if bytes_per_second else None
+
+
+def get_bandwidth_limit():
+    return _bandwidth_limiter.bytes_per_second if _bandwidth_limiter is not None else None
+
+
+def throttle(size: int) -> None:
+    """Wait until given number of bytes may be written within bandwidth limit."""
+    if _bandwidth_limiter is not None:
+        _bandwidth_limiter.consume(size)
+
+
+def throttle_chunks(chunks):
+    for chunk in chunks:
+        throttle(len(chunk))
+        yield chunk
+
+
+class IterStream(io.RawIOBase):
+    """Read-only file-like object over an iterator of bytes chunks."""
+
+    def __init__(self, chunks) -> None:
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
 class LocalFileHandler:
 
     def write(self, path: str, data):
         with open(path, "wb+") as f:
             f.write(data)
 
-    def copy_file(self, src: str, dst: str):
-        shutil.copyfile(src, dst)
+    def write_stream(self, path: str, chunks, digests: Digests = None):
+        if digests is not None:
+            chunks = hash_chunks(chunks, digests)
+        chunks = throttle_chunks(chunks)
+        try:
+            with open(path, "wb+") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except BaseException:
+            if os.path.isfile(path):
+                os.remove(path)
+            raise
+
+    def copy_file(self, src: str, dst: str, digests: Digests = None):
+        if digests is None and _bandwidth_limiter is None:
+            shutil.copyfile(src, dst)
+            return
+        with open(src, "rb") as f:
+            self.write_stream(dst, iter(lambda: f.read(READ_CHUNK_SIZE), b""), digests)
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def read_head(self, path: str, size: int) -> bytes:
+        with open(path, "rb") as f:
+            return f.read(size)
+
+    def stat(self, path: str) -> dict:
+        return {"size": os.path.getsize(path), "etag": None}
+
+    def exists(self, path: str) -> bool:
+        return os.path.isfile(path)
+
+    def iter_chunks(self, path: str):
+        with open(path, "rb") as f:
+            yield from iter(lambda: f.read(READ_CHUNK_SIZE), b"")
+
+    def list_files(self, path: str, prefixes: list) -> list:
+        """Return paths of files within directory whose names start with any of given prefixes."""
+        if not os.path.isdir(path):
+            return []
+        with os.scandir(path) as entries:
+            return [
+                entry.path for entry in entries
+                if entry.is_file() and any(entry.name.startswith(prefix) for prefix in prefixes)
+            ]
+
+    def delete_files(self, paths: list) -> list:
+        """Delete files and return (path, error) pairs of ones which cannot be deleted."""
+        errors = []
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                errors.append((path, str(e)))
+        return errors
 
     def place_file(self, src: str, dst: str):
         shutil.copyfile(src, dst)
@@ -30,36 +285,177 @@ class LocalFileHandler:
         return filepath
 
 
+class _TransferProgress:
+
+    def __init__(self) -> None:
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount: int) -> None:
+        with self._lock:
+            self.bytes += bytes_amount
+
+
+def get_s3_client():
+    """Return S3 client shared by all handlers, boto3 clients are thread safe unlike resources."""
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            transfer_config = get_s3_transfer_config()
+            max_pool_connections = transfer_config.get("max_concurrency", DEFAULT_S3_MAX_CONCURRENCY) + 2
+            _s3_client = boto3.session.Session().client(
+                "s3", config=BotoConfig(max_pool_connections=max(10, max_pool_connections))
+            )
+    return _s3_client
+
+
+def get_transfer_config() -> TransferConfig:
+    config = get_s3_transfer_config()
+    chunk_size = config.get("multipart_chunksize", DEFAULT_S3_MULTIPART_CHUNKSIZE)
+    return TransferConfig(
+        multipart_threshold=config.get("multipart_threshold", chunk_size),
+        multipart_chunksize=chunk_size,
+        max_concurrency=config.get("max_concurrency", DEFAULT_S3_MAX_CONCURRENCY),
+        max_bandwidth=min(filter(None, [config.get("max_bandwidth"), get_bandwidth_limit()]), default=None),
+    )
+
+
 class S3FileHandler:
 
     def __init__(self) -> None:
-        self._s3_resource = None
+        self._transfer_config = None
 
     @property
-    def s3_resource(self):
-        if self._s3_resource is None:
-            self._s3_resource = boto3.resource("s3")
-        return self._s3_resource
+    def s3_client(self):
+        return get_s3_client()
+
+    @property
+    def transfer_config(self):
+        if self._transfer_config is None:
+            self._transfer_config = get_transfer_config()
+        return self._transfer_config
 
     def _parse_url(self, url: str):
         parsed = urlparse(url, allow_fragments=False)
         key = f"{parsed.path.lstrip('/')}?{parsed.query}" if parsed.query else parsed.path.lstrip("/")
         return parsed.netloc, key
 
-    def write(self, path: str, data):
+    def _transfer(self, direction: str, url: str, func, **kwargs) -> None:
+        progress = _TransferProgress()
+        started = time.monotonic()
+        func(Config=self.transfer_config, Callback=progress, **kwargs)
+        seconds = time.monotonic() - started
+        logger.info(
+            "{} {} {} in {:.1f}s ({}/s)", direction, bytes2human(progress.bytes), url, seconds,
+            bytes2human(progress.bytes / seconds if seconds else 0)
+        )
+
+    def write(self, path: str, data, digests: Digests = None):
+        """Upload bytes, file-like object or iterator of bytes chunks with multipart upload."""
         bucket_name, key = self._parse_url(path)
-        obj = self.s3_resource.Object(bucket_name, key)
-        obj.put(Body=data)
+        if isinstance(data, (bytes, bytearray)):
+            data = io.BytesIO(data)
+        elif not hasattr(data, "read"):
+            data = io.BufferedReader(IterStream(data), buffer_size=8 * 1024 * 1024)
+        if digests is not None:
+            data = HashingReader(data, digests)
+        self._transfer(
+            "Uploaded", path, self.s3_client.upload_fileobj, Fileobj=data, Bucket=bucket_name, Key=key
+        )
+
+    def write_stream(self, path: str, chunks, digests: Digests = None):
+        self.write(path, chunks, digests)
 
-    def copy_file(self, src: str, dst: str):
+    def copy_file(self, src: str, dst: str, digests: Digests = None):
+        if digests is not None:
+            # file is read once, sequentially, so digests are computed while parts are uploaded
+            with open(src, "rb") as f:
+                self.write(dst, f, digests)
+            return
         bucket_name, key = self._parse_url(dst)
-        obj = self.s3_resource.Object(bucket_name, key)
-        obj.upload_file(src)
+        self._transfer("Uploaded", dst, self.s3_client.upload_file, Filename=src, Bucket=bucket_name, Key=key)
+
+    def read(self, path: str) -> bytes:
+        bucket_name, key = self._parse_url(path)
+        return self.s3_client.get_object(Bucket=bucket_name, Key=key)["Body"].read()
+
+    def read_head(self, path: str, size: int) -> bytes:
+        bucket_name, key = self._parse_url(path)
+        return self.s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes=0-{size - 1}")["Body"].read()
+
+    def stat(self, path: str) -> dict:
+        bucket_name, key = self._parse_url(path)
+        response = self.s3_client.head_object(Bucket=bucket_name, Key=key)
+        return {"size": response["ContentLength"], "etag": response["ETag"]}
+
+    def exists(self, path: str) -> bool:
+        bucket_name, key = self._parse_url(path)
+        try:
+            self.s3_client.head_object(Bucket=bucket_name, Key=key)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def _get_range(self, bucket_name: str, key: str, start: int, end: int) -> bytes:
+        return self.s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end - 1}")["Body"].read()
+
+    def iter_chunks(self, path: str):
+        """Yield object content in order while fetching ranges of it in parallel."""
+        bucket_name, key = self._parse_url(path)
+        size = self.stat(path)["size"]
+        config = self.transfer_config
+        ranges = [(start, min(start + config.multipart_chunksize, size)) for start in range(0, size, config.multipart_chunksize)]
+        with ThreadPoolExecutor(max_workers=config.max_concurrency) as executor:
+            futures = deque()
+            for start, end in ranges:
+                futures.append(executor.submit(self._get_range, bucket_name, key, start, end))
+                if len(futures) >= config.max_concurrency:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def _list_prefix(self, bucket_name: str, prefix: str) -> list:
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        return [
+            f"s3://{bucket_name}/{item['Key']}"
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter="/")
+            for item in page.get("Contents", [])
+        ]
+
+    def list_files(self, path: str, prefixes: list) -> list:
+        """Return urls of objects under given url whose names start with any of given prefixes.
+
+        Every name prefix is paginated by its own concurrent request chain.
+        """
+        bucket_name, key = self._parse_url(path)
+        key = f"{key.rstrip('/')}/" if key else ""
+        with ThreadPoolExecutor(max_workers=max(1, len(prefixes))) as executor:
+            pages = executor.map(lambda prefix: self._list_prefix(bucket_name, f"{key}{prefix}"), prefixes)
+            return [url for urls in pages for url in urls]
+
+    def delete_files(self, paths: list) -> list:
+        """Delete objects by batches of 1000 keys and return (url, error) pairs of ones which cannot be deleted."""
+        errors = []
+        keys_by_bucket = {}
+        for path in paths:
+            bucket_name, key = self._parse_url(path)
+            keys_by_bucket.setdefault(bucket_name, []).append(key)
+        for bucket_name, keys in keys_by_bucket.items():
+            for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+                response = self.s3_client.delete_objects(Bucket=bucket_name, Delete={
+                    "Objects": [{"Key": key} for key in keys[start:start + S3_DELETE_BATCH_SIZE]], "Quiet": True
+                })
+                errors.extend(
+                    (f"s3://{bucket_name}/{error['Key']}", error.get("Message", error.get("Code")))
+                    for error in response.get("Errors", [])
+                )
+        return errors
 
     def place_file(self, src: str, dst: str):
         bucket_name, key = self._parse_url(src)
-        obj = self.s3_resource.Object(bucket_name, key)
-        obj.download_file(dst)
+        self._transfer("Downloaded", src, self.s3_client.download_file, Bucket=bucket_name, Key=key, Filename=dst)
 
     def get_file_path(self, path: str, filename: str) -> str:
         parsed = urlparse(path, allow_fragments=False)
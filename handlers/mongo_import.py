@@ -1,34 +1,104 @@
 import sys
 import requests
-import json
 import os
 from loguru import logger
 
-from config_handler import get_mongo_config
-from docker_service import create_archive, get_docker_container
-from exceptions import AppError
+from bson import json_util
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from config_handler import get_lucidum_dir
 from api_handler import MongoDBClient
+from exceptions import AppError
 
+DUPLICATE_KEY_ERROR = 11000
 
-class MongoImportJsonRunner:
-    container_dest_dir = "/bitnami/mongodb"
 
-    def __call__(self, source, destination, drop=False, override=False, upsert_fields='_id'):
-        container = get_docker_container("mongo")
-        container_filepath = f"{self.container_dest_dir}/{os.path.basename(source)}"
-        import_cmd = f"mongoimport --username={{mongo_user}} --password={{mongo_pwd}} --authenticationDatabase=test_database --host={{mongo_host}} --port={{mongo_port}} --db={{mongo_db}} --collection={destination} --file={container_filepath}"
-        if drop is True:
-            import_cmd += ' --drop'
-        elif override is True:
-            import_cmd += f' --mode=upsert --upsertFields={upsert_fields}'
+class MongoBulkImportRunner:
+    """Imports NDJSON file into collection with batched bulk writes instead of mongoimport.
+
+    File is streamed, so memory usage does not depend on its size. Modes match mongoimport
+    ones: drop and insert, upsert replacing documents matched by upsert fields, or insert.
+    """
+    source_dir = "{}/mongo/db"
+    batch_size = 1000
+
+    def __init__(self, db) -> None:
+        self.db = db
+
+    def get_source_path(self, source: str) -> str:
+        return os.path.join(self.source_dir.format(get_lucidum_dir()), source)
+
+    def iter_documents(self, source: str):
+        with open(self.get_source_path(source), 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json_util.loads(line)
+
+    def iter_batches(self, source: str):
+        batch = []
+        for document in self.iter_documents(source):
+            batch.append(document)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def get_sent_to_luci(self, source: str, destination: str, upsert_fields: list) -> dict:
+        """Return sent_to_luci of existing records by upsert key, looked up by batches of $in queries."""
+        collection = self.db[destination]
+        sent_to_luci = {}
+        for batch in self.iter_batches(source):
+            query = {field: {'$in': list({_hashable(d.get(field)): d.get(field) for d in batch}.values())}
+                     for field in upsert_fields}
+            projection = {field: True for field in upsert_fields + ['sent_to_luci']}
+            for existing in collection.find(query, projection):
+                if existing.get('sent_to_luci') is not None:
+                    sent_to_luci[_get_key(existing, upsert_fields)] = existing['sent_to_luci']
+        return sent_to_luci
+
+    @staticmethod
+    def _write(collection, requests_: list) -> int:
+        """Write batch and return number of records which failed to be written."""
         try:
-            result = container.exec_run(import_cmd.format(**get_mongo_config()))
-            if result.exit_code:
-                logger.error(result.output.decode('utf-8'))
-        finally:
-            rm_result = container.exec_run(f"rm {container_filepath}", user='root')
-            if rm_result.exit_code:
-                logger.warning(rm_result.output.decode('utf-8'))
+            collection.bulk_write(requests_, ordered=False)
+        except BulkWriteError as e:
+            # like mongoimport, records which already exist are skipped and import goes on
+            errors = [error for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY_ERROR]
+            for error in errors[:10]:
+                logger.error(f"{collection.name}: {error['errmsg']}")
+            return len(errors)
+        return 0
+
+    def __call__(self, source, destination, drop=False, override=False, upsert_fields='_id', sent_to_luci=None):
+        collection = self.db[destination]
+        upsert_fields = upsert_fields.split(',')
+        if drop is True:
+            collection.drop()
+        count, failed = 0, 0
+        for batch in self.iter_batches(source):
+            if sent_to_luci is not None:
+                for document in batch:
+                    document['sent_to_luci'] = sent_to_luci.get(_get_key(document, upsert_fields), True)
+            if drop is not True and override is True:
+                requests_ = [
+                    ReplaceOne({f: d.get(f) for f in upsert_fields}, d, upsert=True) for d in batch
+                ]
+            else:
+                requests_ = [InsertOne(d) for d in batch]
+            failed += self._write(collection, requests_)
+            count += len(batch)
+        logger.info(f"{destination}: {count - failed} records imported from {source}, {failed} failed")
+        return count - failed, failed
+
+
+def _hashable(value):
+    return json_util.dumps(value, sort_keys=True)
+
+
+def _get_key(document: dict, fields: list) -> str:
+    return _hashable([document.get(field) for field in fields])
 
 
 @logger.catch(onerror=lambda _: sys.exit(1))
@@ -36,37 +106,29 @@ def run(source, destination, drop=False, override=False, upsert_fields='_id', cl
     db_client = MongoDBClient()
     destination_lower = destination.lower()
     db = db_client.client[db_client._mongo_db]
+    import_runner = MongoBulkImportRunner(db)
+    sent_to_luci = None
     # Optional cleanup for smart_label or query_builder tables
     if cleanup is True and destination_lower in ['smart_label', 'query_builder']:
         target_table = db[destination]
-        field_display_table = db['field_display_local']
-        vosl_list = list(target_table.find({'created_by': 'lucidum_vosl'}))
         # For smart labels, also need to clean up the field display local table
         if destination_lower == 'smart_label':
-            for vosl in vosl_list:
-                field_display_table.delete_many({'field_name': vosl['field_name']})
-        # Handle override logic with sent_to_luci preservation
+            vosl_fields = target_table.distinct('field_name', {'created_by': 'lucidum_vosl'})
+            d = db['field_display_local'].delete_many({'field_name': {'$in': vosl_fields}})
+            logger.info(f"field_display_local: {d.deleted_count} value-oriented field displays deleted!")
+        # Handle override logic with sent_to_luci preservation, existing values are read before old records are deleted
         if destination_lower == 'query_builder':
-            # Load import data
-            source_path = f"/usr/lucidum/mongo/db/{source}"
-            with open(source_path, 'r', encoding='utf-8') as f:
-                import_data = [json.loads(s) for s in f.readlines() if s.strip()]
-            updated_lines = []
-            for item in import_data:
-                filter_criteria = {f: item.get(f) for f in upsert_fields.split(',')}
-                existing = target_table.find_one(filter_criteria)
-                item['sent_to_luci'] = existing.get(
-                    'sent_to_luci') if existing and existing.get('sent_to_luci') is not None else True
-                updated_lines.append(json.dumps(item, ensure_ascii=False) + '\n')
-            with open(source_path, 'w', encoding='utf-8') as f:
-                f.writelines(updated_lines)
-            logger.info(f"{destination}: {len(updated_lines)} records updated with sent_to_luci preservation")
+            sent_to_luci = import_runner.get_sent_to_luci(source, destination, upsert_fields.split(','))
+            logger.info(f"{destination}: {len(sent_to_luci)} existing sent_to_luci values preserved")
 
         d = target_table.delete_many({'created_by': 'lucidum_vosl'})
         logger.info(f"{destination}: {d.deleted_count} old value-oriented records deleted!")
 
-    import_runner = MongoImportJsonRunner()
-    import_runner(source, destination, drop=drop, override=override, upsert_fields=upsert_fields)
+    _, failed = import_runner(
+        source, destination, drop=drop, override=override, upsert_fields=upsert_fields, sent_to_luci=sent_to_luci
+    )
+    if failed:
+        raise AppError(f"{destination}: {failed} records failed to be imported from {source}")
 
     # populate luci fields
     # if destination.lower() == 'smart_label':
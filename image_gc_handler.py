@@ -0,0 +1,187 @@
+import fcntl
+import fnmatch
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+from docker.errors import APIError
+from loguru import logger
+from psutil._common import bytes2human
+from tabulate import tabulate
+
+from config_handler import get_docker_client, get_image_gc_config, get_state_dir
+from docker_service import ECR_REGISTRY_PATTERN, inspect_docker_images
+
+DEFAULT_COMPONENTS = ["connector-*", "python/ml", "mvp1_backend"]
+DEFAULT_KEEP = 2
+INSPECT_WORKERS = 8
+GC_LOCK_FILE = "image_gc.lock"
+
+
+def _get_component_name(repository: str) -> str:
+    if re.match(ECR_REGISTRY_PATTERN, repository):
+        return repository.split("/", 1)[1]
+    return repository
+
+
+def _split_tag(tag: str) -> tuple:
+    repository, _, version = tag.rpartition(":")
+    return repository, version
+
+
+def _get_referenced_images() -> set:
+    from install_handler import get_image_and_version
+    return set(get_image_and_version())
+
+
+class ImageGarbageCollector:
+    """Removes old component versions from docker keeping N most recent ones per component.
+
+    Versions referenced by docker-compose.yml, airflow settings.yml or by any container are
+    always kept. Reclaimable bytes are computed on layer level, so layers shared with kept
+    images are not counted.
+    """
+
+    def __init__(self, keep: int = None, components: list = None) -> None:
+        config = get_image_gc_config()
+        self.keep = keep if keep is not None else config.get("keep", DEFAULT_KEEP)
+        self.components = components or config.get("components") or DEFAULT_COMPONENTS
+        self._docker_client = get_docker_client()
+
+    def _is_component(self, name: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.components)
+
+    def get_tags_to_remove(self, images: list, used_image_ids: set) -> dict:
+        """Return mapping of image tags to remove to their image ids."""
+        referenced = _get_referenced_images()
+        versions = {}
+        for image in images:
+            for tag in image.get("RepoTags") or []:
+                repository, version = _split_tag(tag)
+                component = _get_component_name(repository)
+                if not self._is_component(component):
+                    continue
+                component_versions = versions.setdefault(component, {})
+                entry = component_versions.setdefault(version, {"created": image["Created"], "tags": {}})
+                entry["created"] = max(entry["created"], image["Created"])
+                entry["tags"][tag] = image["Id"]
+
+        tags_to_remove = {}
+        for component, component_versions in versions.items():
+            ordered = sorted(component_versions.items(), key=lambda v: (v[1]["created"], v[0]), reverse=True)
+            for version, entry in ordered[self.keep:]:
+                if f"{component}:{version}" in referenced:
+                    continue
+                if any(image_id in used_image_ids for image_id in entry["tags"].values()):
+                    continue
+                tags_to_remove.update(entry["tags"])
+        return tags_to_remove
+
+    def _get_layer_sizes(self, image_id: str, layers: list):
+        """Return mapping of image layers to their sizes or None if history does not align with layers."""
+        # history is newest first and contains metadata only steps which have zero size
+        sizes = [h["Size"] for h in reversed(self._docker_client.api.history(image_id)) if h["Size"]]
+        if len(sizes) != len(layers):
+            logger.warning("Cannot align history of '{}' image with its layers, its size is not counted", image_id)
+            return None
+        return dict(zip(layers, sizes))
+
+    def get_reclaimable_bytes(self, images: list, image_ids_to_remove: set) -> tuple:
+        """Return reclaimable bytes and ids of removed images whose layer sizes are unknown."""
+        layers = {
+            image_id: attrs["RootFS"].get("Layers", [])
+            for image_id, attrs in inspect_docker_images((image["Id"] for image in images), INSPECT_WORKERS).items()
+        }
+        with ThreadPoolExecutor(max_workers=INSPECT_WORKERS) as executor:
+            removed = [image_id for image_id in layers if image_id in image_ids_to_remove]
+            sizes, unmeasured = {}, []
+            for image_id, layer_sizes in zip(removed, executor.map(lambda i: self._get_layer_sizes(i, layers[i]), removed)):
+                if layer_sizes is None:
+                    unmeasured.append(image_id)
+                else:
+                    sizes.update(layer_sizes)
+        kept_layers = {
+            layer for image_id, image_layers in layers.items() if image_id not in image_ids_to_remove
+            for layer in image_layers
+        }
+        return sum(size for layer, size in sizes.items() if layer not in kept_layers), unmeasured
+
+    def __call__(self, dry_run: bool = False) -> dict:
+        started = time.monotonic()
+        images = self._docker_client.api.images()
+        used_image_ids = {c["ImageID"] for c in self._docker_client.api.containers(all=True)}
+        tags_to_remove = self.get_tags_to_remove(images, used_image_ids)
+        image_ids_to_remove = {
+            image["Id"] for image in images
+            if image["Id"] not in used_image_ids and all(
+                tag in tags_to_remove for tag in image.get("RepoTags") or [] if tag != "<none>:<none>"
+            )
+        }
+        reclaimable, unmeasured = self.get_reclaimable_bytes(images, image_ids_to_remove)
+        logger.info(
+            "Image garbage collection{}:\n{}", " (dry run)" if dry_run else "",
+            tabulate(sorted(tags_to_remove.items()), headers=["Image", "Id"], tablefmt="orgtbl")
+            if tags_to_remove else "nothing to remove"
+        )
+        removed, failed = [], []
+        if not dry_run:
+            for tag in sorted(tags_to_remove):
+                try:
+                    logger.info("Removing '{}' image...", tag)
+                    self._docker_client.api.remove_image(tag)
+                    removed.append(tag)
+                except APIError as e:
+                    logger.warning(e)
+                    failed.append(tag)
+            pruned = self._docker_client.images.prune(filters={"dangling": True})
+            logger.info("Pruned dangling images, reclaimed {}", bytes2human(pruned.get("SpaceReclaimed") or 0))
+        logger.info(
+            "Image garbage collection {} in {:.1f}s, {} {}{}", "planned" if dry_run else "finished",
+            time.monotonic() - started, "reclaimable" if dry_run else "reclaimed", "at least " if unmeasured else "",
+            bytes2human(reclaimable)
+        )
+        return {
+            "tags": sorted(tags_to_remove),
+            "removed": removed,
+            "failed": failed,
+            "reclaimable_bytes": reclaimable,
+            "reclaimable_estimated": bool(unmeasured),
+            "unmeasured_images": unmeasured,
+            "dry_run": dry_run,
+        }
+
+
+def run_image_gc(keep: int = None, dry_run: bool = False):
+    """Run image garbage collection unless it is already running in another process."""
+    with open(os.path.join(get_state_dir(), GC_LOCK_FILE), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            logger.info("Image garbage collection is already running")
+            return None
+        return ImageGarbageCollector(keep)(dry_run)
+
+
+def start_image_gc_job() -> None:
+    """Start background image garbage collection if 'interval_hours' is configured."""
+    interval_hours = get_image_gc_config().get("interval_hours")
+    if not interval_hours:
+        return
+
+    def _run():
+        while True:
+            time.sleep(interval_hours * 3600)
+            try:
+                run_image_gc()
+            except Exception as e:
+                logger.exception("Image garbage collection failed: {}", e)
+
+    threading.Thread(target=_run, name="image-gc", daemon=True).start()
+
+
+@logger.catch(onerror=lambda _: sys.exit(1))
+def run(keep: int = None, dry_run: bool = False):
+    run_image_gc(keep, dry_run)
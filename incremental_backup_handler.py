@@ -0,0 +1,589 @@
+import grp
+import gzip
+import hashlib
+import json
+import pwd
+import random
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from types import SimpleNamespace
+
+import fnmatch
+import io
+import os
+import numpy as np
+from botocore.exceptions import ClientError
+from loguru import logger
+from psutil._common import bytes2human
+
+from exceptions import AppError
+from file_handler import is_s3_url, get_s3_client, throttle, IterStream, S3_DELETE_BATCH_SIZE
+
+MANIFEST_VERSION = 1
+# chunks written recently are not collected, they may belong to snapshot which is being taken
+CHUNK_GC_GRACE_SECONDS = 24 * 3600
+CHUNKS_DIR = "chunks"
+SNAPSHOTS_DIR = "snapshots"
+SNAPSHOT_SUFFIX = ".json.gz"
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_AVG_SIZE = 64 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+GEAR_WINDOW = 32
+READ_SIZE = 4 * 1024 ** 2
+DEFAULT_WORKERS = 4
+
+_gear_random = random.Random(0x6c756369)
+GEAR = [_gear_random.getrandbits(32) for _ in range(256)]
+GEAR_ARRAY = np.array(GEAR, dtype=np.uint32)
+
+
+def _get_mask(bits: int) -> int:
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+# normalized chunking: harder condition before average size, easier one after it
+MASK_S = _get_mask(18)
+MASK_L = _get_mask(14)
+
+
+def get_window_hashes(data: bytes) -> np.ndarray:
+    """Return FastCDC gear hash at every position of data.
+
+    Byte added k steps earlier is shifted left by k bits, so hash depends on the last 32 bytes
+    only and it is summed by doubling windows instead of looping over bytes one by one.
+    """
+    hashes = GEAR_ARRAY[np.frombuffer(data, dtype=np.uint8)]
+    shift = 1
+    while shift < GEAR_WINDOW:
+        hashes[shift:] += hashes[:-shift] << np.uint32(shift)
+        shift *= 2
+    return hashes
+
+
+def find_chunk_end(data: bytes, hashes: np.ndarray, start: int, end: int) -> int:
+    """Return end of chunk starting at given position found with FastCDC gear hash."""
+    size = end - start
+    if size <= CHUNK_MIN_SIZE:
+        return end
+    normal = start + min(size, CHUNK_AVG_SIZE)
+    limit = start + min(size, CHUNK_MAX_SIZE)
+    # hash is reset at minimum chunk size, it differs from window hash until the window is filled
+    h = 0
+    i = min(start + CHUNK_MIN_SIZE + GEAR_WINDOW - 1, limit)
+    for j in range(start + CHUNK_MIN_SIZE, i):
+        h = ((h << 1) + GEAR[data[j]]) & 0xFFFFFFFF
+        if not h & (MASK_S if j < normal else MASK_L):
+            return j + 1
+    for mask, stop in ((MASK_S, normal), (MASK_L, limit)):
+        if i < stop:
+            matches = (hashes[i:stop] & np.uint32(mask)) == 0
+            first = int(matches.argmax())
+            if matches[first]:
+                return i + first + 1
+            i = stop
+    return limit
+
+
+def iter_file_chunks(f):
+    """Yield content-defined chunks of file."""
+    buffer = b""
+    eof = False
+    while not eof:
+        data = f.read(READ_SIZE)
+        eof = not data
+        buffer += data
+        hashes = get_window_hashes(buffer)
+        start = 0
+        # chunk is cut once maximum chunk size is buffered, the rest waits for next read
+        while start < len(buffer) and (eof or len(buffer) - start >= CHUNK_MAX_SIZE):
+            end = find_chunk_end(buffer, hashes, start, len(buffer))
+            yield buffer[start:end]
+            start = end
+        buffer = buffer[start:]
+
+
+class LocalChunkStore:
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._get_path(key))
+
+    def put(self, key: str, data: bytes) -> None:
+        throttle(len(data))
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> bytes:
+        with open(self._get_path(key), "rb") as f:
+            return f.read()
+
+    def list(self, prefix: str) -> list:
+        return list(self.get_mtimes(prefix))
+
+    def get_mtimes(self, prefix: str) -> dict:
+        """Return modification timestamps of every key under prefix."""
+        mtimes = {}
+        for directory, _, filenames in os.walk(self._get_path(prefix)):
+            reldir = os.path.relpath(directory, self.root)
+            for name in filenames:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    mtimes[f"{reldir}/{name}"] = os.path.getmtime(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        return mtimes
+
+    def delete(self, keys: list) -> list:
+        """Delete keys and return (key, error) pairs of ones which cannot be deleted."""
+        errors = []
+        for key in keys:
+            try:
+                os.remove(self._get_path(key))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                errors.append((key, str(e)))
+        return errors
+
+
+class S3ChunkStore:
+
+    def __init__(self, url: str) -> None:
+        parsed = url.split("://", 1)[1]
+        self.bucket, _, prefix = parsed.partition("/")
+        self.prefix = prefix.strip("/")
+        self._s3_client = get_s3_client()
+
+    def _get_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def exists(self, key: str) -> bool:
+        try:
+            self._s3_client.head_object(Bucket=self.bucket, Key=self._get_key(key))
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def put(self, key: str, data: bytes) -> None:
+        throttle(len(data))
+        self._s3_client.put_object(Bucket=self.bucket, Key=self._get_key(key), Body=data)
+
+    def get(self, key: str) -> bytes:
+        return self._s3_client.get_object(Bucket=self.bucket, Key=self._get_key(key))["Body"].read()
+
+    def list(self, prefix: str) -> list:
+        return list(self.get_mtimes(prefix))
+
+    def get_mtimes(self, prefix: str) -> dict:
+        """Return modification timestamps of every key under prefix."""
+        paginator = self._s3_client.get_paginator("list_objects_v2")
+        full_prefix = f"{self._get_key(prefix)}/"
+        mtimes = {}
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=full_prefix):
+            for obj in page.get("Contents", []):
+                mtimes[f"{prefix}/{obj['Key'][len(full_prefix):]}"] = obj["LastModified"].timestamp()
+        return mtimes
+
+    def delete(self, keys: list) -> list:
+        """Delete keys by batches of 1000 and return (key, error) pairs of ones which cannot be deleted."""
+        errors = []
+        for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            response = self._s3_client.delete_objects(Bucket=self.bucket, Delete={
+                "Objects": [{"Key": self._get_key(key)} for key in keys[start:start + S3_DELETE_BATCH_SIZE]],
+                "Quiet": True
+            })
+            errors.extend((error["Key"], error.get("Message", error.get("Code"))) for error in response.get("Errors", []))
+        return errors
+
+
+def get_chunk_store(root: str):
+    return S3ChunkStore(root) if is_s3_url(root) else LocalChunkStore(root)
+
+
+def split_snapshot_path(path: str) -> tuple:
+    """Split snapshot manifest path into chunk store root and manifest key."""
+    root, _, name = path.rstrip("/").rpartition(f"/{SNAPSHOTS_DIR}/")
+    if not root or not name:
+        raise AppError(f"'{path}' is not a snapshot manifest path of chunk store")
+    return root, f"{SNAPSHOTS_DIR}/{name}"
+
+
+def _get_chunk_key(digest: str) -> str:
+    return f"{CHUNKS_DIR}/{digest[:2]}/{digest}"
+
+
+def list_snapshots(store) -> list:
+    return sorted(key for key in store.list(SNAPSHOTS_DIR) if key.endswith(SNAPSHOT_SUFFIX))
+
+
+def load_manifest(store, key: str) -> dict:
+    manifest = json.loads(gzip.decompress(store.get(key)))
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise AppError(f"Unsupported snapshot manifest version: {manifest.get('version')}")
+    return manifest
+
+
+@lru_cache(maxsize=None)
+def _get_user_name(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@lru_cache(maxsize=None)
+def _get_group_name(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+def _get_entry(relpath: str, st, target: str = None):
+    """Return manifest entry of file with given lstat result or None if its type is not backed up."""
+    entry = {
+        "path": relpath, "mode": stat.S_IMODE(st.st_mode), "mtime_ns": st.st_mtime_ns, "uid": st.st_uid,
+        "gid": st.st_gid, "uname": _get_user_name(st.st_uid), "gname": _get_group_name(st.st_gid),
+    }
+    if stat.S_ISLNK(st.st_mode):
+        entry.update(type="symlink", target=target)
+    elif stat.S_ISDIR(st.st_mode):
+        entry.update(type="dir")
+    elif stat.S_ISREG(st.st_mode):
+        entry.update(type="file", size=st.st_size)
+    else:
+        return None
+    return entry
+
+
+class _PrivilegedFile:
+    """File read through 'sudo cat', failing on close if it could not be read."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._process = subprocess.Popen(["sudo", "cat", path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._process.stdout.read(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._process.stdout.close()
+        stderr = self._process.stderr.read()
+        self._process.stderr.close()
+        return_code = self._process.wait()
+        if return_code and exc_type is None:
+            raise AppError(f"Cannot read '{self.path}' file: {stderr.decode(errors='replace').strip()}")
+
+
+def _open_file(path: str):
+    try:
+        return open(path, "rb")
+    except PermissionError:
+        # lucidum directory contains files of containers users, they are read as root like tar did
+        return _PrivilegedFile(path)
+
+
+# type, mode, uid, gid, size, mtime, symlink target and path of every entry, NUL separated
+FIND_FORMAT = "%y\\0%m\\0%U\\0%G\\0%s\\0%T@\\0%l\\0%P\\0"
+FIND_FIELDS = 8
+FIND_TYPES = {"d": stat.S_IFDIR, "f": stat.S_IFREG, "l": stat.S_IFLNK}
+
+
+def _parse_mtime_ns(value: str) -> int:
+    seconds, _, fraction = value.partition(".")
+    return int(seconds) * 10 ** 9 + int(fraction[:9].ljust(9, "0"))
+
+
+def list_privileged_directory(directory: str) -> list:
+    """Return (relative path, lstat like result, symlink target) of everything under directory.
+
+    Directory is listed with 'sudo find', so directories of containers users which cannot be
+    read by current user are walked like 'sudo tar' did.
+    """
+    cp = subprocess.run(
+        ["sudo", "find", directory, "-mindepth", "1", "-printf", FIND_FORMAT],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if cp.returncode:
+        raise AppError(f"Cannot list '{directory}' directory: {cp.stderr.decode(errors='replace').strip()}")
+    fields = cp.stdout.split(b"\0")[:-1]
+    result = []
+    for i in range(0, len(fields), FIND_FIELDS):
+        type_, mode, uid, gid, size, mtime, target, relpath = (
+            field.decode(errors="surrogateescape") for field in fields[i:i + FIND_FIELDS]
+        )
+        if type_ not in FIND_TYPES:
+            continue
+        st = SimpleNamespace(
+            st_mode=FIND_TYPES[type_] | int(mode, 8), st_uid=int(uid), st_gid=int(gid), st_size=int(size),
+            st_mtime_ns=_parse_mtime_ns(mtime)
+        )
+        result.append((relpath, st, target if type_ == "l" else None))
+    return result
+
+
+class IncrementalBackup:
+    """Stores snapshot of directory in content-addressed chunk store.
+
+    Files are split into content-defined chunks which are stored once by their SHA-256 digest,
+    snapshot itself is a manifest listing entries and chunks of every file. Files whose size
+    and mtime match previous snapshot are not read again, their chunks are reused. Chunks are
+    deleted only by collect_garbage once no remaining snapshot refers to them.
+    """
+
+    def __init__(
+        self, store, source_dir: str, excludes: list = None, workers: int = DEFAULT_WORKERS, extra_files: dict = None
+    ) -> None:
+        self.store = store
+        self.source_dir = source_dir
+        self.excludes = excludes or []
+        # files from outside of source directory stored at given snapshot paths
+        self.extra_files = extra_files or {}
+        self.workers = workers
+        self._known_chunks = set()
+        self._lock = threading.Lock()
+        self._stats = {"read_bytes": 0, "stored_bytes": 0, "stored_chunks": 0, "reused_files": 0}
+
+    def _is_excluded(self, relpath: str) -> bool:
+        # like tar --exclude, pattern matches any trailing part of member path
+        parts = relpath.split("/")
+        return any(
+            fnmatch.fnmatch("/".join(parts[i:]), pattern) for i in range(len(parts)) for pattern in self.excludes
+        )
+
+    def _is_excluded_tree(self, relpath: str) -> bool:
+        parts = relpath.split("/")
+        return any(self._is_excluded("/".join(parts[:i])) for i in range(1, len(parts) + 1))
+
+    def get_latest_snapshot(self):
+        snapshots = list_snapshots(self.store)
+        return snapshots[-1] if snapshots else None
+
+    def _walk(self) -> list:
+        entries = []
+
+        def _on_error(error):
+            if isinstance(error, FileNotFoundError):
+                return
+            if not isinstance(error, PermissionError):
+                raise error
+            # directory and everything below it is listed at once, os.walk does not descend into it
+            reldir = os.path.relpath(error.filename, self.source_dir)
+            reldir = "" if reldir == "." else reldir
+            for relpath, st, target in list_privileged_directory(error.filename):
+                relpath = os.path.join(reldir, relpath)
+                if not self._is_excluded_tree(relpath):
+                    entry = _get_entry(relpath, st, target)
+                    if entry is not None:
+                        entries.append(entry)
+
+        for directory, dirnames, filenames in os.walk(self.source_dir, onerror=_on_error):
+            reldir = os.path.relpath(directory, self.source_dir)
+            reldir = "" if reldir == "." else reldir
+            dirnames[:] = [d for d in dirnames if not self._is_excluded(os.path.join(reldir, d))]
+            for name in sorted(dirnames) + sorted(filenames):
+                relpath = os.path.join(reldir, name)
+                if name in filenames and self._is_excluded(relpath):
+                    continue
+                filepath = os.path.join(directory, name)
+                try:
+                    st = os.lstat(filepath)
+                    target = os.readlink(filepath) if stat.S_ISLNK(st.st_mode) else None
+                except FileNotFoundError:
+                    logger.debug("'{}' was removed while walking directory", relpath)
+                    continue
+                entry = _get_entry(relpath, st, target)
+                if entry is not None:
+                    entries.append(entry)
+        for relpath, filepath in self.extra_files.items():
+            entries.append(_get_entry(relpath, os.stat(filepath)))
+        return entries
+
+    def _store_chunk(self, chunk: bytes) -> str:
+        digest = hashlib.sha256(chunk).hexdigest()
+        with self._lock:
+            known = digest in self._known_chunks
+            self._known_chunks.add(digest)
+        if not known:
+            key = _get_chunk_key(digest)
+            if not self.store.exists(key):
+                data = zlib.compress(chunk, 6)
+                self.store.put(key, data)
+                with self._lock:
+                    self._stats["stored_bytes"] += len(data)
+                    self._stats["stored_chunks"] += 1
+        return digest
+
+    def _backup_file(self, entry: dict) -> None:
+        try:
+            f = _open_file(self.extra_files.get(entry["path"]) or os.path.join(self.source_dir, entry["path"]))
+        except FileNotFoundError:
+            logger.debug("'{}' was removed before it was read", entry["path"])
+            entry["removed"] = True
+            return
+        with f:
+            chunks = []
+            size = 0
+            for chunk in iter_file_chunks(f):
+                chunks.append(self._store_chunk(chunk))
+                size += len(chunk)
+        if size != entry["size"]:
+            logger.warning("'{}' file size changed while reading it", entry["path"])
+        entry["chunks"] = chunks
+        entry["size"] = size
+        with self._lock:
+            self._stats["read_bytes"] += size
+
+    def __call__(self, snapshot_name: str) -> str:
+        started = time.monotonic()
+        previous_key = self.get_latest_snapshot()
+        previous = {}
+        if previous_key is not None:
+            logger.info("Using '{}' as previous snapshot", previous_key)
+            for entry in load_manifest(self.store, previous_key)["entries"]:
+                if entry["type"] == "file":
+                    previous[entry["path"]] = entry
+                    self._known_chunks.update(entry["chunks"])
+        entries = self._walk()
+        changed = []
+        for entry in entries:
+            if entry["type"] != "file":
+                continue
+            old = previous.get(entry["path"])
+            if old is not None and old["size"] == entry["size"] and old["mtime_ns"] == entry["mtime_ns"]:
+                entry["chunks"] = old["chunks"]
+                self._stats["reused_files"] += 1
+            else:
+                changed.append(entry)
+        logger.info(
+            "{} entries found, {} files changed since previous snapshot", len(entries), len(changed)
+        )
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self._backup_file, changed))
+        entries = [entry for entry in entries if not entry.get("removed")]
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "created_at": datetime.now().isoformat(),
+            "source_dir": self.source_dir,
+            "previous": previous_key,
+            "entries": entries,
+        }
+        key = f"{SNAPSHOTS_DIR}/{snapshot_name}{SNAPSHOT_SUFFIX}"
+        self.store.put(key, gzip.compress(json.dumps(manifest).encode()))
+        logger.info(
+            "Snapshot '{}' is stored in {:.1f}s: {} reused files, read {}, stored {} in {} new chunks",
+            key, time.monotonic() - started, self._stats["reused_files"], bytes2human(self._stats["read_bytes"]),
+            bytes2human(self._stats["stored_bytes"]), self._stats["stored_chunks"]
+        )
+        return key
+
+
+def collect_garbage(store, dry_run: bool = False, grace_seconds: int = CHUNK_GC_GRACE_SECONDS) -> dict:
+    """Delete chunks which no snapshot manifest of store refers to, return counts of them.
+
+    Every manifest is read before anything is deleted, so unreadable one fails collection
+    instead of losing its chunks. Chunks written within grace period are kept.
+    """
+    snapshots = list_snapshots(store)
+    if not snapshots:
+        # store without snapshots is rather wrong root than garbage
+        logger.warning("No snapshots found in chunk store, chunks are not collected")
+        return {"unreferenced": 0, "deleted": 0, "errors": 0}
+    referenced = set()
+    for key in snapshots:
+        for entry in load_manifest(store, key)["entries"]:
+            referenced.update(entry.get("chunks", ()))
+    deadline = time.time() - grace_seconds
+    unreferenced = sorted(
+        key for key, mtime in store.get_mtimes(CHUNKS_DIR).items()
+        if key.rsplit("/", 1)[-1] not in referenced and mtime <= deadline
+    )
+    logger.info(
+        "{} {} chunks no snapshot refers to", "Would delete" if dry_run else "Deleting", len(unreferenced)
+    )
+    errors = [] if dry_run or not unreferenced else store.delete(unreferenced)
+    for key, error in errors[:10]:
+        logger.error("Cannot delete chunk {}: {}", key, error)
+    return {
+        "unreferenced": len(unreferenced),
+        "deleted": 0 if dry_run else len(unreferenced) - len(errors),
+        "errors": len(errors),
+    }
+
+
+def _get_chunk(store, entry: dict, digest: str) -> bytes:
+    chunk = zlib.decompress(store.get(_get_chunk_key(digest)))
+    if hashlib.sha256(chunk).hexdigest() != digest:
+        raise AppError(f"Chunk '{digest}' of '{entry['path']}' file is corrupted")
+    return chunk
+
+
+def _iter_entry_data(store, entry: dict, executor, prefetch: int):
+    # fetch next chunks while current one is written, keeping at most 'prefetch' of them in memory
+    futures = deque()
+    for digest in entry["chunks"]:
+        futures.append(executor.submit(_get_chunk, store, entry, digest))
+        if len(futures) >= prefetch:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def write_snapshot_tar(store, manifest: dict, fileobj, workers: int = DEFAULT_WORKERS) -> None:
+    """Write snapshot entries as tar stream into given file object."""
+    with ThreadPoolExecutor(max_workers=workers) as executor, tarfile.open(fileobj=fileobj, mode="w|") as tar:
+        for entry in manifest["entries"]:
+            info = tarfile.TarInfo(entry["path"])
+            info.mode = entry["mode"]
+            info.mtime = entry["mtime_ns"] / 1e9
+            # snapshots taken before ownership was recorded are restored as root like before
+            info.uid, info.gid = entry.get("uid", 0), entry.get("gid", 0)
+            info.uname, info.gname = entry.get("uname", ""), entry.get("gname", "")
+            if entry["type"] == "dir":
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif entry["type"] == "symlink":
+                info.type = tarfile.SYMTYPE
+                info.linkname = entry["target"]
+                tar.addfile(info)
+            else:
+                info.size = entry["size"]
+                tar.addfile(info, io.BufferedReader(IterStream(_iter_entry_data(store, entry, executor, workers * 2))))
+
+
+def restore_snapshot(store, key: str, target_dir: str, workers: int = DEFAULT_WORKERS) -> None:
+    """Restore snapshot into target directory through 'sudo tar' so ownership rules match tarball restore."""
+    started = time.monotonic()
+    manifest = load_manifest(store, key)
+    process = subprocess.Popen(["sudo", "tar", "-xf", "-", f"--directory={target_dir}"], stdin=subprocess.PIPE)
+    try:
+        write_snapshot_tar(store, manifest, process.stdin, workers)
+    finally:
+        process.stdin.close()
+        return_code = process.wait()
+    if return_code:
+        raise AppError(f"Extracting '{key}' snapshot failed with {return_code} code")
+    logger.info("Snapshot '{}' is restored into '{}' in {:.1f}s", key, target_dir, time.monotonic() - started)
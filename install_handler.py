@@ -5,20 +5,28 @@ import re
 import shutil
 import subprocess
 import sys
+import tarfile
+import threading
+import time
 from datetime import datetime
 
 import yaml
 from docker.errors import APIError
 from jinja2 import Environment, FileSystemLoader
 from loguru import logger
+from psutil._common import bytes2human
 from tabulate import tabulate
 
 from config_handler import get_archive_config, get_lucidum_dir, get_jinja_templates_dir, \
-    get_docker_compose_tmplt_file, get_ecr_images, get_images_from_ecr, get_local_images, \
+    get_docker_compose_tmplt_file, get_ecr_images, get_images_from_ecr, get_local_images, get_local_image, \
     get_docker_compose_service_image_mapping_config, get_airflow_service_image_mapping_config
-from docker_service import load_docker_images, pull_docker_image, copy_files_from_docker_container, \
-    remove_docker_image, list_docker_images, get_docker_image, stop_docker_compose_service
+from executor_service import ContextThreadPoolExecutor
+from docker_service import load_docker_images, load_docker_images_from_stream, pull_docker_image, \
+    copy_files_from_docker_images, \
+    remove_docker_image, get_docker_image, stop_docker_compose_service
+from docker_index_service import get_docker_index
 from exceptions import AppError
+from preflight_handler import check_install_plan, record_pull_throughput
 
 _jinja_env = Environment(loader=FileSystemLoader(get_jinja_templates_dir()), autoescape=True)
 
@@ -101,38 +109,139 @@ def format_template(formatter: BaseTemplateFormatter) -> None:
     template.stream(**formatter.template_params).dump(formatter.output_file)
 
 
-def unpack_archive(archive_filepath: str) -> str:
-    """Unpack archive from given file path."""
+def _check_archive(archive_filepath: str):
     if not os.path.isfile(archive_filepath):
         raise AppError(f"File '{archive_filepath}' does not exist")
     match = re.match(r"(.+)\.(tar|tar.gz)$", archive_filepath, re.I)
     if not match:
         raise AppError(f"Unsupported archive file format: {archive_filepath}")
-    extract_dir = match.group(1)
+    return match
+
+
+def unpack_archive(archive_filepath: str) -> str:
+    """Unpack archive from given file path."""
+    extract_dir = _check_archive(archive_filepath).group(1)
     logger.info("Unpacking '{}' to '{}' directory...", archive_filepath, extract_dir)
     shutil.unpack_archive(archive_filepath, extract_dir=extract_dir)
     return extract_dir
 
 
+class DockerImagesLoader:
+    """Loads docker images tarballs concurrently with bounded worker count, largest first.
+
+    The largest tarball is loaded alone to measure serial throughput of docker daemon. If
+    concurrent loads turn out not to be faster, daemon is the bottleneck and remaining
+    tarballs are loaded one at a time.
+    """
+    min_speedup = 1.2
+
+    def __init__(self, workers: int) -> None:
+        self._workers = max(workers, 1)
+        self._limit = 1
+        self._active = 0
+        self._condition = threading.Condition()
+        self._serial_throughput = None
+        self._parallel_started = None
+        self._parallel_bytes = 0
+        self._parallel_loaded = 0
+
+    def _update_limit(self, size: int, elapsed: float) -> None:
+        if self._serial_throughput is None:
+            self._serial_throughput = size / max(elapsed, 0.001)
+            self._limit = self._workers
+            self._parallel_started = time.monotonic()
+            return
+        if self._limit == 1 or self._parallel_loaded >= self._workers:
+            return
+        self._parallel_bytes += size
+        self._parallel_loaded += 1
+        if self._parallel_loaded < self._workers:
+            return
+        throughput = self._parallel_bytes / max(time.monotonic() - self._parallel_started, 0.001)
+        logger.info(
+            "Docker images load throughput: serial {}/s, concurrent {}/s",
+            bytes2human(self._serial_throughput), bytes2human(throughput)
+        )
+        if throughput < self._serial_throughput * self.min_speedup:
+            logger.warning("Docker daemon is the bottleneck, falling back to serial docker images loading")
+            self._limit = 1
+
+    def _load(self, filepath: str, size: int) -> None:
+        with self._condition:
+            self._condition.wait_for(lambda: self._active < self._limit)
+            self._active += 1
+        logger.info("Loading docker images from '{}' file...", filepath)
+        started = time.monotonic()
+        try:
+            images = load_docker_images(filepath)
+        finally:
+            elapsed = time.monotonic() - started
+            with self._condition:
+                self._active -= 1
+                self._update_limit(size, elapsed)
+                self._condition.notify_all()
+        logger.info(
+            "Loaded docker images from '{}' file in {:.1f}s ({}/s): {}", filepath, elapsed,
+            bytes2human(size / max(elapsed, 0.001)), ", ".join(i.tags[0] for i in images)
+        )
+
+    def __call__(self, filepaths: list) -> None:
+        files = sorted(((f, os.path.getsize(f)) for f in filepaths), key=lambda f: f[1], reverse=True)
+        if not files:
+            return
+        # largest tarball is loaded before the pool starts, so nothing runs alongside it
+        self._load(*files[0])
+        with ContextThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = [executor.submit(self._load, filepath, size) for filepath, size in files[1:]]
+        for future in futures:
+            future.result()
+
+
 def load_docker_images_from_file(release_dir: str) -> None:
     """Find archive based on file pattern and load docker images from it."""
-    docker_images_dir = os.path.join(release_dir, get_archive_config()["docker_images_dir"])
-    for filename in os.listdir(docker_images_dir):
-        if not fnmatch.fnmatch(filename, "*.tar"):
-            continue
-        f_name = os.path.join(docker_images_dir, filename)
-        logger.info("Loading docker images from '{}' file...", f_name)
-        images = load_docker_images(f_name)
-        logger.info("Loaded docker images from '{}' file: {}", f_name, ", ".join(i.tags[0] for i in images))
+    archive_config = get_archive_config()
+    docker_images_dir = os.path.join(release_dir, archive_config["docker_images_dir"])
+    filepaths = [
+        os.path.join(docker_images_dir, filename) for filename in os.listdir(docker_images_dir)
+        if fnmatch.fnmatch(filename, "*.tar")
+    ]
+    workers = archive_config.get("load_workers") or min(4, os.cpu_count() or 1)
+    DockerImagesLoader(workers)(filepaths)
+
+
+def load_release_archive(archive_filepath: str) -> dict:
+    """Load docker images from archive member by member without unpacking it and return release metadata."""
+    _check_archive(archive_filepath)
+    archive_config = get_archive_config()
+    docker_images_dir = os.path.normpath(archive_config["docker_images_dir"])
+    release_file = os.path.normpath(archive_config["release_file"])
+    release_data = None
+    logger.info("Streaming '{}' archive...", archive_filepath)
+    with tarfile.open(archive_filepath, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = os.path.normpath(member.name)
+            if os.path.dirname(name) == docker_images_dir and fnmatch.fnmatch(name, "*.tar"):
+                logger.info("Loading docker images from '{}' archive member...", name)
+                images = load_docker_images_from_stream(tar.extractfile(member))
+                logger.info(
+                    "Loaded docker images from '{}' archive member: {}", name, ", ".join(i.tags[0] for i in images)
+                )
+            elif name == release_file:
+                release_data = json.load(tar.extractfile(member))
+    if release_data is None:
+        raise AppError(f"Release metadata file '{release_file}' does not exist")
+    return release_data
 
 
 def check_release_versions_exist(release_images: list) -> None:
     """Check if given release images exist within docker."""
-    docker_images = [tag for image in list_docker_images() for tag in image.tags]
+    docker_index = get_docker_index(sync=True)
     missed_docker_images = []
     for image in release_images:
         docker_image = f"{image['name']}:{image['version']}"
-        if docker_image not in docker_images:
+        if not docker_index.has_image(docker_image):
             missed_docker_images.append(docker_image)
 
     if missed_docker_images:
@@ -179,11 +288,13 @@ def create_hard_link(src, dst):
 
 class DockerImagesUpdater:
 
-    def __init__(self, ecr_images, copy_default, restart) -> None:
+    def __init__(self, ecr_images, copy_default, restart, download_bytes=None) -> None:
         self._ecr_images = ecr_images
         self._copy_default = copy_default
         self._restart = restart
         self._images_to_remove = []
+        self._files_to_copy = []
+        self._download_bytes = download_bytes or {}
 
     def _update_image(self, image_data):
         image_tag = f"{image_data['name']}:{image_data['version']}"
@@ -192,7 +303,11 @@ class DockerImagesUpdater:
         except:
             logger.info(f'{image_tag} local image does not exist!')
             old_image = None
+        started = time.monotonic()
         image = pull_docker_image(image_data["image"])
+        elapsed = time.monotonic() - started
+        if self._download_bytes.get(image_data["image"]) and elapsed >= 1:
+            record_pull_throughput(self._download_bytes[image_data["image"]], elapsed)
         logger.info(f"Updated to latest image, id: {image.short_id} tag: {image.tags}")
         if old_image and image.short_id != old_image.short_id:
             self._images_to_remove.append(old_image.short_id)
@@ -201,7 +316,7 @@ class DockerImagesUpdater:
         self._images_to_remove.append(image_data["image"])
         host_path, docker_path = image_data.get("hostPath"), image_data.get("dockerPath")
         if self._copy_default and docker_path and host_path:
-            copy_files_from_docker_container(image, docker_path, host_path)
+            self._files_to_copy.append((image, docker_path, host_path))
 
     def restart(self) -> None:
         components = [component["name"] for component in self._ecr_images]
@@ -212,6 +327,8 @@ class DockerImagesUpdater:
     def __call__(self):
         for ecr_image in self._ecr_images:
             self._update_image(ecr_image)
+        if self._files_to_copy:
+            copy_files_from_docker_images(self._files_to_copy)
         self.restart()
         for image in self._images_to_remove:
             try:
@@ -283,8 +400,8 @@ def update_airflow_settings_file(components: list) -> None:
 
 class DockerImagesUpdaterWithNewRestart(DockerImagesUpdater):
 
-    def __init__(self, ecr_images, copy_default, restart, update_files=False) -> None:
-        super().__init__(ecr_images, copy_default, restart)
+    def __init__(self, ecr_images, copy_default, restart, update_files=False, download_bytes=None) -> None:
+        super().__init__(ecr_images, copy_default, restart, download_bytes)
         self.update_files = update_files
 
     def restart(self) -> None:
@@ -317,9 +434,25 @@ class DockerImagesUpdaterWithNewRestart(DockerImagesUpdater):
             run_docker_compose()
 
 
+def _install_release(release_data: dict) -> None:
+    format_docker_compose(release_data["images"])
+    run_docker_compose()
+
+
 @logger.catch(onerror=lambda _: sys.exit(1))
-def install(archive_filepath: str) -> None:
-    """Unpack archive, load docker images, format docker-compose.yml file and run docker compose."""
+def install(archive_filepath: str, stream: bool = False) -> None:
+    """Unpack archive, load docker images, format docker-compose.yml file and run docker compose.
+
+    With stream enabled docker images are piped to docker straight from archive, so it is read
+    once and nothing but docker images is written to disk.
+    """
+    if stream:
+        try:
+            _install_release(load_release_archive(archive_filepath))
+        except AppError as e:
+            logger.exception(e)
+            sys.exit(1)
+        return
     release_dir = unpack_archive(archive_filepath)
     try:
         load_docker_images_from_file(release_dir)
@@ -328,8 +461,7 @@ def install(archive_filepath: str) -> None:
             raise AppError(f"Release metadata file '{release_file}' does not exist")
         with open(release_file) as f:
             data = json.load(f)
-        format_docker_compose(data["images"])
-        run_docker_compose()
+        _install_release(data)
     except AppError as e:
         logger.exception(e)
         sys.exit(1)
@@ -352,24 +484,23 @@ def get_components(filter_=None, get_images=get_ecr_images):
 
 @logger.catch(onerror=lambda _: sys.exit(1))
 def install_ecr(components, copy_default, restart, get_images=get_ecr_images):
-    ecr_images = get_images()
-    update_docker_images = DockerImagesUpdater(
-        [image for image in ecr_images if f"{image['name']}:{image['version']}" in components], copy_default, restart
-    )
+    ecr_images = [image for image in get_images() if f"{image['name']}:{image['version']}" in components]
+    download_bytes = check_install_plan(ecr_images)
+    update_docker_images = DockerImagesUpdater(ecr_images, copy_default, restart, download_bytes)
     update_docker_images()
 
 @logger.catch(onerror=lambda _: sys.exit(1))
 def install_image_from_ecr(images, copy_default, restart, update_files=False):
-    update_docker_images = DockerImagesUpdaterWithNewRestart(images, copy_default, restart, update_files)
+    download_bytes = check_install_plan(images)
+    update_docker_images = DockerImagesUpdaterWithNewRestart(images, copy_default, restart, update_files, download_bytes)
     update_docker_images()
 
 @logger.catch(onerror=lambda _: sys.exit(1))
 def remove_components(components):
     lucidum_dir = get_lucidum_dir()
-    images = get_local_images()
-    for image in images:
-        component = f"{image['name']}:{image['version']}"
-        if component not in components:
+    for component in components:
+        image = get_local_image(component)
+        if image is None:
             continue
         host_path = image.get("hostPath")
         if host_path and os.path.exists(host_path) and os.path.isdir(host_path):
@@ -382,9 +513,7 @@ def remove_components(components):
             rm_path = os.path.join(lucidum_dir, rel_path.split("/")[0])
             logger.info("Removing '{}' directory...", rm_path)
             shutil.rmtree(rm_path)
-        result = list_docker_images(name=component)
-        if result:
-            remove_docker_image(component, force=True)
+        remove_docker_image(component, force=True)
 
 
 def get_ecr_to_local_components_conjunction() -> list:
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import os
+import psutil
+from loguru import logger
+
+from config_handler import get_state_dir, get_jobs_config
+
+JOBS_DB_FILE = "jobs.db"
+JOBS_LOGS_DIR = "jobs"
+PULL_POOL = "pull"
+CONTAINER_POOL = "container"
+DEFAULT_POOL_WORKERS = {PULL_POOL: 1, CONTAINER_POOL: 2}
+LOG_POLL_INTERVAL = 0.5
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+ACTIVE_STATUSES = (PENDING, RUNNING)
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+
+def _get_params_hash(kind: str, params: dict) -> str:
+    return hashlib.sha256(json.dumps([kind, params], sort_keys=True, default=str).encode()).hexdigest()
+
+
+class JobManager:
+    """Runs long operations in background and keeps their state, logs and results.
+
+    Jobs are stored in sqlite database within state directory, so any API worker can report
+    them. Every job runs on a bounded pool of its kind (image pulls or container runs) and
+    an identical job which is still pending or running is reused instead of submitting a new one.
+    """
+
+    def __init__(self) -> None:
+        config = get_jobs_config()
+        state_dir = get_state_dir()
+        self.db_filepath = os.path.join(state_dir, JOBS_DB_FILE)
+        self.logs_dir = os.path.join(state_dir, JOBS_LOGS_DIR)
+        os.makedirs(self.logs_dir, exist_ok=True)
+        self._pools = {
+            pool: ThreadPoolExecutor(max_workers=config.get(f"{pool}_workers", workers), thread_name_prefix=f"job-{pool}")
+            for pool, workers in DEFAULT_POOL_WORKERS.items()
+        }
+        self._create_table()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_filepath, timeout=30, isolation_level=None)
+
+    def _create_table(self) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, params_hash TEXT NOT NULL, "
+                "status TEXT NOT NULL, pid INTEGER, created_at REAL NOT NULL, started_at REAL, finished_at REAL, "
+                "result TEXT, error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_params_hash ON jobs (params_hash, status)")
+
+    def _update(self, job_id: str, **fields) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute(
+                f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                list(fields.values()) + [job_id]
+            )
+
+    def get_log_filepath(self, job_id: str) -> str:
+        return os.path.join(self.logs_dir, f"{job_id}.log")
+
+    def get_job(self, job_id: str):
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        del job["params_hash"]
+        return job
+
+    def submit(self, kind: str, params: dict, pool: str, func, *args, **kwargs) -> str:
+        """Submit job running func(*args, **kwargs) and return its id.
+
+        Id of pending or running job of the same kind and params is returned if there is one.
+        """
+        params_hash = _get_params_hash(kind, params)
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE params_hash = ? AND status IN (?, ?)", (params_hash,) + ACTIVE_STATUSES
+                ).fetchone()
+                if row is not None:
+                    conn.execute("COMMIT")
+                    logger.info("Job '{}' with the same parameters is already submitted", row[0])
+                    return row[0]
+                job_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO jobs (id, kind, params, params_hash, status, pid, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, kind, json.dumps(params, default=str), params_hash, PENDING, os.getpid(), time.time())
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        logger.info("Submitted '{}' job '{}'", kind, job_id)
+        self._pools[pool].submit(self._run, job_id, func, args, kwargs)
+        return job_id
+
+    def _run(self, job_id: str, func, args: tuple, kwargs: dict) -> None:
+        sink_id = logger.add(
+            self.get_log_filepath(job_id), filter=lambda record: record["extra"].get("job_id") == job_id
+        )
+        try:
+            with logger.contextualize(job_id=job_id):
+                self._update(job_id, status=RUNNING, started_at=time.time())
+                try:
+                    result = func(*args, **kwargs)
+                except (Exception, SystemExit) as e:
+                    logger.exception("Job '{}' failed: {}", job_id, e)
+                    self._update(job_id, status=FAILED, error=str(e) or repr(e), finished_at=time.time())
+                else:
+                    logger.info("Job '{}' succeeded", job_id)
+                    self._update(
+                        job_id, status=SUCCEEDED, result=json.dumps(result, default=str), finished_at=time.time()
+                    )
+        finally:
+            logger.remove(sink_id)
+
+    def fail_interrupted_jobs(self) -> None:
+        """Mark jobs of processes which are not running anymore as failed."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, pid FROM jobs WHERE status IN (?, ?)", ACTIVE_STATUSES
+            ).fetchall()
+        for job_id, pid in rows:
+            if pid is None or not psutil.pid_exists(pid):
+                logger.warning("Job '{}' was interrupted", job_id)
+                self._update(job_id, status=FAILED, error="Job was interrupted", finished_at=time.time())
+
+    def follow_logs(self, job_id: str, follow: bool = True):
+        """Yield job log chunks, waiting for new ones until job is finished if follow is set."""
+        filepath = self.get_log_filepath(job_id)
+        position = 0
+        while True:
+            finished = self.get_job(job_id)["status"] not in ACTIVE_STATUSES
+            if os.path.isfile(filepath):
+                with open(filepath, "rb") as f:
+                    f.seek(position)
+                    for chunk in iter(lambda: f.read(64 * 1024), b""):
+                        position += len(chunk)
+                        yield chunk
+            if finished or not follow:
+                return
+            time.sleep(LOG_POLL_INTERVAL)
+
+
+def get_job_manager() -> JobManager:
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager()
+    return _job_manager
@@ -0,0 +1,367 @@
+import io
+import json
+import re
+import subprocess
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import os
+import shutil
+from bson import ObjectId, decode_file_iter
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from bson.timestamp import Timestamp
+from loguru import logger
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from backup_handler import BaseBackupRunner, MongoBackupRunner, BACKUP_DATE_FORMAT
+from config_handler import get_mongo_config, get_mongo_incremental_config, get_backup_dir, get_lucidum_dir
+from docker_service import create_archive, get_docker_container
+from exceptions import AppError
+from file_handler import gzip_chunks, IterStream, LocalFileHandler
+from restore_handler import BaseRestoreRunner, MongoRestoreRunner, log_wrap
+
+CHAIN_FILE = "chain.json"
+OPLOG_MODE = "oplog"
+DELTA_MODE = "delta"
+DEFAULT_BASE_INTERVAL_HOURS = 24
+DEFAULT_DELTA_COLLECTIONS = {"metrics": "_utc", "action_job": "_id"}
+INSERT_BATCH_SIZE = 1000
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+def get_mongo_database():
+    from connector_handler import MongoDBClient
+    mongo_config = get_mongo_config()
+    client = MongoDBClient(**mongo_config).client
+    return client, client[mongo_config["mongo_db"]]
+
+
+def is_replica_set(client) -> bool:
+    return "setName" in client.admin.command("hello")
+
+
+def _gunzip_chunks(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def _iter_segment_docs(file_handler, path: str):
+    """Yield raw BSON documents of gzip compressed segment as it is read."""
+    stream = io.BufferedReader(IterStream(_gunzip_chunks(file_handler.iter_chunks(path))))
+    yield from decode_file_iter(stream, RAW_CODEC_OPTIONS)
+
+
+def _get_document_time(doc, field: str) -> datetime:
+    """Return local time of document by its datetime, oplog timestamp or ObjectId field."""
+    value = doc[field]
+    if isinstance(value, Timestamp):
+        value = value.as_datetime()
+    elif isinstance(value, ObjectId):
+        value = value.generation_time
+    elif value.tzinfo is None:
+        # mongo keeps datetimes in UTC
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone().replace(tzinfo=None)
+
+
+def get_oplog_query(db_name: str, start: list) -> dict:
+    """Return query of oplog entries of given database newer than given [time, inc] position."""
+    return {"ts": {"$gt": Timestamp(*start)}, "ns": {"$regex": f"^{re.escape(db_name)}\\."}}
+
+
+class MongoChain:
+    """Index of base dumps and incremental segments stored in chain.json within chain root."""
+
+    def __init__(self, file_handler, root: str) -> None:
+        self.file_handler = file_handler
+        self.root = root
+        self.filepath = f"{root}/{CHAIN_FILE}"
+        # only missing chain is started from scratch, saving empty one over unreadable file would lose all bases
+        if self.file_handler.exists(self.filepath):
+            self.data = json.loads(self.file_handler.read(self.filepath))
+        else:
+            self.data = {"bases": []}
+
+    @property
+    def bases(self) -> list:
+        return self.data["bases"]
+
+    @property
+    def last_base(self):
+        return self.bases[-1] if self.bases else None
+
+    def save(self) -> None:
+        self.file_handler.write(self.filepath, json.dumps(self.data, indent=2).encode())
+
+    def get_base(self, point_in_time: datetime = None):
+        bases = [
+            base for base in self.bases
+            if point_in_time is None or datetime.fromisoformat(base["created_at"]) <= point_in_time
+        ]
+        if not bases:
+            raise AppError(f"No mongo base dump in '{self.root}' is older than {point_in_time}")
+        return bases[-1]
+
+
+class MongoIncrementalBackupRunner(BaseBackupRunner):
+    """Continuous mongo backup made of periodic base dumps and segments of changes since then.
+
+    Replica set members are backed up by oplog segments, so they can be restored to any point
+    in time. Standalone deployments fall back to delta exports of append-mostly collections
+    whose documents are newer than watermark of '_utc' or '_id' field. Base dump is taken when
+    there is none, when it is older than 'base_interval_hours' or when oplog was rolled over.
+    """
+    store_dirname = "mongo_incremental"
+
+    def __init__(self, name: str, file_handler, backup_dir: str = None, path: str = None) -> None:
+        super().__init__(name, file_handler, backup_dir, path, manifest=False)
+        config = get_mongo_incremental_config()
+        self.base_interval = timedelta(hours=config.get("base_interval_hours", DEFAULT_BASE_INTERVAL_HOURS))
+        self.delta_collections = config.get("delta_collections", DEFAULT_DELTA_COLLECTIONS)
+
+    @property
+    def root(self) -> str:
+        return (self._path or os.path.join(self.backup_dir, self.store_dirname)).rstrip("/")
+
+    @property
+    def backup_file(self):
+        return f"{self.root}/{CHAIN_FILE}"
+
+    def _get_segment_path(self, name: str) -> str:
+        return f"{self.root}/{name}_{self.datetime_now.strftime(BACKUP_DATE_FORMAT)}.bson.gz"
+
+    @staticmethod
+    def _get_last_oplog_ts(client, sort: int = -1) -> list:
+        try:
+            entry = client.local["oplog.rs"].find_one({}, sort=[("$natural", sort)], projection={"ts": True})
+        except OperationFailure as e:
+            raise AppError(f"Cannot read oplog, mongo user needs read access to 'local' database: {e}")
+        return [entry["ts"].time, entry["ts"].inc] if entry else [0, 0]
+
+    def _get_watermarks(self, db) -> dict:
+        watermarks = {}
+        for collection, field in self.delta_collections.items():
+            doc = db[collection].find_one({field: {"$exists": True}}, sort=[(field, -1)], projection={field: True})
+            watermarks[collection] = {"field": field, "value": json.loads(json.dumps(doc[field], default=str)) if doc else None}
+        return watermarks
+
+    def _can_extend(self, chain: MongoChain, client, mode: str) -> bool:
+        """Return True if segment of changes since last one can be appended to the last base."""
+        base = chain.last_base
+        if base is None or base["mode"] != mode:
+            return False
+        if mode == OPLOG_MODE and self._get_last_oplog_ts(client, sort=1) > chain.data["oplog_ts"]:
+            logger.warning("Oplog was rolled over since last segment, taking new base dump")
+            return False
+        return True
+
+    def _is_base_expired(self, chain: MongoChain) -> bool:
+        return datetime.now() - datetime.fromisoformat(chain.last_base["created_at"]) >= self.base_interval
+
+    def _take_base(self, chain: MongoChain, client, db, mode: str) -> None:
+        # position is taken before dump starts, replaying from it is idempotent
+        base = {"mode": mode, "created_at": self.datetime_now.isoformat(), "segments": []}
+        if mode == OPLOG_MODE:
+            chain.data["oplog_ts"] = base["oplog_ts"] = self._get_last_oplog_ts(client)
+        else:
+            chain.data["watermarks"] = base["watermarks"] = self._get_watermarks(db)
+        runner = MongoBackupRunner("mongo", self.file_handler, backup_dir=self.backup_dir, path=f"{self.root}/")
+        runner.backup_filename_format = "mongo_base_{date}.gz"
+        runner.datetime_now = self.datetime_now
+        runner.progress = self.progress
+        base["file"] = runner()
+        chain.bases.append(base)
+
+    def _write_segment(self, path: str, docs) -> dict:
+        stats = {"documents": 0, "last": None}
+
+        def _iter_raw():
+            for doc in docs:
+                stats["documents"] += 1
+                stats["last"] = doc
+                yield doc.raw
+
+        self.file_handler.write_stream(path, self.track(gzip_chunks(_iter_raw()), "written"))
+        return stats
+
+    def _take_oplog_segment(self, chain: MongoChain, client, db) -> None:
+        start = chain.data["oplog_ts"]
+        oplog = client.local.get_collection("oplog.rs", codec_options=RAW_CODEC_OPTIONS)
+        query = get_oplog_query(db.name, start)
+        path = self._get_segment_path("mongo_oplog")
+        stats = self._write_segment(path, oplog.find(query, sort=[("$natural", 1)]))
+        if not stats["documents"]:
+            self.file_handler.delete_files([path])
+            logger.info("No oplog entries since {}, segment is not written", start)
+            return
+        end = [stats["last"]["ts"].time, stats["last"]["ts"].inc]
+        chain.last_base["segments"].append({
+            "file": path, "created_at": self.datetime_now.isoformat(), "start_ts": start, "end_ts": end,
+            "documents": stats["documents"],
+        })
+        chain.data["oplog_ts"] = end
+        logger.info("Oplog segment of {} entries is saved to {}", stats["documents"], path)
+
+    def _take_delta_segments(self, chain: MongoChain, db) -> None:
+        for collection, watermark in chain.data["watermarks"].items():
+            field, value = watermark["field"], watermark["value"]
+            if field == "_id" and value is not None:
+                value = ObjectId(value)
+            elif value is not None:
+                value = datetime.fromisoformat(value)
+            query = {field: {"$gt": value}} if value is not None else {field: {"$exists": True}}
+            path = self._get_segment_path(f"mongo_delta_{collection}")
+            raw_collection = db.get_collection(collection, codec_options=RAW_CODEC_OPTIONS)
+            stats = self._write_segment(path, raw_collection.find(query, sort=[(field, 1)]))
+            if not stats["documents"]:
+                self.file_handler.delete_files([path])
+                continue
+            watermark["value"] = json.loads(json.dumps(stats["last"][field], default=str))
+            chain.last_base["segments"].append({
+                "file": path, "created_at": self.datetime_now.isoformat(), "collection": collection,
+                "field": field, "documents": stats["documents"],
+            })
+            logger.info("Delta of '{}' collection ({} documents) is saved to {}", collection, stats["documents"], path)
+
+    def _take_segments(self, chain: MongoChain, client, db, mode: str) -> None:
+        if mode == OPLOG_MODE:
+            with self.stage("oplog"):
+                self._take_oplog_segment(chain, client, db)
+        else:
+            with self.stage("delta"):
+                self._take_delta_segments(chain, db)
+
+    def __call__(self):
+        if isinstance(self.file_handler, LocalFileHandler):
+            os.makedirs(self.root, exist_ok=True)
+        chain = MongoChain(self.file_handler, self.root)
+        client, db = get_mongo_database()
+        mode = OPLOG_MODE if is_replica_set(client) else DELTA_MODE
+        can_extend = self._can_extend(chain, client, mode)
+        if not can_extend or self._is_base_expired(chain):
+            if can_extend:
+                # changes since last segment are closed into previous base, otherwise restoring
+                # to a time between last segment and new base would lose them
+                self._take_segments(chain, client, db, mode)
+            logger.info("Taking '{}' base dump into {}...", mode, self.root)
+            with self.stage("base"):
+                self._take_base(chain, client, db, mode)
+        else:
+            self._take_segments(chain, client, db, mode)
+        chain.save()
+        logger.info("'{}' backup chain is saved to {}", self.name, self.backup_file)
+        return self.backup_file
+
+
+class MongoIncrementalRestoreRunner(BaseRestoreRunner):
+    """Restores base dump of incremental mongo chain and replays its segments up to point in time.
+
+    Filepath is chain root, the latest state is restored if point in time is not given.
+    """
+    container_dest_dir = "/home"
+
+    def __init__(self, name: str, filepath: str, file_handler, point_in_time: datetime = None) -> None:
+        super().__init__(name, filepath.rstrip("/"), file_handler)
+        self.point_in_time = point_in_time
+
+    def _write_oplog(self, base: dict, local_filepath: str) -> int:
+        """Write oplog entries of base segments up to point in time into single BSON file."""
+        count = 0
+        with open(local_filepath, "wb") as f:
+            for segment in base["segments"]:
+                for doc in _iter_segment_docs(self.file_handler, segment["file"]):
+                    if self.point_in_time is not None and _get_document_time(doc, "ts") > self.point_in_time:
+                        return count
+                    f.write(doc.raw)
+                    count += 1
+        return count
+
+    def _replay_oplog(self, base: dict) -> None:
+        container = get_docker_container("mongo")
+        backup_dir = get_backup_dir()
+        os.makedirs(backup_dir, exist_ok=True)
+        local_filepath = os.path.join(backup_dir, f"{str(uuid.uuid4())}_oplog.bson")
+        container_dir = f"{self.container_dest_dir}/{str(uuid.uuid4())}_dump"
+        try:
+            count = self._write_oplog(base, local_filepath)
+            if not count:
+                return
+            logger.info("Replaying {} oplog entries...", count)
+            if not container.put_archive(self.container_dest_dir, create_archive(local_filepath)):
+                raise AppError("Putting oplog file to 'mongo' container was failed")
+            restore_cmd = (
+                "mongorestore --username={mongo_user} --password={mongo_pwd} --authenticationDatabase=test_database "
+                "--host={mongo_host} --port={mongo_port}"
+            ).format(**get_mongo_config())
+            container_filepath = f"{self.container_dest_dir}/{os.path.basename(local_filepath)}"
+            result = container.exec_run(
+                f"/bin/bash -c 'mkdir -p {container_dir} && {restore_cmd} --oplogReplay "
+                f"--oplogFile={container_filepath} --dir={container_dir}'"
+            )
+            if result.exit_code:
+                raise AppError(result.output.decode("utf-8"))
+        finally:
+            rm_result = container.exec_run(
+                f"rm -rf {container_dir} {self.container_dest_dir}/{os.path.basename(local_filepath)}", user="root"
+            )
+            if rm_result.exit_code:
+                logger.warning(rm_result.output.decode("utf-8"))
+            if os.path.isfile(local_filepath):
+                os.remove(local_filepath)
+
+    def _insert_batch(self, collection, docs: list) -> None:
+        try:
+            collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # documents which are in base dump already
+            errors = [error for error in e.details["writeErrors"] if error["code"] != 11000]
+            if errors:
+                raise AppError(f"Cannot restore '{collection.name}' delta: {errors[0]['errmsg']}")
+
+    def _apply_deltas(self, base: dict) -> None:
+        _, db = get_mongo_database()
+        previous_created_at = {}
+        for segment in base["segments"]:
+            # segment taken after point in time still holds documents changed before it, only the next
+            # segments of the collection are newer than point in time entirely
+            created_at = previous_created_at.get(segment["collection"])
+            previous_created_at[segment["collection"]] = datetime.fromisoformat(segment["created_at"])
+            if self.point_in_time is not None and created_at is not None and created_at > self.point_in_time:
+                continue
+            collection = db.get_collection(segment["collection"], codec_options=RAW_CODEC_OPTIONS)
+            batch = []
+            for doc in _iter_segment_docs(self.file_handler, segment["file"]):
+                if self.point_in_time is not None and _get_document_time(doc, segment["field"]) > self.point_in_time:
+                    continue
+                batch.append(doc)
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    self._insert_batch(collection, batch)
+                    batch = []
+            if batch:
+                self._insert_batch(collection, batch)
+            logger.info("Delta of '{}' collection from {} is applied", segment["collection"], segment["file"])
+
+    @log_wrap
+    def __call__(self):
+        chain = MongoChain(self.file_handler, self.filepath)
+        base = chain.get_base(self.point_in_time)
+        logger.info("Restoring '{}' base dump taken at {}...", base["mode"], base["created_at"])
+        base_runner = MongoRestoreRunner("mongo", base["file"], self.file_handler, web_stop=False)
+        base_runner.progress = self.progress
+        lucidum_dir = get_lucidum_dir()
+        docker_compose_executable = shutil.which("docker")
+        subprocess.run([docker_compose_executable, "compose", "stop", self.web_service], cwd=lucidum_dir, check=True)
+        try:
+            with self.stage("base restore"):
+                base_runner()
+            with self.stage("replay"):
+                if base["mode"] == OPLOG_MODE:
+                    self._replay_oplog(base)
+                else:
+                    self._apply_deltas(base)
+        finally:
+            subprocess.run([docker_compose_executable, "compose", "start", self.web_service], cwd=lucidum_dir, check=True)
@@ -0,0 +1,198 @@
+import json
+import shutil
+
+import os
+import requests
+from loguru import logger
+from psutil._common import bytes2human
+from tabulate import tabulate
+
+from config_handler import get_aws_config, get_ecr_client, get_lucidum_dir, get_state_dir, get_docker_client, \
+    get_install_preflight_config
+from executor_service import ContextThreadPoolExecutor
+from docker_service import inspect_docker_images, get_docker_root_dir
+from exceptions import AppError
+
+DEFAULT_EXPANSION_RATIO = 2.5
+DEFAULT_MIN_FREE_BYTES = 1024 ** 3
+PULL_THROUGHPUT_FILE = "pull_throughput.json"
+PULL_THROUGHPUT_SAMPLES = 10
+PLAN_WORKERS = 4
+
+
+def _parse_ecr_image(image: str) -> tuple:
+    """Split ECR image uri into registry id, repository name and tag."""
+    host, _, path = image.partition("/")
+    repository, _, tag = path.rpartition(":")
+    return host.split(".", 1)[0], repository, tag
+
+
+def _get_free_bytes(path: str) -> int:
+    while True:
+        try:
+            return shutil.disk_usage(path).free
+        except OSError:
+            parent = os.path.dirname(path.rstrip("/"))
+            if not parent or parent == path:
+                raise
+            path = parent
+
+
+def _get_pull_throughput_filepath() -> str:
+    return os.path.join(get_state_dir(), PULL_THROUGHPUT_FILE)
+
+
+def get_pull_throughput():
+    """Return average throughput of recent image pulls in bytes per second."""
+    filepath = _get_pull_throughput_filepath()
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath) as f:
+        samples = json.load(f)
+    seconds = sum(sample["seconds"] for sample in samples)
+    if not seconds:
+        return None
+    return sum(sample["bytes"] for sample in samples) / seconds
+
+
+def record_pull_throughput(size: int, seconds: float) -> None:
+    filepath = _get_pull_throughput_filepath()
+    samples = []
+    if os.path.isfile(filepath):
+        with open(filepath) as f:
+            samples = json.load(f)
+    samples = (samples + [{"bytes": size, "seconds": seconds}])[-PULL_THROUGHPUT_SAMPLES:]
+    with open(filepath, "w") as f:
+        json.dump(samples, f)
+
+
+class InstallPlanner:
+    """Estimates download and disk space needed to pull given ECR images.
+
+    Compressed sizes come from ECR image manifests and layers which are already present
+    locally are not counted. Uncompressed size is estimated with expansion ratio of locally
+    installed version of the same component.
+    """
+
+    def __init__(self, images: list) -> None:
+        self.images = images
+        self.config = get_install_preflight_config()
+        access_key, secret_key = get_aws_config()
+        self._ecr_client = get_ecr_client(access_key, secret_key)
+        self._local_images = []
+        self._local_layers = set()
+
+    def _load_local_images(self) -> None:
+        self._local_images = get_docker_client().api.images()
+        attrs = inspect_docker_images(image["Id"] for image in self._local_images)
+        self._local_layers = {layer for a in attrs.values() for layer in a["RootFS"].get("Layers", [])}
+
+    def _get_expansion_ratio(self, registry_id: str, repository: str, name: str) -> float:
+        local_sizes = {}
+        for local_image in self._local_images:
+            for tag in local_image.get("RepoTags") or []:
+                tag_name, _, version = tag.rpartition(":")
+                if tag_name == name:
+                    local_sizes[version] = local_image["Size"]
+        if local_sizes:
+            # sizes of all repository tags are read with one paginated call instead of one call per local tag
+            try:
+                ecr_images = self._ecr_client.get_images(repository, registry_id)
+            except Exception as e:
+                logger.debug("Cannot describe '{}' repository images: {}", repository, e)
+                ecr_images = []
+            for details in ecr_images:
+                for version in details.get("imageTags") or []:
+                    if version in local_sizes and details.get("imageSizeInBytes"):
+                        return local_sizes[version] / details["imageSizeInBytes"]
+        return self.config.get("expansion_ratio", DEFAULT_EXPANSION_RATIO)
+
+    def _plan_image(self, image: dict) -> dict:
+        registry_id, repository, tag = _parse_ecr_image(image["image"])
+        details = self._ecr_client.describe_image(repository, tag, registry_id)
+        manifest = self._ecr_client.get_image_manifest(repository, {"imageTag": tag}, registry_id)
+        config_url = self._ecr_client.get_layer_download_url(repository, manifest["config"]["digest"], registry_id)
+        response = requests.get(config_url, timeout=60)
+        response.raise_for_status()
+        diff_ids = response.json()["rootfs"]["diff_ids"]
+        download_bytes = sum(
+            layer["size"] for layer, diff_id in zip(manifest["layers"], diff_ids) if diff_id not in self._local_layers
+        )
+        ratio = self._get_expansion_ratio(registry_id, repository, image["name"])
+        return {
+            "image": image["image"],
+            "compressed_bytes": details["imageSizeInBytes"],
+            "download_bytes": download_bytes,
+            "disk_bytes": int(download_bytes * (ratio + 1)),
+        }
+
+    def __call__(self) -> dict:
+        self._load_local_images()
+        with ContextThreadPoolExecutor(max_workers=PLAN_WORKERS) as executor:
+            images = list(executor.map(self._plan_image, self.images))
+        min_free_bytes = self.config.get("min_free_bytes", DEFAULT_MIN_FREE_BYTES)
+        docker_root_dir = get_docker_root_dir()
+        lucidum_dir = get_lucidum_dir()
+        download_bytes = sum(image["download_bytes"] for image in images)
+        throughput = get_pull_throughput()
+        return {
+            "images": images,
+            "download_bytes": download_bytes,
+            "disk_bytes": sum(image["disk_bytes"] for image in images),
+            "docker_root_dir": docker_root_dir,
+            "docker_root_free_bytes": _get_free_bytes(docker_root_dir),
+            "lucidum_dir": lucidum_dir,
+            "lucidum_dir_free_bytes": _get_free_bytes(lucidum_dir),
+            "min_free_bytes": min_free_bytes,
+            "estimated_seconds": download_bytes / throughput if throughput else None,
+        }
+
+
+def get_plan_problems(plan: dict) -> list:
+    problems = []
+    required = plan["disk_bytes"] + plan["min_free_bytes"]
+    if plan["docker_root_free_bytes"] < required:
+        problems.append(
+            f"Not enough space in docker root '{plan['docker_root_dir']}': "
+            f"{bytes2human(plan['docker_root_free_bytes'])} free, {bytes2human(required)} required"
+        )
+    if plan["lucidum_dir_free_bytes"] < plan["min_free_bytes"]:
+        problems.append(
+            f"Not enough space in lucidum directory '{plan['lucidum_dir']}': "
+            f"{bytes2human(plan['lucidum_dir_free_bytes'])} free, {bytes2human(plan['min_free_bytes'])} required"
+        )
+    return problems
+
+
+def check_install_plan(images: list) -> dict:
+    """Check there is enough disk space to install given images before anything is removed.
+
+    Return mapping of image to its download size. Raise AppError if disk space is not enough
+    and preflight mode is 'refuse', only warn if it is 'warn'.
+    """
+    mode = get_install_preflight_config().get("mode", "refuse")
+    if mode == "off":
+        return {}
+    try:
+        plan = InstallPlanner(images)()
+    except Exception as e:
+        logger.warning("Cannot estimate install size, skipping preflight check: {}", e)
+        return {}
+    logger.info("Install plan:\n{}", tabulate(
+        [[i["image"], bytes2human(i["compressed_bytes"]), bytes2human(i["download_bytes"]),
+          bytes2human(i["disk_bytes"])] for i in plan["images"]],
+        headers=["Image", "Compressed", "Download", "Disk"], tablefmt="orgtbl"
+    ))
+    eta = plan["estimated_seconds"]
+    logger.info(
+        "Download {}, disk {} ({} free in docker root), estimated transfer time: {}",
+        bytes2human(plan["download_bytes"]), bytes2human(plan["disk_bytes"]),
+        bytes2human(plan["docker_root_free_bytes"]), f"{eta:.0f}s" if eta is not None else "unknown"
+    )
+    problems = get_plan_problems(plan)
+    if problems:
+        if mode == "refuse":
+            raise AppError("; ".join(problems))
+        for problem in problems:
+            logger.warning(problem)
+    return {image["image"]: image["download_bytes"] for image in plan["images"]}
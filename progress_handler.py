@@ -0,0 +1,238 @@
+import fcntl
+import json
+import statistics
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import os
+import psutil
+from loguru import logger
+from psutil._common import bytes2human
+
+from config_handler import get_state_dir
+
+PROGRESS_DIR = "progress"
+PROGRESS_HISTORY_FILE = "progress_history.json"
+PROGRESS_LOG_INTERVAL = 30
+MAX_HISTORY_RUNS = 10
+MAX_PROGRESS_FILES = 50
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+INTERRUPTED = "interrupted"
+
+
+def _get_progress_dir() -> str:
+    progress_dir = os.path.join(get_state_dir(), PROGRESS_DIR)
+    os.makedirs(progress_dir, exist_ok=True)
+    return progress_dir
+
+
+def _write_json(filepath: str, data) -> None:
+    tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+
+@contextmanager
+def _locked_history():
+    filepath = os.path.join(get_state_dir(), PROGRESS_HISTORY_FILE)
+    with open(f"{filepath}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        history = {}
+        if os.path.isfile(filepath):
+            with open(filepath) as f:
+                history = json.load(f)
+        yield history
+        _write_json(filepath, history)
+
+
+def get_history(operation: str) -> list:
+    filepath = os.path.join(get_state_dir(), PROGRESS_HISTORY_FILE)
+    if not os.path.isfile(filepath):
+        return []
+    with open(filepath) as f:
+        return json.load(f).get(operation, [])
+
+
+class Progress:
+    """Bytes, throughput, stages and ETA of one backup or restore operation.
+
+    Byte streams are counted by wrapping them with track, state is logged and saved to state
+    directory every interval, so API can report it. Durations of successful runs are kept per
+    operation and predict ETA of later runs whose total size is not known in advance.
+    """
+
+    def __init__(self, operation: str, total_bytes: int = None, interval: int = PROGRESS_LOG_INTERVAL) -> None:
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.read_bytes = 0
+        self.written_bytes = 0
+        self.status = RUNNING
+        self.error = None
+        self.started_at = time.time()
+        self.stages = {}
+        self._active_stages = {}
+        self._started = time.monotonic()
+        self._history = get_history(operation)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._reporter = None
+        self.filepath = os.path.join(_get_progress_dir(), f"{self.id}.json")
+
+    def __enter__(self):
+        self._remove_old_files()
+        self.save()
+        self._reporter = threading.Thread(target=self._report, name=f"progress-{self.id}", daemon=True)
+        self._reporter.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.finish(exc_value)
+
+    def add(self, size: int, counter: str = "read") -> None:
+        with self._lock:
+            setattr(self, f"{counter}_bytes", getattr(self, f"{counter}_bytes") + size)
+
+    def track(self, chunks, counter: str = "read"):
+        for chunk in chunks:
+            self.add(len(chunk), counter)
+            yield chunk
+
+    @contextmanager
+    def stage(self, name: str):
+        with self._lock:
+            self._active_stages[name] = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages[name] = round(time.monotonic() - self._active_stages.pop(name), 1)
+
+    def get_eta(self):
+        """Return seconds left, by throughput if total size is known, otherwise by previous runs."""
+        elapsed = time.monotonic() - self._started
+        done = max(self.read_bytes, self.written_bytes)
+        if self.total_bytes and done:
+            return max(0.0, elapsed * (self.total_bytes - done) / done)
+        if not self._history:
+            return None
+        predicted = statistics.median(run["seconds"] for run in self._history)
+        # scale prediction by how fast already finished stages were compared to previous runs
+        expected = [
+            statistics.median(run["stages"][stage] for run in self._history if stage in run["stages"])
+            for stage in self.stages if any(stage in run["stages"] for run in self._history)
+        ]
+        actual = [self.stages[stage] for stage in self.stages if any(stage in run["stages"] for run in self._history)]
+        if sum(expected):
+            predicted *= sum(actual) / sum(expected)
+        return max(0.0, predicted - elapsed)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            eta = self.get_eta() if self.status == RUNNING else 0
+            return {
+                "id": self.id,
+                "operation": self.operation,
+                "status": self.status,
+                "error": self.error,
+                "pid": os.getpid(),
+                "started_at": self.started_at,
+                "seconds": round(elapsed, 1),
+                "read_bytes": self.read_bytes,
+                "written_bytes": self.written_bytes,
+                "total_bytes": self.total_bytes,
+                "read_bytes_per_second": int(self.read_bytes / elapsed) if elapsed else 0,
+                "written_bytes_per_second": int(self.written_bytes / elapsed) if elapsed else 0,
+                "eta_seconds": round(eta) if eta is not None else None,
+                "stages": dict(self.stages),
+                "active_stages": list(self._active_stages),
+            }
+
+    def save(self) -> None:
+        _write_json(self.filepath, self.to_dict())
+
+    def log(self) -> None:
+        state = self.to_dict()
+        logger.info(
+            "'{}' progress: read {} ({}/s), written {} ({}/s){}, {:.0f}s elapsed, ETA {}{}",
+            self.operation, bytes2human(state["read_bytes"]), bytes2human(state["read_bytes_per_second"]),
+            bytes2human(state["written_bytes"]), bytes2human(state["written_bytes_per_second"]),
+            f" of {bytes2human(state['total_bytes'])}" if state["total_bytes"] else "", state["seconds"],
+            f"{state['eta_seconds']}s" if state["eta_seconds"] is not None else "unknown",
+            f", running {', '.join(state['active_stages'])}" if state["active_stages"] else ""
+        )
+
+    def _report(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.log()
+                self.save()
+            except Exception as e:
+                logger.warning("Cannot report '{}' progress: {}", self.operation, e)
+
+    def finish(self, error: BaseException = None) -> None:
+        self._stopped.set()
+        if self._reporter is not None:
+            self._reporter.join()
+        self.status = FAILED if error is not None else SUCCEEDED
+        self.error = str(error) if error is not None else None
+        state = self.to_dict()
+        self.save()
+        self.log()
+        if error is None:
+            with _locked_history() as history:
+                runs = history.setdefault(self.operation, [])
+                runs.append({
+                    "finished_at": time.time(),
+                    "seconds": state["seconds"],
+                    "read_bytes": state["read_bytes"],
+                    "written_bytes": state["written_bytes"],
+                    "stages": state["stages"],
+                })
+                del runs[:-MAX_HISTORY_RUNS]
+
+    @staticmethod
+    def _remove_old_files() -> None:
+        progress_dir = _get_progress_dir()
+        filepaths = sorted(
+            (os.path.join(progress_dir, name) for name in os.listdir(progress_dir) if name.endswith(".json")),
+            key=os.path.getmtime
+        )
+        for filepath in filepaths[:-MAX_PROGRESS_FILES]:
+            os.remove(filepath)
+
+
+def _load_progress(filepath: str) -> dict:
+    with open(filepath) as f:
+        state = json.load(f)
+    if state["status"] == RUNNING and not psutil.pid_exists(state["pid"]):
+        state["status"] = INTERRUPTED
+    return state
+
+
+def list_progress() -> list:
+    """Return saved progress of recent operations, newest first."""
+    progress_dir = _get_progress_dir()
+    states = []
+    for name in os.listdir(progress_dir):
+        if not name.endswith(".json"):
+            continue
+        try:
+            states.append(_load_progress(os.path.join(progress_dir, name)))
+        except (OSError, ValueError):
+            continue
+    return sorted(states, key=lambda state: state["started_at"], reverse=True)
+
+
+def get_progress(progress_id: str):
+    filepath = os.path.join(_get_progress_dir(), f"{os.path.basename(progress_id)}.json")
+    if not os.path.isfile(filepath):
+        return None
+    return _load_progress(filepath)
@@ -1,17 +1,133 @@
+import json
+import re
 import subprocess
 import sys
+import tarfile
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import fnmatch
 import os
 import shutil
+from contextlib import nullcontext
 from functools import wraps
 from loguru import logger
+from psutil._common import bytes2human
 
-from config_handler import get_db_config, get_mongo_config, get_lucidum_dir, get_backup_dir
-from docker_service import create_archive, get_docker_container
+from backup_handler import COLLECTIONS_MANIFEST
+from config_handler import get_db_config, get_mongo_config, get_lucidum_dir, get_backup_dir, get_backup_config
+from docker_service import create_members_archive, get_docker_container, exec_stdin, exec_stream
 from exceptions import AppError
-from file_handler import get_file_handler, LocalFileHandler
+from file_handler import get_file_handler, detect_compression, is_tar_header, get_decompress_program, \
+    LocalFileHandler
+from progress_handler import Progress
+from incremental_backup_handler import get_chunk_store, restore_snapshot, split_snapshot_path, DEFAULT_WORKERS
+
+DEFAULT_MONGO_RESTORE_WORKERS = 4
+# enough to tell compression codec and tar header apart
+HEAD_SIZE = 512
+DEFAULT_PARALLEL_COLLECTIONS = 4
+MAX_INSERTION_WORKERS = 8
+# dumps smaller than that are restored faster than extra insertion workers pay off
+SMALL_DUMP_SIZE = 256 * 1024 ** 2
+PROGRESS_LOG_INTERVAL = 30
+BYTE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+
+
+def get_mongorestore_options(size: int, processes: int = 1) -> list:
+    """Return mongorestore tuning options chosen by host cores and compressed dump size.
+
+    Values set in BACKUP_CONFIG (restore_parallel_collections, restore_insertion_workers,
+    restore_batch_size, restore_no_index) take precedence. Cores are shared by given
+    number of concurrent mongorestore processes.
+    """
+    config = get_backup_config()
+    cores = max(1, (os.cpu_count() or 1) // processes)
+    collections = config.get("restore_parallel_collections") or (
+        1 if processes > 1 else min(DEFAULT_PARALLEL_COLLECTIONS, cores)
+    )
+    insertion_workers = config.get("restore_insertion_workers") or (
+        1 if size < SMALL_DUMP_SIZE else max(1, min(MAX_INSERTION_WORKERS, cores // collections))
+    )
+    options = [
+        f"--numParallelCollections={collections}",
+        f"--numInsertionWorkersPerCollection={insertion_workers}",
+    ]
+    if config.get("restore_batch_size"):
+        options.append(f"--batchSize={config['restore_batch_size']}")
+    if config.get("restore_no_index"):
+        # indexes have to be built by application afterwards, but data is loaded much faster
+        options.append("--noIndexRestore")
+    return options
+
+
+class MongoRestoreProgress:
+    """Parses mongorestore output into restored bytes and documents and logs their rates.
+
+    Output of several concurrent mongorestore processes can be fed to the same instance.
+    """
+    progress_pattern = re.compile(r"\]\s+(\S+)\s+([\d.]+)([KMGT]?B)(?:/([\d.]+)([KMGT]?B))?")
+    finished_pattern = re.compile(r"finished restoring (\S+) \((\d+) documents?(?:, (\d+) failures?)?\)")
+
+    def __init__(self, name: str, interval: int = PROGRESS_LOG_INTERVAL) -> None:
+        self.name = name
+        self.interval = interval
+        self.started = self._logged = time.monotonic()
+        self._buffers = {}
+        self._bytes = {}
+        self._total_bytes = {}
+        self.documents = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def feed(self, data: bytes, source=None) -> None:
+        with self._lock:
+            lines = (self._buffers.get(source, b"") + data).split(b"\n")
+            self._buffers[source] = lines.pop()
+            for line in lines:
+                self._parse(line.decode("utf-8", errors="replace"))
+            if time.monotonic() - self._logged >= self.interval:
+                self._logged = time.monotonic()
+                self.log()
+
+    def _parse(self, line: str) -> None:
+        match = self.progress_pattern.search(line)
+        if match:
+            namespace, done, done_unit, total, total_unit = match.groups()
+            self._bytes[namespace] = float(done) * BYTE_UNITS[done_unit]
+            if total is not None:
+                self._total_bytes[namespace] = float(total) * BYTE_UNITS[total_unit]
+            return
+        match = self.finished_pattern.search(line)
+        if match:
+            namespace = match.group(1)
+            self._bytes[namespace] = self._total_bytes.get(namespace, self._bytes.get(namespace, 0))
+            self.documents += int(match.group(2))
+            self.failures += int(match.group(3) or 0)
+
+    def get_stats(self) -> dict:
+        seconds = time.monotonic() - self.started
+        restored_bytes = sum(self._bytes.values())
+        return {
+            "seconds": round(seconds, 1),
+            "bytes": int(restored_bytes),
+            "total_bytes": int(sum(self._total_bytes.values())),
+            "documents": self.documents,
+            "failures": self.failures,
+            "bytes_per_second": int(restored_bytes / seconds) if seconds else 0,
+            "documents_per_second": int(self.documents / seconds) if seconds else 0,
+        }
+
+    def log(self) -> None:
+        stats = self.get_stats()
+        logger.info(
+            "'{}' restore progress: {} of {} ({}/s), {} documents ({}/s), {} failures, {:.0f}s elapsed",
+            self.name, bytes2human(stats["bytes"]), bytes2human(stats["total_bytes"]),
+            bytes2human(stats["bytes_per_second"]), stats["documents"], stats["documents_per_second"],
+            stats["failures"], stats["seconds"]
+        )
 
 
 def log_wrap(func):
@@ -32,49 +148,147 @@ class BaseRestoreRunner:
         self.name = name
         self.filepath = filepath
         self.file_handler = file_handler
+        self.progress = None
+
+    def stage(self, name: str):
+        return self.progress.stage(name) if self.progress is not None else nullcontext()
 
     def get_backup_filepath(self) -> str:
         backup_dir = get_backup_dir()
         os.makedirs(backup_dir, exist_ok=True)
         backup_filepath = os.path.join(backup_dir, str(uuid.uuid4()))
-        self.file_handler.place_file(self.filepath, backup_filepath)
+        with self.stage("download"):
+            self.file_handler.place_file(self.filepath, backup_filepath)
+        if self.progress is not None:
+            self.progress.add(os.path.getsize(backup_filepath), "read")
         return backup_filepath
 
+    def read_backup_head(self) -> bytes:
+        return self.file_handler.read_head(self.filepath, HEAD_SIZE)
+
+    def iter_backup_chunks(self):
+        """Yield backup file content as it is read or downloaded, logging throughput at the end."""
+        started = time.monotonic()
+        size = 0
+        chunks = self.file_handler.iter_chunks(self.filepath)
+        if self.progress is not None:
+            self.progress.total_bytes = self.file_handler.stat(self.filepath)["size"]
+            chunks = self.progress.track(chunks, "read")
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+        seconds = time.monotonic() - started
+        logger.info(
+            "Streamed {} of '{}' file in {:.1f}s ({}/s)",
+            bytes2human(size), self.filepath, seconds, bytes2human(size / seconds if seconds else size)
+        )
+
     def __call__(self):
         raise NotImplementedError
 
 
 class MySQLRestoreRunner(BaseRestoreRunner):
-    container_dest_dir = "/home"
 
     @log_wrap
     def __call__(self):
         container = get_docker_container("mysql")
-        local_filepath = self.get_backup_filepath()
-        tar_stream = create_archive(local_filepath)
-        success = container.put_archive(self.container_dest_dir, tar_stream)
-        if not success:
-            raise AppError(f"Putting '{self.filepath}' file to 'mysql' container was failed")
         db_config = get_db_config()
-        restore_cmd = f"/bin/bash -c 'mysql --user={{mysql_user}} {{mysql_db}} < {self.container_dest_dir}/{os.path.basename(local_filepath)}'"
-        try:
-            result = container.exec_run(restore_cmd.format(**db_config), environment={"MYSQL_PWD": db_config["mysql_pwd"]})
-            if result.exit_code:
-                raise AppError(result.output.decode('utf-8'))
-        finally:
-            rm_result = container.exec_run(f"rm {self.container_dest_dir}/{os.path.basename(local_filepath)}", user='root')
-            if rm_result.exit_code:
-                logger.warning(rm_result.output.decode('utf-8'))
-            if os.path.isfile(local_filepath):
-                os.remove(local_filepath)
+        # dump is streamed to mysql stdin as it is read, nothing is copied into container
+        if detect_compression(self.read_backup_head()) == "gzip":
+            restore_cmd = "/bin/bash -c 'set -o pipefail; gunzip -c | mysql --user={mysql_user} {mysql_db}'"
+        else:
+            restore_cmd = "mysql --user={mysql_user} {mysql_db}"
+        with self.stage("restore"):
+            exec_stdin(
+                container, restore_cmd.format(**db_config), self.iter_backup_chunks(),
+                environment={"MYSQL_PWD": db_config["mysql_pwd"]}
+            )
 
 
 class MongoRestoreRunner(BaseRestoreRunner):
+    """Restores mongo database from single archive or from tar of per collection archives.
+
+    If collections are given only they are restored, per collection archives are restored
+    concurrently by 'mongo_restore_workers' of BACKUP_CONFIG processes.
+    """
     container_dest_dir = "/home"
+    restore_cmd = "mongorestore --username={mongo_user} --password={mongo_pwd} --authenticationDatabase=test_database --host={mongo_host} --port={mongo_port} --gzip --drop"
 
-    def __init__(self, name: str, filepath: str, file_handler, web_stop=True) -> None:
+    def __init__(self, name: str, filepath: str, file_handler, web_stop=True, collections: list = None) -> None:
         super().__init__(name, filepath, file_handler)
         self._web_stop = web_stop
+        self.collections = collections
+
+    def _restore_archive(self, container, progress: MongoRestoreProgress) -> None:
+        mongo_config = get_mongo_config()
+        options = get_mongorestore_options(self.file_handler.stat(self.filepath)["size"])
+        logger.info("Restoring mongo archive with {} options...", " ".join(options))
+        restore_cmd = f"{self.restore_cmd.format(**mongo_config)} {' '.join(options)} --archive"
+        if self.collections:
+            restore_cmd += "".join(f" --nsInclude={mongo_config['mongo_db']}.{c}" for c in self.collections)
+        else:
+            restore_cmd += f" --db={mongo_config['mongo_db']}"
+        exec_stdin(container, restore_cmd, self.iter_backup_chunks(), on_output=progress.feed)
+
+    def _select_collections(self, tar) -> tuple:
+        manifest = json.load(tar.extractfile(COLLECTIONS_MANIFEST))
+        collections = manifest["collections"]
+        if self.collections:
+            missing = set(self.collections) - {c["name"] for c in collections}
+            if missing:
+                raise AppError(f"Collections are not found in '{self.filepath}' backup: {', '.join(sorted(missing))}")
+            collections = [c for c in collections if c["name"] in self.collections]
+        return manifest, collections
+
+    def _restore_collection(
+        self, container, container_dir: str, db: str, collection: dict, options: list, progress: MongoRestoreProgress
+    ) -> None:
+        started = time.monotonic()
+        restore_cmd = (
+            f"{self.restore_cmd.format(**get_mongo_config())} {' '.join(options)} "
+            f"--archive={container_dir}/{collection['member']} --nsInclude={db}.{collection['name']}"
+        )
+        try:
+            for _ in exec_stream(container, restore_cmd, on_stderr=lambda data: progress.feed(data, collection["name"])):
+                pass
+        except AppError as e:
+            raise AppError(f"Restoring '{collection['name']}' collection failed: {e}")
+        logger.info(
+            "Collection '{}' ({} documents) is restored in {:.1f}s",
+            collection["name"], collection["documents"], time.monotonic() - started
+        )
+
+    def _restore_collections(self, container, local_filepath: str, progress: MongoRestoreProgress) -> None:
+        container_dir = f"{self.container_dest_dir}/{os.path.basename(local_filepath)}"
+        with tarfile.open(local_filepath) as tar:
+            manifest, collections = self._select_collections(tar)
+            result = container.exec_run(f"mkdir -p {container_dir}", user='root')
+            if result.exit_code:
+                raise AppError(result.output.decode('utf-8'))
+            try:
+                members = (
+                    (c["member"], c["size"], tar.extractfile(c["member"])) for c in collections
+                )
+                if not container.put_archive(container_dir, create_members_archive(members)):
+                    raise AppError(f"Putting '{self.filepath}' file to 'mongo' container was failed")
+                workers = get_backup_config().get("mongo_restore_workers", DEFAULT_MONGO_RESTORE_WORKERS)
+                workers = max(1, min(workers, len(collections)))
+                logger.info("Restoring {} collections with {} workers...", len(collections), workers)
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(
+                            self._restore_collection, container, container_dir, manifest["db"], c,
+                            get_mongorestore_options(c["size"], workers), progress
+                        )
+                        for c in collections
+                    ]
+                errors = [str(f.exception()) for f in futures if f.exception() is not None]
+                if errors:
+                    raise AppError("\n".join(errors))
+            finally:
+                rm_result = container.exec_run(f"rm -rf {container_dir}", user='root')
+                if rm_result.exit_code:
+                    logger.warning(rm_result.output.decode('utf-8'))
 
     @log_wrap
     def __call__(self):
@@ -82,42 +296,60 @@ class MongoRestoreRunner(BaseRestoreRunner):
         docker_compose_executable = shutil.which("docker")
         if self._web_stop:
             subprocess.run([docker_compose_executable, "compose", "stop", self.web_service], cwd=lucidum_dir, check=True)
-        container = get_docker_container("mongo")
-        local_filepath = self.get_backup_filepath()
-        tar_stream = create_archive(local_filepath)
-        success = container.put_archive(self.container_dest_dir, tar_stream)
-        if not success:
-            raise AppError(f"Putting '{self.filepath}' file to 'mongo' container was failed")
-        restore_cmd = f"mongorestore -v --username={{mongo_user}} --password={{mongo_pwd}} --authenticationDatabase=test_database --host={{mongo_host}} --port={{mongo_port}} --archive={self.container_dest_dir}/{os.path.basename(local_filepath)} --gzip --db={{mongo_db}} --drop"
+        local_filepath = None
         try:
-            result = container.exec_run(restore_cmd.format(**get_mongo_config()))
-            if result.exit_code:
-                raise AppError(result.output.decode('utf-8'))
+            container = get_docker_container("mongo")
+            progress = MongoRestoreProgress(self.name)
+            if is_tar_header(self.read_backup_head()):
+                # per collection archives are restored concurrently, so they need random access
+                local_filepath = self.get_backup_filepath()
+                with self.stage("restore"):
+                    self._restore_collections(container, local_filepath, progress)
+            else:
+                with self.stage("restore"):
+                    self._restore_archive(container, progress)
+            progress.log()
         finally:
-            rm_result = container.exec_run(f"rm {self.container_dest_dir}/{os.path.basename(local_filepath)}", user='root')
-            if rm_result.exit_code:
-                logger.warning(rm_result.output.decode('utf-8'))
-            if os.path.isfile(local_filepath):
+            if local_filepath and os.path.isfile(local_filepath):
                 os.remove(local_filepath)
             if self._web_stop:
                 subprocess.run([docker_compose_executable, "start", self.web_service], cwd=lucidum_dir, check=True)
 
 
 class LucidumDirRestoreRunner(BaseRestoreRunner):
-    mysql_dump_pattern = "mysql_dump_*.sql"
+    mysql_dump_pattern = "mysql_dump_*.sql*"
     mongo_dump_pattern = "mongo_dump_*.gz"
 
+    def _extract(self, lucidum_dir: str) -> None:
+        restore_cmd = ["sudo", "tar", "-xf", "-", f"--directory={lucidum_dir}"]
+        decompress_program = get_decompress_program(detect_compression(self.read_backup_head()))
+        if decompress_program is not None:
+            restore_cmd.append(f"--use-compress-program={decompress_program}")
+        process = subprocess.Popen(restore_cmd, stdin=subprocess.PIPE)
+        try:
+            for chunk in self.iter_backup_chunks():
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            process.terminate()
+            raise
+        finally:
+            process.stdin.close()
+            return_code = process.wait()
+        if return_code:
+            raise AppError(f"Extracting '{self.filepath}' file failed with {return_code} code")
+
     @log_wrap
     def __call__(self):
         lucidum_dir = get_lucidum_dir()
         docker_compose_executable = shutil.which("docker")
         subprocess.run([docker_compose_executable, "compose", "stop", self.web_service], cwd=lucidum_dir, check=True)
         mysql_dump_file = mongo_dump_file = None
-        local_filepath = self.get_backup_filepath()
-        restore_cmd = f"sudo tar -xvf {local_filepath} --directory={lucidum_dir}"
         try:
             try:
-                subprocess.run(restore_cmd.split(), check=True)
+                with self.stage("extract"):
+                    self._extract(lucidum_dir)
             except Exception as error:
                 try:
                     mysql_dump_file = f"{lucidum_dir}/{self._find_file_by_pattern(lucidum_dir, self.mysql_dump_pattern)}"
@@ -128,16 +360,16 @@ class LucidumDirRestoreRunner(BaseRestoreRunner):
             mysql_dump_file = f"{lucidum_dir}/{self._find_file_by_pattern(lucidum_dir, self.mysql_dump_pattern)}"
             mongo_dump_file = f"{lucidum_dir}/{self._find_file_by_pattern(lucidum_dir, self.mongo_dump_pattern)}"
             local_file_handler = LocalFileHandler()
-            MySQLRestoreRunner("mysql", mysql_dump_file, local_file_handler)()
-            MongoRestoreRunner("mongo", mongo_dump_file, local_file_handler, web_stop=False)()
+            with self.stage("mysql restore"):
+                MySQLRestoreRunner("mysql", mysql_dump_file, local_file_handler)()
+            with self.stage("mongo restore"):
+                MongoRestoreRunner("mongo", mongo_dump_file, local_file_handler, web_stop=False)()
         finally:
             subprocess.run([docker_compose_executable, "start", self.web_service], cwd=lucidum_dir, check=True)
-            if os.path.isfile(mysql_dump_file):
+            if mysql_dump_file and os.path.isfile(mysql_dump_file):
                 os.remove(mysql_dump_file)
-            if os.path.isfile(mongo_dump_file):
+            if mongo_dump_file and os.path.isfile(mongo_dump_file):
                 os.remove(mongo_dump_file)
-            if os.path.isfile(local_filepath):
-                os.remove(local_filepath)
 
     @staticmethod
     def _find_file_by_pattern(_dir, file_pattern):
@@ -147,23 +379,40 @@ class LucidumDirRestoreRunner(BaseRestoreRunner):
         return files[0]
 
 
-def get_restore_runner(data_to_restore: str, filepath: str):
+class LucidumDirIncrementalRestoreRunner(LucidumDirRestoreRunner):
+    """Restores lucidum directory from snapshot manifest of content-addressed chunk store."""
+
+    def _extract(self, lucidum_dir: str) -> None:
+        store_root, key = split_snapshot_path(self.filepath)
+        workers = get_backup_config().get("incremental_workers", DEFAULT_WORKERS)
+        restore_snapshot(get_chunk_store(store_root), key, lucidum_dir, workers)
+
+
+def get_restore_runner(data_to_restore: str, filepath: str, collections: list = None, point_in_time=None):
     file_handler = get_file_handler(filepath)
     if data_to_restore == "mysql":
         return MySQLRestoreRunner(data_to_restore, filepath, file_handler)
     elif data_to_restore == "mongo":
-        return MongoRestoreRunner(data_to_restore, filepath, file_handler)
+        return MongoRestoreRunner(data_to_restore, filepath, file_handler, collections=collections)
+    elif data_to_restore == "mongo-incremental":
+        from mongo_incremental_handler import MongoIncrementalRestoreRunner
+        return MongoIncrementalRestoreRunner(data_to_restore, filepath, file_handler, point_in_time)
+    elif data_to_restore == "lucidum-incremental":
+        return LucidumDirIncrementalRestoreRunner(data_to_restore, filepath, file_handler)
     elif data_to_restore == "lucidum":
         return LucidumDirRestoreRunner(data_to_restore, filepath, file_handler)
     else:
         raise AppError(f"Cannot restore data for {data_to_restore}")
 
 
-def restore(data: list):
+def restore(data: list, collections: list = None, point_in_time=None):
     results = []
     for name, filepath in data:
         try:
-            get_restore_runner(name, filepath)()
+            restore_runner = get_restore_runner(name, filepath, collections, point_in_time)
+            with Progress(f"restore {name}") as progress:
+                restore_runner.progress = progress
+                restore_runner()
             results.append((name, 'success', 'Restored successfully'))
         except AppError as e:
             logger.exception(e)
@@ -0,0 +1,198 @@
+import re
+import sys
+from datetime import datetime
+
+import os
+from loguru import logger
+from tabulate import tabulate
+
+from backup_handler import BACKUP_DATE_FORMAT, MANIFEST_SUFFIX, MySQLBackupRunner, MongoBackupRunner, \
+    MongoCollectionsBackupRunner, LucidumDirIncrementalBackupRunner
+from config_handler import get_backup_dir, get_retention_config
+from file_handler import get_file_handler, is_s3_url, COMPRESSION_EXTENSIONS
+from incremental_backup_handler import get_chunk_store, list_snapshots, collect_garbage, SNAPSHOT_SUFFIX
+
+BACKUP_FILENAME_FORMATS = {
+    "mysql": [MySQLBackupRunner.backup_filename_format, "mysql_dump_{date}.sql"],
+    "mongo": [MongoBackupRunner.backup_filename_format],
+    "mongo-collections": [MongoCollectionsBackupRunner.backup_filename_format],
+    "lucidum": [f"lucidum_{{date}}{extension}" for extension in COMPRESSION_EXTENSIONS.values()],
+}
+SNAPSHOT_DATA_TYPE = "lucidum-incremental"
+SNAPSHOT_FILENAME_FORMAT = f"lucidum_{{date}}{SNAPSHOT_SUFFIX}"
+PERIOD_FORMATS = {"daily": "%Y-%m-%d", "weekly": "%G-W%V", "monthly": "%Y-%m", "yearly": "%Y"}
+
+
+def _get_filename_pattern(filename_format: str):
+    return re.compile(re.escape(filename_format).replace(re.escape("{date}"), r"(?P<date>\d{8}_\d{6})"))
+
+
+def get_backup_location(filepath: str = None) -> str:
+    """Return directory or S3 prefix backups are written to for given backup filepath."""
+    if filepath is None:
+        return get_backup_dir()
+    if filepath.endswith("/"):
+        return filepath
+    if is_s3_url(filepath):
+        return f"{filepath.rsplit('/', 1)[0]}/"
+    return os.path.dirname(os.path.abspath(filepath))
+
+
+def select_expired(artifacts: list, policy: dict) -> list:
+    """Return artifacts which are not kept by grandfather-father-son policy.
+
+    :param artifacts: list of (datetime, path) tuples
+    :param policy: number of 'keep_last' artifacts and of 'daily', 'weekly', 'monthly' and
+        'yearly' periods whose newest artifact is kept, the newest artifact is always kept
+    """
+    artifacts = sorted(artifacts, reverse=True)
+    keep = {path for _, path in artifacts[:max(1, policy.get("keep_last", 1))]}
+    for period, period_format in PERIOD_FORMATS.items():
+        periods = set()
+        for date, path in artifacts:
+            if len(periods) >= policy.get(period, 0):
+                break
+            if date.strftime(period_format) not in periods:
+                periods.add(date.strftime(period_format))
+                keep.add(path)
+    return [(date, path) for date, path in artifacts if path not in keep]
+
+
+class RetentionRunner:
+    """Deletes backups of one type within one location which are expired by retention policy.
+
+    Backups are recognized by backup type filename formats, so files with custom names are
+    never touched. Sidecar manifests are deleted together with their backups.
+    """
+
+    def __init__(self, data_type: str, location: str, policy: dict, file_handler, dry_run: bool = False) -> None:
+        self.data_type = data_type
+        self.location = location
+        self.policy = policy
+        self.file_handler = file_handler
+        self.dry_run = dry_run
+        self.patterns = [_get_filename_pattern(f) for f in BACKUP_FILENAME_FORMATS[data_type]]
+
+    @property
+    def prefixes(self) -> list:
+        return sorted({f.split("{date}")[0] for f in BACKUP_FILENAME_FORMATS[self.data_type]})
+
+    def get_artifacts(self, paths: list) -> list:
+        artifacts = []
+        for path in paths:
+            filename = path.rsplit("/", 1)[-1]
+            for pattern in self.patterns:
+                match = pattern.fullmatch(filename)
+                if match:
+                    artifacts.append((datetime.strptime(match.group("date"), BACKUP_DATE_FORMAT), path))
+                    break
+        return artifacts
+
+    def __call__(self, paths: list) -> dict:
+        artifacts = self.get_artifacts(paths)
+        expired = [path for _, path in select_expired(artifacts, self.policy)]
+        existing = set(paths)
+        to_delete = expired + [f"{p}{MANIFEST_SUFFIX}" for p in expired if f"{p}{MANIFEST_SUFFIX}" in existing]
+        for path in expired:
+            logger.info("{} expired '{}' backup {}", "Would delete" if self.dry_run else "Deleting", self.data_type, path)
+        errors = [] if self.dry_run or not to_delete else self.file_handler.delete_files(to_delete)
+        for path, error in errors:
+            logger.error("Cannot delete {}: {}", path, error)
+        return {
+            "type": self.data_type,
+            "kept": len(artifacts) - len(expired),
+            "expired": len(expired),
+            "deleted": 0 if self.dry_run else len(to_delete) - len(errors),
+            "errors": len(errors),
+        }
+
+
+class SnapshotRetentionRunner:
+    """Deletes snapshots of chunk store expired by retention policy and then chunks which
+    none of the remaining snapshots refers to.
+    """
+    data_type = SNAPSHOT_DATA_TYPE
+
+    def __init__(self, store_root: str, policy: dict, dry_run: bool = False) -> None:
+        self.store_root = store_root
+        self.policy = policy
+        self.dry_run = dry_run
+        self.pattern = _get_filename_pattern(SNAPSHOT_FILENAME_FORMAT)
+
+    def get_artifacts(self, keys: list) -> list:
+        artifacts = []
+        for key in keys:
+            match = self.pattern.fullmatch(key.rsplit("/", 1)[-1])
+            if match:
+                artifacts.append((datetime.strptime(match.group("date"), BACKUP_DATE_FORMAT), key))
+        return artifacts
+
+    def __call__(self) -> dict:
+        store = get_chunk_store(self.store_root)
+        artifacts = self.get_artifacts(list_snapshots(store))
+        expired = [key for _, key in select_expired(artifacts, self.policy)]
+        for key in expired:
+            logger.info("{} expired snapshot {}/{}", "Would delete" if self.dry_run else "Deleting", self.store_root, key)
+        errors = [] if self.dry_run or not expired else store.delete(expired)
+        for key, error in errors:
+            logger.error("Cannot delete {}: {}", key, error)
+        # chunks of expired snapshots would be counted as referenced in dry run
+        garbage = collect_garbage(store) if not self.dry_run else {"deleted": 0, "errors": 0}
+        return {
+            "type": self.data_type,
+            "kept": len(artifacts) - len(expired),
+            "expired": len(expired),
+            "deleted": 0 if self.dry_run else len(expired) - len(errors) + garbage["deleted"],
+            "errors": len(errors) + garbage["errors"],
+        }
+
+
+def get_snapshot_store_root(filepath: str = None) -> str:
+    """Return chunk store root of lucidum-incremental backups written to given filepath."""
+    return (filepath or os.path.join(get_backup_dir(), LucidumDirIncrementalBackupRunner.store_dirname)).rstrip("/")
+
+
+def get_retention_policy(data_type: str):
+    policies = get_retention_config().get("policies") or {}
+    return policies.get(data_type) or policies.get("default")
+
+
+def apply_retention(data: list, filepath: str = None, dry_run: bool = False) -> list:
+    """Prune backups of given types in location of given backup filepath, return summary per type."""
+    location = get_backup_location(filepath)
+    file_handler = get_file_handler(location)
+    runners = []
+    snapshot_runner = None
+    for data_type in data:
+        if data_type not in BACKUP_FILENAME_FORMATS and data_type != SNAPSHOT_DATA_TYPE:
+            logger.info("Retention of '{}' backups is not supported, skipping", data_type)
+            continue
+        policy = get_retention_policy(data_type)
+        if policy is None:
+            logger.info("No retention policy for '{}' backups, skipping", data_type)
+            continue
+        if data_type == SNAPSHOT_DATA_TYPE:
+            # snapshots are kept in chunk store whose root is the backup filepath itself
+            snapshot_runner = SnapshotRetentionRunner(get_snapshot_store_root(filepath), policy, dry_run)
+        else:
+            runners.append(RetentionRunner(data_type, location, policy, file_handler, dry_run))
+    results = []
+    if runners:
+        paths = file_handler.list_files(location, sorted({p for runner in runners for p in runner.prefixes}))
+        results = [runner(paths) for runner in runners]
+    if snapshot_runner is not None:
+        results.append(snapshot_runner())
+    if not results:
+        return []
+    logger.info("Retention of '{}' backups{}:\n{}", filepath or location, " (dry run)" if dry_run else "", tabulate(
+        [[r["type"], r["kept"], r["expired"], r["deleted"], r["errors"]] for r in results],
+        headers=["Type", "Kept", "Expired", "Deleted files", "Errors"], tablefmt="orgtbl"
+    ))
+    return results
+
+
+@logger.catch(onerror=lambda _: sys.exit(1))
+def prune(data: list, filepath: str = None, dry_run: bool = False):
+    results = apply_retention(data, filepath, dry_run)
+    if any(result["errors"] for result in results):
+        sys.exit(1)
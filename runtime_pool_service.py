@@ -0,0 +1,277 @@
+import shlex
+import socket
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import os
+import psutil
+from docker.errors import APIError, ContainerError, NotFound
+from loguru import logger
+
+from config_handler import get_docker_client, get_runtime_pool_config
+from exceptions import AppError
+
+POOL_LABEL = "com.lucidum.runtime-pool"
+POOL_OWNER_LABEL = "com.lucidum.runtime-pool.owner"
+POOL_IMAGE_LABEL = "com.lucidum.runtime-pool.image"
+DEFAULT_MAX_SIZE = 2
+DEFAULT_MAX_USES = 50
+DEFAULT_IDLE_SECONDS = 600
+DEFAULT_ACQUIRE_TIMEOUT = 300
+DEFAULT_EXEC_TIMEOUT = 900
+REAP_INTERVAL = 30
+
+_runtime_pool = None
+_runtime_pool_lock = threading.Lock()
+
+
+def _get_repository(image: str) -> str:
+    return image.rpartition(":")[0]
+
+
+def _get_changes(container) -> set:
+    return {(change["Path"], change["Kind"]) for change in container.diff() or []}
+
+
+class _Runtime:
+
+    def __init__(self, container, key: tuple, entrypoint: list) -> None:
+        self.container = container
+        self.key = key
+        self.entrypoint = entrypoint
+        self.changes = _get_changes(container)
+        self.uses = 0
+        self.released_at = time.monotonic()
+
+
+class RuntimePool:
+    """Pool of idle long-lived containers used to run connector and action tests.
+
+    Containers are started once per image with 'sleep infinity' and commands run inside
+    them with exec prefixed by image entrypoint, so a test does not pay for container creation
+    and start. A container is reused only if the command left no processes or filesystem
+    changes behind, otherwise it is replaced by a fresh one in background. Pool grows up to
+    'max_size' containers per image on demand, containers are recycled after 'max_uses' runs,
+    removed after 'idle_seconds' without use and retired once another version of the same
+    image is requested. Pool is disabled unless RUNTIME_POOL_CONFIG.enabled is set.
+    """
+
+    def __init__(self) -> None:
+        config = get_runtime_pool_config()
+        self.max_size = config.get("max_size", DEFAULT_MAX_SIZE)
+        self.max_uses = config.get("max_uses", DEFAULT_MAX_USES)
+        self.idle_seconds = config.get("idle_seconds", DEFAULT_IDLE_SECONDS)
+        self.acquire_timeout = config.get("acquire_timeout", DEFAULT_ACQUIRE_TIMEOUT)
+        self.exec_timeout = config.get("exec_timeout", DEFAULT_EXEC_TIMEOUT)
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self._idle = {}
+        self._sizes = {}
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def _create(self, key: tuple) -> _Runtime:
+        image, network, privileged = key
+        logger.info("Starting runtime container for '{}' image...", image)
+        docker_client = get_docker_client()
+        # entrypoint only keeps container running, image one is run by every exec instead
+        entrypoint = docker_client.images.get(image).attrs["Config"].get("Entrypoint") or []
+        container = docker_client.containers.run(
+            image, entrypoint=["sleep", "infinity"], detach=True, network=network, privileged=privileged,
+            labels={POOL_LABEL: "true", POOL_OWNER_LABEL: self.owner, POOL_IMAGE_LABEL: image}
+        )
+        return _Runtime(container, key, entrypoint)
+
+    @staticmethod
+    def _remove(runtime: _Runtime) -> None:
+        try:
+            runtime.container.remove(force=True)
+        except NotFound:
+            pass
+        except APIError as e:
+            logger.warning("Cannot remove runtime container '{}': {}", runtime.container.name, e)
+
+    def _retire_other_versions(self, image: str) -> list:
+        repository = _get_repository(image)
+        retired = []
+        for key in list(self._idle):
+            if key[0] != image and _get_repository(key[0]) == repository:
+                runtimes = self._idle.pop(key)
+                self._sizes[key] -= len(runtimes)
+                retired.extend(runtimes)
+        return retired
+
+    def _acquire(self, key: tuple) -> _Runtime:
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._condition:
+            retired = self._retire_other_versions(key[0])
+            while True:
+                if self._closed:
+                    raise AppError("Runtime pool is closed")
+                if self._idle.get(key):
+                    runtime = self._idle[key].pop()
+                    break
+                if self._sizes.get(key, 0) < self.max_size:
+                    self._sizes[key] = self._sizes.get(key, 0) + 1
+                    runtime = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AppError(f"No runtime container of '{key[0]}' image is available")
+                self._condition.wait(remaining)
+        for old in retired:
+            self._remove(old)
+        if runtime is not None:
+            return runtime
+        try:
+            return self._create(key)
+        except Exception:
+            with self._condition:
+                self._sizes[key] -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, runtime: _Runtime, reusable: bool) -> None:
+        runtime.uses += 1
+        runtime.released_at = time.monotonic()
+        recycle = not reusable or runtime.uses >= self.max_uses
+        with self._condition:
+            if self._closed:
+                self._sizes[runtime.key] -= 1
+            elif not recycle:
+                self._idle.setdefault(runtime.key, []).append(runtime)
+            self._condition.notify()
+            closed = self._closed
+        if closed:
+            self._remove(runtime)
+        elif recycle:
+            threading.Thread(target=self._replace, args=(runtime,), name="runtime-pool-replace", daemon=True).start()
+
+    def _replace(self, runtime: _Runtime) -> None:
+        """Remove used container and start a fresh one in its place, keeping its pool slot."""
+        self._remove(runtime)
+        try:
+            new_runtime = self._create(runtime.key)
+        except Exception as e:
+            logger.warning("Cannot start runtime container for '{}' image: {}", runtime.key[0], e)
+            new_runtime = None
+        with self._condition:
+            if new_runtime is None or self._closed:
+                self._sizes[runtime.key] -= 1
+            else:
+                self._idle.setdefault(runtime.key, []).append(new_runtime)
+            self._condition.notify()
+            closed = self._closed
+        if new_runtime is not None and closed:
+            self._remove(new_runtime)
+
+    def _exec(self, runtime: _Runtime, command: list) -> tuple:
+        api = get_docker_client().api
+        exec_id = api.exec_create(runtime.container.id, command, stdout=True, stderr=True)["Id"]
+        future = Future()
+
+        def _run():
+            try:
+                future.set_result(api.exec_start(exec_id))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=_run, name="runtime-pool-exec", daemon=True).start()
+        try:
+            output = future.result(timeout=self.exec_timeout)
+        except FutureTimeoutError:
+            # removing container kills the command and closes its output stream
+            self._remove(runtime)
+            raise AppError(f"Command did not finish in {self.exec_timeout}s within '{runtime.key[0]}' container")
+        return api.exec_inspect(exec_id)["ExitCode"], output
+
+    @staticmethod
+    def _is_clean(runtime: _Runtime) -> bool:
+        """Return True if container has no processes and filesystem changes left by the last command."""
+        processes = runtime.container.top().get("Processes") or []
+        return len(processes) <= 1 and _get_changes(runtime.container) == runtime.changes
+
+    def run(self, image: str, command: str, network: str = None, privileged: bool = False) -> bytes:
+        """Run command within pooled container of given image and return its output.
+
+        Raise ContainerError if command exits with non-zero status, like one-off container run does.
+        """
+        runtime = self._acquire((image, network, privileged))
+        reusable = False
+        try:
+            exit_code, output = self._exec(runtime, runtime.entrypoint + shlex.split(command))
+            reusable = self._is_clean(runtime)
+        finally:
+            self._release(runtime, reusable)
+        if exit_code != 0:
+            raise ContainerError(runtime.container, exit_code, command, image, output)
+        return output
+
+    def reap(self) -> None:
+        """Remove containers which were idle for longer than 'idle_seconds'."""
+        now = time.monotonic()
+        expired = []
+        with self._condition:
+            for key, runtimes in self._idle.items():
+                keep = [runtime for runtime in runtimes if now - runtime.released_at < self.idle_seconds]
+                expired.extend(runtime for runtime in runtimes if runtime not in keep)
+                self._sizes[key] -= len(runtimes) - len(keep)
+                self._idle[key] = keep
+        for runtime in expired:
+            logger.info("Removing idle runtime container '{}'...", runtime.container.name)
+            self._remove(runtime)
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            runtimes = [runtime for runtimes in self._idle.values() for runtime in runtimes]
+            self._idle = {}
+            self._condition.notify_all()
+        for runtime in runtimes:
+            self._remove(runtime)
+
+    def remove_orphans(self) -> None:
+        """Remove pool containers left by processes which are not running anymore."""
+        hostname = socket.gethostname()
+        for container in get_docker_client().containers.list(all=True, filters={"label": POOL_LABEL}):
+            owner = container.labels.get(POOL_OWNER_LABEL, "")
+            owner_host, _, pid = owner.rpartition("-")
+            if owner_host == hostname and pid.isdigit() and psutil.pid_exists(int(pid)):
+                continue
+            logger.info("Removing orphaned runtime container '{}'...", container.name)
+            try:
+                container.remove(force=True)
+            except APIError as e:
+                logger.warning("Cannot remove runtime container '{}': {}", container.name, e)
+
+    def start_reaper(self) -> None:
+        def _run():
+            while not self._closed:
+                time.sleep(REAP_INTERVAL)
+                try:
+                    self.reap()
+                except Exception as e:
+                    logger.exception("Runtime pool reaper failed: {}", e)
+
+        threading.Thread(target=_run, name="runtime-pool-reaper", daemon=True).start()
+
+
+def get_runtime_pool():
+    """Return process wide runtime pool or None if it is disabled."""
+    global _runtime_pool
+    if not get_runtime_pool_config().get("enabled", False):
+        return None
+    with _runtime_pool_lock:
+        if _runtime_pool is None:
+            _runtime_pool = RuntimePool()
+            _runtime_pool.remove_orphans()
+            _runtime_pool.start_reaper()
+    return _runtime_pool
+
+
+def close_runtime_pool() -> None:
+    global _runtime_pool
+    with _runtime_pool_lock:
+        if _runtime_pool is not None:
+            _runtime_pool.close()
+            _runtime_pool = None
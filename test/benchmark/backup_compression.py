@@ -0,0 +1,102 @@
+"""Wall time and ratio of lucidum directory archive for every compression codec.
+
+Run from repository root:
+
+    python test/benchmark/backup_compression.py [directory]
+
+Without directory a representative tree is generated: airflow style text and json files,
+python sources, logs and incompressible binary blobs (model files, images).
+Codecs whose executables are missing are skipped.
+"""
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.getcwd())
+
+from file_handler import COMPRESSION_CODECS, COMPRESSION_EXTENSIONS, get_compress_program, \
+    get_decompress_program  # noqa: E402
+
+WORDS = ["connector", "asset", "lucidum", "airflow", "bridge", "config", "metric", "aws", "azure", "okta"]
+
+
+def _generate_tree(root: str, size_mb: int = 256) -> None:
+    rnd = random.Random(0)
+    written = 0
+    index = 0
+    while written < size_mb * 1024 ** 2:
+        kind = index % 4
+        directory = os.path.join(root, ["dags", "data", "logs", "models"][kind], str(index % 16))
+        os.makedirs(directory, exist_ok=True)
+        if kind == 0:
+            data = "\n".join(
+                f"def task_{i}():\n    return '{rnd.choice(WORDS)}_{rnd.randint(0, 999)}'" for i in range(2000)
+            ).encode()
+        elif kind == 1:
+            data = json.dumps([
+                {"name": rnd.choice(WORDS), "value": rnd.random(), "tags": rnd.sample(WORDS, 3)} for _ in range(4000)
+            ]).encode()
+        elif kind == 2:
+            data = "\n".join(
+                f"2024-01-01 00:00:{i % 60:02d} INFO {rnd.choice(WORDS)} processed {rnd.randint(0, 10 ** 6)} rows"
+                for i in range(8000)
+            ).encode()
+        else:
+            data = os.urandom(1024 ** 2)
+        with open(os.path.join(directory, f"file_{index}"), "wb") as f:
+            f.write(data)
+        written += len(data)
+        index += 1
+
+
+def _get_tree_size(root: str) -> int:
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+
+
+def _run(command: list) -> float:
+    started = time.monotonic()
+    subprocess.run(command, check=True)
+    return time.monotonic() - started
+
+
+def run(directory: str) -> None:
+    tree_size = _get_tree_size(directory)
+    print(f"Directory: {directory}, {tree_size / 1024 ** 2:.0f} MB")
+    print(f"{'codec':<24} {'archive MB':>10} {'ratio':>6} {'create s':>9} {'extract s':>9}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for codec in COMPRESSION_CODECS:
+            for level in ([None] if codec == "none" else [1, 3, 6, 9] if codec == "gzip" else [1, 3, 9, 19]):
+                program = get_compress_program(codec, level)
+                if program is not None and shutil.which(program.split()[0]) is None:
+                    continue
+                archive = os.path.join(tmp_dir, f"lucidum{COMPRESSION_EXTENSIONS[codec]}")
+                command = ["tar", "-cf", archive] + ([f"--use-compress-program={program}"] if program else [])
+                create_seconds = _run(command + [f"--directory={directory}", "."])
+                extract_dir = os.path.join(tmp_dir, "extract")
+                os.makedirs(extract_dir)
+                decompress_program = get_decompress_program(codec)
+                command = ["tar", "-xf", archive, f"--directory={extract_dir}"]
+                if decompress_program is not None:
+                    command.append(f"--use-compress-program={decompress_program}")
+                extract_seconds = _run(command)
+                archive_size = os.path.getsize(archive)
+                print(
+                    f"{program or 'none':<24} {archive_size / 1024 ** 2:>10.0f} {tree_size / archive_size:>6.2f} "
+                    f"{create_seconds:>9.2f} {extract_seconds:>9.2f}"
+                )
+                shutil.rmtree(extract_dir)
+                os.remove(archive)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as tree_dir:
+            _generate_tree(tree_dir)
+            run(tree_dir)
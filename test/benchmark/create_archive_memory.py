@@ -0,0 +1,74 @@
+"""Peak RSS of building put_archive tar stream for growing input files.
+
+Run from repository root:
+
+    python test/benchmark/create_archive_memory.py [size_mb ...]
+
+Every measurement runs in its own process, so ru_maxrss is the peak of that run only.
+The streaming builder should stay flat while the legacy in-memory one grows with file size.
+"""
+import io
+import os
+import resource
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.getcwd())
+
+DEFAULT_SIZES_MB = [64, 256, 1024]
+
+
+def legacy_create_archive(filepath):
+    tar_stream = io.BytesIO()
+    tar = tarfile.TarFile(fileobj=tar_stream, mode='w')
+    with open(filepath, "rb") as f:
+        file_data = f.read()
+    tarinfo = tarfile.TarInfo(name=os.path.basename(filepath))
+    tarinfo.size = len(file_data)
+    tarinfo.mtime = time.time()
+    tar.addfile(tarinfo, io.BytesIO(file_data))
+    tar.close()
+    tar_stream.seek(0)
+    return [tar_stream.read()]
+
+
+def measure(builder, filepath):
+    from docker_service import create_archive
+    started = time.monotonic()
+    if builder == "streaming":
+        chunks = create_archive(filepath)
+    else:
+        chunks = legacy_create_archive(filepath)
+    size = sum(len(chunk) for chunk in chunks)
+    elapsed = time.monotonic() - started
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{size} {elapsed:.2f} {max_rss_mb:.1f}")
+
+
+def run(sizes_mb):
+    print(f"{'builder':<10} {'file MB':>8} {'tar MB':>8} {'seconds':>8} {'peak RSS MB':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size_mb in sizes_mb:
+            filepath = os.path.join(tmp_dir, f"dump_{size_mb}.bin")
+            with open(filepath, "wb") as f:
+                chunk = os.urandom(1024 * 1024)
+                for _ in range(size_mb):
+                    f.write(chunk)
+            for builder in ["streaming", "legacy"]:
+                output = subprocess.run(
+                    [sys.executable, __file__, "--measure", builder, filepath],
+                    check=True, stdout=subprocess.PIPE, universal_newlines=True
+                ).stdout.split()
+                tar_size, seconds, max_rss_mb = int(output[0]), float(output[1]), float(output[2])
+                print(f"{builder:<10} {size_mb:>8} {tar_size / 1024 ** 2:>8.0f} {seconds:>8.2f} {max_rss_mb:>12.1f}")
+            os.remove(filepath)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3])
+    else:
+        run([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES_MB)
@@ -0,0 +1,92 @@
+import os
+import tarfile
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import psutil
+import pytest
+
+import backup_handler
+import file_handler
+from backup_handler import LucidumDirBackupRunner
+from exceptions import AppError
+from file_handler import LocalFileHandler
+
+
+@pytest.mark.parametrize("codec, level, pigz", [
+    ("gzip", 9, False), ("gzip", 11, True), ("zstd", 19, False), ("none", None, False),
+])
+def test_supported_compression_level(monkeypatch, tmp_path, codec, level, pigz):
+    monkeypatch.setattr(file_handler, "_get_gzip_executable", lambda: "pigz" if pigz else "gzip")
+    runner = LucidumDirBackupRunner("lucidum", LocalFileHandler(), str(tmp_path), None, codec, level)
+    assert runner.compression_level == level
+
+
+@pytest.mark.parametrize("codec, level, pigz", [
+    ("gzip", 12, False), ("gzip", 11, False), ("gzip", 15, True), ("zstd", 20, False), ("none", 3, False),
+])
+def test_unsupported_compression_level(monkeypatch, tmp_path, codec, level, pigz):
+    monkeypatch.setattr(file_handler, "_get_gzip_executable", lambda: "pigz" if pigz else "gzip")
+    with pytest.raises(AppError):
+        LucidumDirBackupRunner("lucidum", LocalFileHandler(), str(tmp_path), None, codec, level)
+
+
+@pytest.fixture
+def without_sudo(monkeypatch):
+    popen = backup_handler.subprocess.Popen
+    monkeypatch.setattr(
+        backup_handler.subprocess, "Popen",
+        lambda command, *args, **kwargs: popen(command[1:] if command[0] == "sudo" else command, *args, **kwargs)
+    )
+
+
+def _done(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def test_lucidum_archive_is_written_through_bandwidth_limit(without_sudo, monkeypatch, tmp_path):
+    throttled = []
+    monkeypatch.setattr(file_handler, "throttle", throttled.append)
+    lucidum_dir = tmp_path / "lucidum"
+    (lucidum_dir / "airflow").mkdir(parents=True)
+    (lucidum_dir / "airflow" / "settings.yml").write_bytes(b"global: {}\n")
+    (lucidum_dir / "mongo").mkdir()
+    staging_dir = tmp_path / "staging"
+    staging_dir.mkdir()
+    (staging_dir / "mysql_dump.sql").write_bytes(b"CREATE TABLE t;\n")
+    backup_dir = tmp_path / "backup"
+    runner = LucidumDirBackupRunner("lucidum", LocalFileHandler(), str(backup_dir), None, "none")
+    runner.manifest = False
+
+    runner._archive(str(lucidum_dir), str(staging_dir), [_done(str(staging_dir / "mysql_dump.sql"))], {})
+
+    assert os.listdir(backup_dir) == [os.path.basename(runner.backup_file)]
+    with tarfile.open(runner.backup_file) as tar:
+        names = tar.getnames()
+    assert "./airflow/settings.yml" in names and "mysql_dump.sql" in names
+    assert not any(name.startswith("./mongo") for name in names)
+    assert sum(throttled) == os.path.getsize(runner.backup_file) == runner.digests.size
+
+
+def test_lucidum_archive_is_removed_when_dump_fails(without_sudo, tmp_path):
+    lucidum_dir = tmp_path / "lucidum"
+    lucidum_dir.mkdir()
+    failed = Future()
+    failed.set_exception(AppError("dump failed"))
+    runner = LucidumDirBackupRunner("lucidum", LocalFileHandler(), str(tmp_path / "backup"), None, "none")
+    with pytest.raises(AppError):
+        runner._archive(str(lucidum_dir), str(tmp_path), [failed], {})
+    assert not os.path.exists(runner.backup_file)
+
+
+@pytest.mark.parametrize("ionice, nice, prefix", [
+    ((0, 0), 0, ""),
+    ((psutil.IOPRIO_CLASS_IDLE, 0), 10, "ionice -c 3 nice -n 10 "),
+    ((psutil.IOPRIO_CLASS_BE, 7), 0, "ionice -c 2 -n 7 "),
+])
+def test_container_dump_gets_priority_of_backup_process(monkeypatch, ionice, nice, prefix):
+    process = SimpleNamespace(ionice=lambda: SimpleNamespace(ioclass=ionice[0], value=ionice[1]), nice=lambda: nice)
+    monkeypatch.setattr(backup_handler.psutil, "Process", lambda: process)
+    assert backup_handler._get_priority_prefix() == prefix
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import pytest
+
+from backup_scheduler_service import CronExpression, BackupJob
+from exceptions import AppError
+
+
+@pytest.mark.parametrize("expression, after, expected", [
+    ("0 2 * * *", datetime(2024, 3, 1, 1, 59, 30), datetime(2024, 3, 1, 2, 0)),
+    ("0 2 * * *", datetime(2024, 3, 1, 2, 0), datetime(2024, 3, 2, 2, 0)),
+    ("*/15 * * * *", datetime(2024, 3, 1, 10, 16), datetime(2024, 3, 1, 10, 30)),
+    ("30 1-3 * * *", datetime(2024, 3, 1, 3, 31), datetime(2024, 3, 2, 1, 30)),
+    ("0 0 1 * *", datetime(2024, 1, 31, 12, 0), datetime(2024, 2, 1, 0, 0)),
+    ("0 0 29 2 *", datetime(2024, 3, 1), datetime(2028, 2, 29, 0, 0)),
+    ("0 3 * * 0", datetime(2024, 3, 1), datetime(2024, 3, 3, 3, 0)),
+    ("0 3 * * 7", datetime(2024, 3, 1), datetime(2024, 3, 3, 3, 0)),
+    ("0 3 * * 1-5", datetime(2024, 3, 1, 4, 0), datetime(2024, 3, 4, 3, 0)),
+    ("0 0 * 12 *", datetime(2024, 3, 1), datetime(2024, 12, 1, 0, 0)),
+    ("59 23 31 12 *", datetime(2024, 12, 31, 23, 59), datetime(2025, 12, 31, 23, 59)),
+    ("0,30 8 * * *", datetime(2024, 3, 1, 8, 0), datetime(2024, 3, 1, 8, 30)),
+])
+def test_get_next(expression, after, expected):
+    assert CronExpression(expression).get_next(after) == expected
+
+
+def test_day_of_month_or_weekday():
+    # like cron, 13th of month or any friday when both fields are restricted
+    cron = CronExpression("0 0 13 * 5")
+    assert cron.get_next(datetime(2024, 9, 1)) == datetime(2024, 9, 6)
+    assert cron.get_next(datetime(2024, 9, 6)) == datetime(2024, 9, 13)
+
+
+@pytest.mark.parametrize("expression", [
+    "0 2 * *", "60 * * * *", "* 24 * * *", "* * 0 * *", "* * * 13 *", "* * * * 8", "5-1 * * * *", "a * * * *",
+])
+def test_invalid_expression(expression):
+    with pytest.raises(AppError):
+        CronExpression(expression)
+
+
+def test_expression_which_never_matches():
+    with pytest.raises(AppError):
+        CronExpression("0 0 31 2 *").get_next(datetime(2024, 1, 1))
+
+
+def test_backup_job_command():
+    job = BackupJob(
+        {"name": "nightly", "cron": "0 2 * * *", "data": ["mysql", "lucidum"], "filepath": "s3://bucket/backups/"},
+        {"bandwidth_limit": 20}
+    )
+    assert job.get_command()[2:] == [
+        "backup", "--data", "mysql", "--data", "lucidum", "--filepath", "s3://bucket/backups/",
+        "--bandwidth-limit", "20",
+    ]
+
+
+def test_backup_job_command_with_compression():
+    job = BackupJob({"name": "nightly", "cron": "0 2 * * *", "compression": "zstd", "compression_level": 19}, {})
+    assert job.get_command()[2:] == [
+        "backup", "--data", "lucidum", "--compression", "zstd", "--compression-level", "19",
+    ]
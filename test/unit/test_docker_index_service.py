@@ -0,0 +1,60 @@
+import compose_service
+import docker_index_service
+from compose_service import ComposeState
+from docker_index_service import DockerIndex, get_docker_index
+
+
+def test_docker_index_is_synchronized_once_per_process(monkeypatch):
+    syncs = []
+    monkeypatch.setattr(docker_index_service, "_docker_index", None)
+    monkeypatch.setattr(DockerIndex, "load_snapshot", lambda self: False)
+    monkeypatch.setattr(DockerIndex, "sync", lambda self: syncs.append(self))
+    docker_index = get_docker_index()
+    assert get_docker_index() is docker_index
+    assert len(syncs) == 1
+    get_docker_index(sync=True)
+    assert len(syncs) == 2
+
+
+def test_docker_index_tracks_image_tags():
+    docker_index = DockerIndex()
+    docker_index._set_image("sha256:1", ["connector-aws:1.0"], 1, 10)
+    docker_index._set_image("sha256:2", ["connector-aws:1.0", "connector-aws:2.0"], 2, 10)
+    assert sorted(docker_index.get_tags()) == [("connector-aws", "1.0"), ("connector-aws", "2.0")]
+    docker_index._remove_image("sha256:2")
+    assert not docker_index.has_image("connector-aws:1.0")
+
+
+def _container(container_id: str, service: str, state: str = "running", project: str = "lucidum", **labels) -> dict:
+    data = {
+        "Id": container_id, "Names": [f"/{project}-{service}-{container_id}"], "State": state,
+        "Labels": {
+            docker_index_service.COMPOSE_PROJECT_LABEL: project, docker_index_service.COMPOSE_SERVICE_LABEL: service,
+            docker_index_service.COMPOSE_WORKING_DIR_LABEL: f"/usr/{project}", **labels,
+        },
+    }
+    return docker_index_service._to_container(data)
+
+
+def test_docker_index_tracks_compose_services():
+    docker_index = DockerIndex()
+    docker_index._set_containers([_container("1", "web"), _container("2", "web"), _container("3", "mongo")])
+    docker_index._set_container(_container("2", "mysql"))
+    assert [c["id"] for c in docker_index.get_service_containers("lucidum", "web")] == ["1"]
+    assert sorted(docker_index.get_project_services("lucidum")) == ["mongo", "mysql", "web"]
+    docker_index._remove_container("3")
+    assert docker_index.get_service_containers("lucidum", "mongo") == []
+    assert sorted(docker_index.get_project_services("lucidum")) == ["mysql", "web"]
+
+
+def test_compose_state_reads_services_of_project_directory(monkeypatch):
+    docker_index = DockerIndex()
+    docker_index._set_containers([
+        _container("1", "web"), _container("2", "mongo", "exited"), _container("3", "other", project="other"),
+        _container("4", "airflow", **{docker_index_service.COMPOSE_ONEOFF_LABEL: "True"}),
+    ])
+    monkeypatch.setattr(compose_service, "get_docker_index", lambda live=False: docker_index)
+    compose_state = ComposeState("/usr/lucidum")
+    assert compose_state.get_services() == {"web", "mongo"}
+    assert compose_state.is_running("web") and not compose_state.is_running("mongo")
+    assert not compose_state.has_service("other") and not compose_state.has_service("airflow")
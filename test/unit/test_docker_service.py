@@ -0,0 +1,74 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from docker_service import extract_tar_stream
+
+
+def _create_tar(members: list) -> bytes:
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar:
+        for name, type_, data in members:
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.type = type_
+            tarinfo.mode = 0o755 if type_ == tarfile.DIRTYPE else 0o644
+            if type_ == tarfile.LNKTYPE:
+                tarinfo.linkname = data
+                tar.addfile(tarinfo)
+            else:
+                tarinfo.size = len(data or b"")
+                tar.addfile(tarinfo, io.BytesIO(data) if data else None)
+    return stream.getvalue()
+
+
+HARD_LINK_TAR = [
+    ("external", tarfile.DIRTYPE, None),
+    ("external/settings.yml", tarfile.REGTYPE, b"key: value\n"),
+    ("external/settings.link", tarfile.LNKTYPE, "external/settings.yml"),
+]
+
+
+def test_extract_hard_link(tmp_path):
+    extract_tar_stream(io.BytesIO(_create_tar(HARD_LINK_TAR)), str(tmp_path))
+    link = tmp_path / "external" / "settings.link"
+    assert link.read_bytes() == b"key: value\n"
+    assert os.path.samefile(link, tmp_path / "external" / "settings.yml")
+
+
+def test_extract_hard_link_over_existing_files(tmp_path):
+    data = _create_tar(HARD_LINK_TAR)
+    extract_tar_stream(io.BytesIO(data), str(tmp_path))
+    extract_tar_stream(io.BytesIO(data), str(tmp_path))
+    assert (tmp_path / "external" / "settings.link").read_bytes() == b"key: value\n"
+
+
+def test_extract_skips_hard_link_outside_directory(tmp_path):
+    outside = tmp_path / "outside"
+    outside.write_bytes(b"secret")
+    extract_dir = tmp_path / "extract"
+    extract_dir.mkdir()
+    extract_tar_stream(io.BytesIO(_create_tar([("leak", tarfile.LNKTYPE, "../outside")])), str(extract_dir))
+    assert not (extract_dir / "leak").exists()
+
+
+@pytest.mark.parametrize("data_filter", [True, False])
+def test_extract_sets_directory_attributes_after_content(monkeypatch, tmp_path, data_filter):
+    if not data_filter and hasattr(tarfile, "data_filter"):
+        monkeypatch.delattr(tarfile, "data_filter")
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar:
+        directory = tarfile.TarInfo("readonly")
+        directory.type, directory.mode, directory.mtime = tarfile.DIRTYPE, 0o555, 1000000000
+        tar.addfile(directory)
+        member = tarfile.TarInfo("readonly/settings.yml")
+        member.size, member.mode = 11, 0o444
+        tar.addfile(member, io.BytesIO(b"key: value\n"))
+    extract_tar_stream(io.BytesIO(stream.getvalue()), str(tmp_path))
+    readonly = tmp_path / "readonly"
+    try:
+        assert (readonly / "settings.yml").read_bytes() == b"key: value\n"
+        assert readonly.stat().st_mtime == 1000000000
+    finally:
+        readonly.chmod(0o755)
@@ -0,0 +1,50 @@
+import image_gc_handler
+from image_gc_handler import ImageGarbageCollector
+
+
+class FakeApi:
+
+    def __init__(self, histories: dict) -> None:
+        self.histories = histories
+
+    def history(self, image_id: str) -> list:
+        return self.histories[image_id]
+
+
+class FakeDockerClient:
+
+    def __init__(self, histories: dict) -> None:
+        self.api = FakeApi(histories)
+
+
+def _get_collector(monkeypatch, histories: dict, layers: dict) -> ImageGarbageCollector:
+    monkeypatch.setattr(image_gc_handler, "get_docker_client", lambda: FakeDockerClient(histories))
+    monkeypatch.setattr(
+        image_gc_handler, "inspect_docker_images",
+        lambda image_ids, workers: {i: {"RootFS": {"Layers": layers[i]}} for i in image_ids}
+    )
+    return ImageGarbageCollector(keep=1, components=["connector-*"])
+
+
+def test_reclaimable_bytes_skip_shared_layers(monkeypatch):
+    collector = _get_collector(
+        monkeypatch,
+        {"old": [{"Size": 0}, {"Size": 30}, {"Size": 100}]},
+        {"old": ["base", "old-top"], "new": ["base", "new-top"]},
+    )
+    reclaimable, unmeasured = collector.get_reclaimable_bytes([{"Id": "old"}, {"Id": "new"}], {"old"})
+    assert reclaimable == 30
+    assert unmeasured == []
+
+
+def test_reclaimable_bytes_skip_unaligned_history(monkeypatch):
+    collector = _get_collector(
+        monkeypatch,
+        {"old": [{"Size": 30}, {"Size": 20}, {"Size": 100}], "other": [{"Size": 5}, {"Size": 100}]},
+        {"old": ["base", "old-top"], "other": ["base", "other-top"], "new": ["base"]},
+    )
+    reclaimable, unmeasured = collector.get_reclaimable_bytes(
+        [{"Id": "old"}, {"Id": "other"}, {"Id": "new"}], {"old", "other"}
+    )
+    assert reclaimable == 5
+    assert unmeasured == ["old"]
@@ -0,0 +1,195 @@
+import gzip
+import io
+import json
+import os
+import subprocess
+import random
+import tarfile
+import time
+
+import pytest
+
+import incremental_backup_handler
+from exceptions import AppError
+from incremental_backup_handler import IncrementalBackup, LocalChunkStore, load_manifest, write_snapshot_tar, \
+    list_privileged_directory, _get_entry, _PrivilegedFile, iter_file_chunks, collect_garbage, list_snapshots, \
+    CHUNK_MIN_SIZE, CHUNK_AVG_SIZE, CHUNK_MAX_SIZE, CHUNKS_DIR, GEAR, MASK_S, MASK_L
+
+
+@pytest.fixture
+def without_sudo(monkeypatch):
+    """Run privileged commands as current user, tests are not allowed to use sudo."""
+    def _strip_sudo(func):
+        return lambda command, *args, **kwargs: func(command[1:] if command[0] == "sudo" else command, *args, **kwargs)
+
+    monkeypatch.setattr(incremental_backup_handler.subprocess, "run", _strip_sudo(subprocess.run))
+    monkeypatch.setattr(incremental_backup_handler.subprocess, "Popen", _strip_sudo(subprocess.Popen))
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    source = tmp_path / "lucidum"
+    (source / "connector" / "external").mkdir(parents=True)
+    (source / "connector" / "external" / "settings.yml").write_bytes(b"key: value\n")
+    (source / "data.bin").write_bytes(os.urandom(300 * 1024))
+    (source / "logs").mkdir()
+    (source / "logs" / "run.log").write_bytes(b"log")
+    os.symlink("connector/external/settings.yml", source / "settings.yml")
+    os.chmod(source / "connector" / "external" / "settings.yml", 0o600)
+    return source
+
+
+def _read_tar(data: bytes) -> dict:
+    members = {}
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+        for member in tar:
+            content = tar.extractfile(member).read() if member.isfile() else None
+            members[member.name] = (member, content)
+    return members
+
+
+def test_snapshot_round_trip(tmp_path, source_dir):
+    store = LocalChunkStore(str(tmp_path / "store"))
+    key = IncrementalBackup(store, str(source_dir), excludes=["logs"])("snapshot")
+    stream = io.BytesIO()
+    write_snapshot_tar(store, load_manifest(store, key), stream)
+    members = _read_tar(stream.getvalue())
+
+    assert sorted(members) == [
+        "connector", "connector/external", "connector/external/settings.yml", "data.bin", "settings.yml"
+    ]
+    for name, (member, content) in members.items():
+        st = os.lstat(source_dir / name)
+        assert (member.uid, member.gid, member.mode) == (st.st_uid, st.st_gid, st.st_mode & 0o7777)
+        assert member.uname == incremental_backup_handler._get_user_name(st.st_uid)
+        if member.isfile():
+            assert content == (source_dir / name).read_bytes()
+    assert members["settings.yml"][0].linkname == "connector/external/settings.yml"
+
+
+def test_unchanged_files_are_not_read_again(tmp_path, source_dir):
+    store = LocalChunkStore(str(tmp_path / "store"))
+    IncrementalBackup(store, str(source_dir))("snapshot-1")
+    backup = IncrementalBackup(store, str(source_dir))
+    backup("snapshot-2")
+    assert backup._stats["read_bytes"] == 0
+    assert backup._stats["reused_files"] == 3
+
+
+def test_privileged_read_failure_is_raised(without_sudo, tmp_path):
+    with pytest.raises(AppError):
+        with _PrivilegedFile(str(tmp_path / "missing")) as f:
+            f.read()
+
+
+def test_privileged_listing_matches_lstat(without_sudo, source_dir):
+    for relpath, st, target in list_privileged_directory(str(source_dir)):
+        filepath = os.path.join(source_dir, relpath)
+        expected = os.lstat(filepath)
+        expected_target = os.readlink(filepath) if os.path.islink(filepath) else None
+        assert _get_entry(relpath, st, target) == _get_entry(relpath, expected, expected_target)
+
+
+def test_unreadable_directory_is_listed_with_privileges(without_sudo, monkeypatch, tmp_path, source_dir):
+    original_walk = os.walk
+
+    def _walk(top, onerror=None):
+        for directory, dirnames, filenames in original_walk(top):
+            if os.path.basename(directory) == "connector":
+                onerror(PermissionError(13, "Permission denied", directory))
+                continue
+            if os.path.dirname(directory).endswith("connector"):
+                continue
+            yield directory, dirnames, filenames
+
+    monkeypatch.setattr(incremental_backup_handler.os, "walk", _walk)
+    store = LocalChunkStore(str(tmp_path / "store"))
+    key = IncrementalBackup(store, str(source_dir))("snapshot")
+    manifest = json.loads(gzip.decompress(store.get(key)))
+    paths = [entry["path"] for entry in manifest["entries"]]
+    assert "connector/external/settings.yml" in paths
+    assert paths.index("connector") < paths.index("connector/external") < paths.index(
+        "connector/external/settings.yml"
+    )
+
+
+def test_files_removed_while_walking_are_skipped(monkeypatch, tmp_path, source_dir):
+    original_lstat = os.lstat
+
+    def _lstat(path, *args, **kwargs):
+        if str(path).endswith("data.bin"):
+            raise FileNotFoundError(2, "No such file or directory", path)
+        return original_lstat(path, *args, **kwargs)
+
+    monkeypatch.setattr(incremental_backup_handler.os, "lstat", _lstat)
+    store = LocalChunkStore(str(tmp_path / "store"))
+    manifest = load_manifest(store, IncrementalBackup(store, str(source_dir))("snapshot"))
+    assert "data.bin" not in [entry["path"] for entry in manifest["entries"]]
+
+
+def _find_chunk_end_bytewise(data: bytes, start: int, end: int) -> int:
+    """Reference FastCDC loop the vectorised chunker must match."""
+    size = end - start
+    if size <= CHUNK_MIN_SIZE:
+        return end
+    normal, limit = start + min(size, CHUNK_AVG_SIZE), start + min(size, CHUNK_MAX_SIZE)
+    h = 0
+    for i in range(start + CHUNK_MIN_SIZE, limit):
+        h = ((h << 1) + GEAR[data[i]]) & 0xFFFFFFFF
+        if not h & (MASK_S if i < normal else MASK_L):
+            return i + 1
+    return limit
+
+
+@pytest.mark.parametrize("data", [
+    b"", b"x" * 100, bytes(CHUNK_MIN_SIZE + 20), random.Random(1).randbytes(3 * 1024 ** 2 + 12345),
+    b"abc" * 100000 + bytes(200000) + random.Random(2).randbytes(500000),
+])
+def test_chunk_boundaries_match_bytewise_gear_hash(data):
+    expected, start = [], 0
+    while start < len(data):
+        end = _find_chunk_end_bytewise(data, start, len(data))
+        expected.append(data[start:end])
+        start = end
+    assert list(iter_file_chunks(io.BytesIO(data))) == expected
+
+
+def _age_chunks(store: LocalChunkStore, seconds: int) -> None:
+    mtime = time.time() - seconds
+    for key in store.list(CHUNKS_DIR):
+        os.utime(os.path.join(store.root, key), (mtime, mtime))
+
+
+def test_chunks_of_deleted_snapshots_are_collected(tmp_path, source_dir):
+    store = LocalChunkStore(str(tmp_path / "store"))
+    IncrementalBackup(store, str(source_dir))("snapshot-1")
+    (source_dir / "data.bin").write_bytes(os.urandom(100 * 1024))
+    IncrementalBackup(store, str(source_dir))("snapshot-2")
+    old_chunks = len(store.list(CHUNKS_DIR))
+    _age_chunks(store, 2 * 24 * 3600)
+    assert collect_garbage(store)["deleted"] == 0
+
+    assert store.delete([list_snapshots(store)[0]]) == []
+    result = collect_garbage(store)
+    assert result["deleted"] > 0 and len(store.list(CHUNKS_DIR)) == old_chunks - result["deleted"]
+    stream = io.BytesIO()
+    write_snapshot_tar(store, load_manifest(store, list_snapshots(store)[0]), stream)
+    assert _read_tar(stream.getvalue())["data.bin"][1] == (source_dir / "data.bin").read_bytes()
+
+
+def test_recent_chunks_are_not_collected(tmp_path, source_dir):
+    store = LocalChunkStore(str(tmp_path / "store"))
+    IncrementalBackup(store, str(source_dir))("snapshot-1")
+    (source_dir / "data.bin").write_bytes(os.urandom(100 * 1024))
+    IncrementalBackup(store, str(source_dir))("snapshot-2")
+    store.delete([list_snapshots(store)[0]])
+    assert collect_garbage(store) == {"unreferenced": 0, "deleted": 0, "errors": 0}
+    assert collect_garbage(store, grace_seconds=0)["deleted"] > 0
+
+
+def test_store_without_snapshots_is_not_collected(tmp_path, source_dir):
+    store = LocalChunkStore(str(tmp_path / "store"))
+    IncrementalBackup(store, str(source_dir))("snapshot")
+    store.delete(list_snapshots(store))
+    assert collect_garbage(store, grace_seconds=0)["deleted"] == 0
+    assert store.list(CHUNKS_DIR)
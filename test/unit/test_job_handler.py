@@ -0,0 +1,46 @@
+import time
+
+import pytest
+from loguru import logger
+
+import job_handler
+from executor_service import ContextThreadPoolExecutor
+from job_handler import JobManager, CONTAINER_POOL, ACTIVE_STATUSES, SUCCEEDED
+
+
+@pytest.fixture
+def job_manager(monkeypatch, tmp_path):
+    monkeypatch.setattr(job_handler, "get_state_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(job_handler, "get_jobs_config", lambda: {})
+    return JobManager()
+
+
+def _wait(job_manager: JobManager, job_id: str) -> dict:
+    deadline = time.monotonic() + 5
+    while job_manager.get_job(job_id)["status"] in ACTIVE_STATUSES and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return job_manager.get_job(job_id)
+
+
+def _run_workers() -> int:
+    def _work(number):
+        logger.info("worker {} done", number)
+        return number
+
+    with ContextThreadPoolExecutor(max_workers=2) as executor:
+        return sum(executor.map(_work, range(3)))
+
+
+def test_job_log_contains_worker_thread_logs(job_manager):
+    job_id = job_manager.submit("test", {}, CONTAINER_POOL, _run_workers)
+    job = _wait(job_manager, job_id)
+    assert job["status"] == SUCCEEDED
+    assert job["result"] == 3
+    log = b"".join(job_manager.follow_logs(job_id, follow=False)).decode()
+    assert all(f"worker {number} done" in log for number in range(3))
+
+
+def test_active_job_with_same_params_is_reused(job_manager):
+    job_ids = [job_manager.submit("test", {"name": "a"}, CONTAINER_POOL, time.sleep, 0.2) for _ in range(2)]
+    other_id = job_manager.submit("test", {"name": "b"}, CONTAINER_POOL, time.sleep, 0)
+    assert job_ids[0] == job_ids[1] != other_id
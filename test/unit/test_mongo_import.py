@@ -0,0 +1,119 @@
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+from bson import json_util
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+HANDLER_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "handlers", "mongo_import.py")
+
+
+@pytest.fixture
+def mongo_import(monkeypatch):
+    """Load handler without api_handler, which needs full application config to be imported."""
+    monkeypatch.setitem(sys.modules, "api_handler", types.SimpleNamespace(MongoDBClient=None))
+    spec = importlib.util.spec_from_file_location("mongo_import", HANDLER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeCollection:
+    def __init__(self, name: str, existing: list = None, errors: list = None) -> None:
+        self.name = name
+        self.existing = existing or []
+        self.errors = errors or []
+        self.dropped = False
+        self.batches = []
+
+    def drop(self) -> None:
+        self.dropped = True
+
+    def find(self, query: dict, projection: dict = None):
+        return [doc for doc in self.existing if all(doc.get(f) in c["$in"] for f, c in query.items())]
+
+    def bulk_write(self, requests_: list, ordered: bool = True) -> None:
+        assert ordered is False
+        self.batches.append(requests_)
+        if self.errors:
+            raise BulkWriteError({"writeErrors": self.errors.pop(0)})
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name: str) -> FakeCollection:
+        self[name] = FakeCollection(name)
+        return self[name]
+
+
+@pytest.fixture
+def source(monkeypatch, mongo_import, tmp_path):
+    monkeypatch.setattr(mongo_import, "get_lucidum_dir", lambda: str(tmp_path))
+    (tmp_path / "mongo" / "db").mkdir(parents=True)
+    documents = [{"name": f"query{i}", "created_by": "lucidum_vosl"} for i in range(5)]
+    (tmp_path / "mongo" / "db" / "postSavedQuery.json").write_text(
+        "\n".join(json_util.dumps(document) for document in documents) + "\n\n"
+    )
+    return "postSavedQuery.json"
+
+
+def _requests(collection: FakeCollection) -> list:
+    return [request for batch in collection.batches for request in batch]
+
+
+@pytest.mark.parametrize("drop, override, request_type, dropped", [
+    (True, False, InsertOne, True), (False, True, ReplaceOne, False), (False, False, InsertOne, False),
+    (True, True, InsertOne, True),
+])
+def test_import_mode(mongo_import, source, drop, override, request_type, dropped):
+    db = FakeDatabase()
+    runner = mongo_import.MongoBulkImportRunner(db)
+    runner.batch_size = 2
+    assert runner(source, "query_builder", drop=drop, override=override, upsert_fields="name") == (5, 0)
+    assert [len(batch) for batch in db["query_builder"].batches] == [2, 2, 1]
+    assert all(type(request) is request_type for request in _requests(db["query_builder"]))
+    assert db["query_builder"].dropped is dropped
+
+
+def test_override_replaces_by_upsert_fields(mongo_import, source):
+    db = FakeDatabase()
+    mongo_import.MongoBulkImportRunner(db)(source, "query_builder", override=True, upsert_fields="name,created_by")
+    request = _requests(db["query_builder"])[0]
+    assert request._filter == {"name": "query0", "created_by": "lucidum_vosl"}
+    assert request._doc["name"] == "query0" and request._upsert is True
+
+
+def test_sent_to_luci_is_preserved(mongo_import, source):
+    db = FakeDatabase(query_builder=FakeCollection("query_builder", existing=[
+        {"name": "query1", "sent_to_luci": False}, {"name": "query3", "sent_to_luci": None}, {"name": "other"},
+    ]))
+    runner = mongo_import.MongoBulkImportRunner(db)
+    runner.batch_size = 2
+    sent_to_luci = runner.get_sent_to_luci(source, "query_builder", ["name"])
+    runner(source, "query_builder", override=True, upsert_fields="name", sent_to_luci=sent_to_luci)
+    assert [request._doc["sent_to_luci"] for request in _requests(db["query_builder"])] == [
+        True, False, True, True, True,
+    ]
+
+
+def test_failures_are_counted_and_duplicates_skipped(mongo_import, source):
+    db = FakeDatabase(query_builder=FakeCollection("query_builder", errors=[
+        [{"code": 11000, "errmsg": "duplicate key"}, {"code": 121, "errmsg": "validation failed"}],
+        [{"code": 11000, "errmsg": "duplicate key"}],
+    ]))
+    runner = mongo_import.MongoBulkImportRunner(db)
+    runner.batch_size = 2
+    assert runner(source, "query_builder") == (4, 1)
+
+
+def test_run_exits_with_error_on_failures(monkeypatch, mongo_import, source):
+    db = FakeDatabase(field_display_local=FakeCollection("field_display_local", errors=[
+        [{"code": 121, "errmsg": "validation failed"}],
+    ]))
+    client = types.SimpleNamespace(client={"test_database": db}, _mongo_db="test_database")
+    monkeypatch.setattr(mongo_import, "MongoDBClient", lambda: client)
+    with pytest.raises(SystemExit) as e:
+        mongo_import.run(source, "field_display_local", override=True, upsert_fields="name")
+    assert e.value.code == 1
@@ -0,0 +1,188 @@
+import gzip
+import json
+import re
+import types
+from datetime import datetime, timedelta
+
+import bson
+import pytest
+from bson.raw_bson import RawBSONDocument
+from bson.timestamp import Timestamp
+
+import mongo_incremental_handler
+from file_handler import LocalFileHandler
+from mongo_incremental_handler import MongoChain, MongoIncrementalBackupRunner, MongoIncrementalRestoreRunner, \
+    get_oplog_query, gzip_chunks, CHAIN_FILE, OPLOG_MODE, DELTA_MODE
+
+
+def _oplog_entry(ts: int, ns: str, op: str = "i") -> RawBSONDocument:
+    return RawBSONDocument(bson.encode({"ts": Timestamp(ts, 1), "ns": ns, "op": op, "o": {"_id": ts}}))
+
+
+def _matches(doc, query: dict) -> bool:
+    return doc["ts"] > query["ts"]["$gt"] and re.search(query["ns"]["$regex"], doc["ns"]) is not None
+
+
+class FakeOplog:
+    def __init__(self, entries: list) -> None:
+        self.entries = entries
+
+    def find(self, query: dict, sort=None):
+        return iter([doc for doc in self.entries if _matches(doc, query)])
+
+    def find_one(self, query: dict, sort=None, projection=None):
+        if not self.entries:
+            return None
+        return self.entries[0] if sort[0][1] == 1 else self.entries[-1]
+
+
+class FakeLocal:
+    def __init__(self, oplog: FakeOplog) -> None:
+        self.oplog = oplog
+
+    def __getitem__(self, name: str) -> FakeOplog:
+        return self.oplog
+
+    def get_collection(self, name: str, codec_options=None) -> FakeOplog:
+        return self.oplog
+
+
+class FakeClient:
+    def __init__(self, entries: list) -> None:
+        self.local = FakeLocal(FakeOplog(entries))
+
+
+class FakeDatabase:
+    name = "test_database"
+
+
+ENTRIES = [
+    _oplog_entry(100, "test_database.metrics"),
+    _oplog_entry(101, "test_database2.metrics"),
+    _oplog_entry(102, "admin.$cmd", "c"),
+    _oplog_entry(103, "test_databaseXmetrics"),
+    _oplog_entry(104, "test_database.action_job", "u"),
+    _oplog_entry(105, "test_database.$cmd", "c"),
+]
+
+
+def test_oplog_query_selects_entries_of_database():
+    query = get_oplog_query("test_database", [100, 1])
+    assert [doc["ts"].time for doc in ENTRIES if _matches(doc, query)] == [104, 105]
+
+
+def test_oplog_query_escapes_database_name():
+    query = get_oplog_query("test.db", [0, 0])
+    assert _matches(_oplog_entry(1, "test.db.metrics"), query)
+    assert not _matches(_oplog_entry(1, "testXdb.metrics"), query)
+
+
+def _read_segment(path: str) -> list:
+    with gzip.open(path, "rb") as f:
+        return list(bson.decode_file_iter(f))
+
+
+@pytest.fixture
+def runner(tmp_path):
+    (tmp_path / "mongo_incremental").mkdir()
+    return MongoIncrementalBackupRunner("mongo_incremental", LocalFileHandler(), str(tmp_path))
+
+
+def _save_chain(root: str, bases: list, oplog_ts: list) -> None:
+    with open(f"{root}/{CHAIN_FILE}", "w") as f:
+        json.dump({"bases": bases, "oplog_ts": oplog_ts}, f)
+
+
+def test_oplog_segment_contains_entries_of_database(runner):
+    chain = MongoChain(runner.file_handler, runner.root)
+    chain.data["oplog_ts"] = [99, 1]
+    chain.bases.append({"mode": OPLOG_MODE, "created_at": datetime.now().isoformat(), "segments": []})
+    runner._take_oplog_segment(chain, FakeClient(ENTRIES), FakeDatabase())
+    segment, = chain.last_base["segments"]
+    assert [doc["ns"] for doc in _read_segment(segment["file"])] == [
+        "test_database.metrics", "test_database.action_job", "test_database.$cmd",
+    ]
+    assert segment["start_ts"] == [99, 1] and segment["end_ts"] == [105, 1] == chain.data["oplog_ts"]
+
+
+def test_missing_chain_is_started_empty(runner):
+    assert MongoChain(runner.file_handler, runner.root).bases == []
+
+
+def test_unreadable_chain_is_not_replaced(runner):
+    with open(f"{runner.root}/{CHAIN_FILE}", "w") as f:
+        f.write("{")
+    with pytest.raises(ValueError):
+        MongoChain(runner.file_handler, runner.root)
+
+
+class FakeMongoBackupRunner:
+    def __init__(self, name, file_handler, backup_dir=None, path=None) -> None:
+        self.path = path
+
+    def __call__(self):
+        return f"{self.path}{self.backup_filename_format.format(date='now')}"
+
+
+@pytest.fixture
+def fake_mongo(monkeypatch):
+    client = FakeClient(ENTRIES)
+    monkeypatch.setattr(mongo_incremental_handler, "get_mongo_database", lambda: (client, FakeDatabase()))
+    monkeypatch.setattr(mongo_incremental_handler, "is_replica_set", lambda _: True)
+    monkeypatch.setattr(mongo_incremental_handler, "MongoBackupRunner", FakeMongoBackupRunner)
+    return client
+
+
+def test_expired_base_is_closed_before_new_base(fake_mongo, runner):
+    created_at = (datetime.now() - timedelta(days=2)).isoformat()
+    _save_chain(runner.root, [{"mode": OPLOG_MODE, "created_at": created_at, "segments": []}], [103, 1])
+    runner()
+    chain = MongoChain(runner.file_handler, runner.root)
+    closed, new = chain.bases
+    assert [(segment["start_ts"], segment["end_ts"]) for segment in closed["segments"]] == [([103, 1], [105, 1])]
+    assert new["segments"] == [] and new["oplog_ts"] == [105, 1]
+
+
+def test_rolled_over_base_is_not_closed(fake_mongo, runner):
+    created_at = datetime.now().isoformat()
+    _save_chain(runner.root, [{"mode": OPLOG_MODE, "created_at": created_at, "segments": []}], [50, 1])
+    runner()
+    closed, new = MongoChain(runner.file_handler, runner.root).bases
+    assert closed["segments"] == [] and new["oplog_ts"] == [105, 1]
+
+
+def test_local_store_is_created_by_first_backup(fake_mongo, tmp_path):
+    backup_dir = tmp_path / "backup"
+    runner = MongoIncrementalBackupRunner("mongo_incremental", LocalFileHandler(), str(backup_dir))
+    runner()
+    base, = MongoChain(runner.file_handler, runner.root).bases
+    assert (backup_dir / "mongo_incremental" / CHAIN_FILE).is_file() and base["oplog_ts"] == [105, 1]
+
+
+class FakeDeltaCollection:
+    def __init__(self) -> None:
+        self.inserted = []
+
+    def insert_many(self, docs: list, ordered: bool = True) -> None:
+        self.inserted.extend(doc["_id"] for doc in docs)
+
+
+def _write_delta_segment(path, created_at: datetime, times: list) -> dict:
+    docs = [bson.encode({"_id": f"{t:%H:%M}", "_utc": t.astimezone()}) for t in times]
+    path.write_bytes(b"".join(gzip_chunks(iter(docs))))
+    return {"file": str(path), "created_at": created_at.isoformat(), "collection": "metrics", "field": "_utc"}
+
+
+def test_delta_restore_to_point_in_time_between_segments(monkeypatch, tmp_path):
+    at = [datetime(2026, 1, 1, 10) + timedelta(hours=hours) for hours in range(7)]
+    segments = [
+        _write_delta_segment(tmp_path / "delta_1.bson.gz", at[1], [at[0], at[1]]),
+        _write_delta_segment(tmp_path / "delta_2.bson.gz", at[4], [at[2], at[3], at[4]]),
+        _write_delta_segment(tmp_path / "delta_3.bson.gz", at[6], [at[5], at[6]]),
+    ]
+    collection = FakeDeltaCollection()
+    db = types.SimpleNamespace(get_collection=lambda name, codec_options=None: collection)
+    monkeypatch.setattr(mongo_incremental_handler, "get_mongo_database", lambda: (None, db))
+    runner = MongoIncrementalRestoreRunner("mongo_incremental", str(tmp_path), LocalFileHandler(), at[3])
+    runner._apply_deltas({"mode": DELTA_MODE, "segments": segments})
+    assert collection.inserted == [f"{t:%H:%M}" for t in at[:4]]
@@ -0,0 +1,38 @@
+import preflight_handler
+from preflight_handler import InstallPlanner, DEFAULT_EXPANSION_RATIO
+
+
+class FakeECRClient:
+
+    def __init__(self, images: list) -> None:
+        self.images = images
+        self.calls = []
+
+    def get_images(self, repository_name, registry_id=None):
+        self.calls.append((repository_name, registry_id))
+        return self.images
+
+
+def _get_planner(monkeypatch, ecr_images: list) -> InstallPlanner:
+    monkeypatch.setattr(preflight_handler, "get_ecr_client", lambda *args: FakeECRClient(ecr_images))
+    planner = InstallPlanner([])
+    planner._local_images = [
+        {"RepoTags": ["connector-aws:1.0", "connector-aws:latest"], "Size": 300},
+        {"RepoTags": ["connector-gcp:2.0"], "Size": 500},
+    ]
+    return planner
+
+
+def test_expansion_ratio_of_local_version_in_one_call(monkeypatch):
+    planner = _get_planner(monkeypatch, [
+        {"imageTags": ["0.9"], "imageSizeInBytes": 50},
+        {"imageTags": ["1.0"], "imageSizeInBytes": 100},
+    ])
+    assert planner._get_expansion_ratio("123", "connector-aws", "connector-aws") == 3
+    assert planner._ecr_client.calls == [("connector-aws", "123")]
+
+
+def test_expansion_ratio_default_without_local_version(monkeypatch):
+    planner = _get_planner(monkeypatch, [{"imageTags": ["1.0"], "imageSizeInBytes": 100}])
+    assert planner._get_expansion_ratio("123", "connector-okta", "connector-okta") == DEFAULT_EXPANSION_RATIO
+    assert planner._ecr_client.calls == []
@@ -0,0 +1,124 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import retention_handler
+from retention_handler import RetentionRunner, SnapshotRetentionRunner, apply_retention, select_expired
+from backup_handler import MANIFEST_SUFFIX
+from incremental_backup_handler import IncrementalBackup, LocalChunkStore, list_snapshots, CHUNKS_DIR
+
+NOW = datetime(2024, 3, 31, 2, 0)
+
+
+def _daily_artifacts(days: int) -> list:
+    return [(NOW - timedelta(days=day), f"lucidum_{day}") for day in range(days)]
+
+
+def _kept(artifacts: list, policy: dict) -> list:
+    expired = {path for _, path in select_expired(artifacts, policy)}
+    return sorted((date, path) for date, path in artifacts if path not in expired)
+
+
+def test_newest_artifact_is_always_kept():
+    artifacts = _daily_artifacts(5)
+    assert _kept(artifacts, {}) == [artifacts[0]]
+
+
+def test_keep_last():
+    artifacts = _daily_artifacts(5)
+    assert _kept(artifacts, {"keep_last": 3}) == sorted(artifacts[:3])
+
+
+def test_grandfather_father_son():
+    artifacts = _daily_artifacts(400)
+    kept = _kept(artifacts, {"daily": 7, "weekly": 4, "monthly": 12, "yearly": 2})
+    kept_dates = [date.date() for date, _ in kept]
+    # 7 newest days
+    assert all((NOW - timedelta(days=day)).date() in kept_dates for day in range(7))
+    # newest artifact of every one of 12 newest months
+    months = {date.strftime("%Y-%m") for date, _ in kept}
+    assert len(months) == 12
+    assert (datetime(2023, 4, 30)).date() in kept_dates
+    assert (datetime(2023, 3, 31)).date() not in kept_dates
+    # newest artifact of 2023 and of 2024 are kept by yearly period
+    assert datetime(2023, 12, 31).date() in kept_dates
+    assert datetime(2024, 3, 31).date() in kept_dates
+    # weeks are ISO weeks, Sunday is the newest day of a week
+    assert datetime(2024, 3, 17).date() in kept_dates and datetime(2024, 3, 16).date() not in kept_dates
+
+
+def test_same_period_keeps_newest_only():
+    artifacts = [(datetime(2024, 3, 1, hour), f"lucidum_{hour}") for hour in range(0, 24, 6)]
+    assert _kept(artifacts, {"daily": 1}) == [(datetime(2024, 3, 1, 18), "lucidum_18")]
+
+
+class FakeFileHandler:
+
+    def __init__(self) -> None:
+        self.deleted = []
+
+    def delete_files(self, paths: list) -> list:
+        self.deleted.extend(paths)
+        return []
+
+
+def test_retention_runner_deletes_expired_backups_with_manifests():
+    paths = [
+        "/backup/lucidum_20240301_020000.tar.gz",
+        f"/backup/lucidum_20240301_020000.tar.gz{MANIFEST_SUFFIX}",
+        "/backup/lucidum_20240302_020000.tar.zst",
+        "/backup/lucidum_20240303_020000.tar.gz",
+        "/backup/lucidum_custom.tar.gz",
+    ]
+    file_handler = FakeFileHandler()
+    result = RetentionRunner("lucidum", "/backup", {"keep_last": 2}, file_handler)(paths)
+    assert sorted(file_handler.deleted) == sorted(paths[:2])
+    assert result == {"type": "lucidum", "kept": 2, "expired": 1, "deleted": 2, "errors": 0}
+
+
+def test_retention_runner_dry_run_deletes_nothing():
+    file_handler = FakeFileHandler()
+    result = RetentionRunner("mysql", "/backup", {}, file_handler, dry_run=True)(
+        ["mysql_dump_20240301_020000.sql", "mysql_dump_20240302_020000.sql"]
+    )
+    assert file_handler.deleted == []
+    assert result["expired"] == 1 and result["deleted"] == 0
+
+
+def _take_snapshots(store_root, source_dir, names: list) -> LocalChunkStore:
+    store = LocalChunkStore(str(store_root))
+    for name in names:
+        (source_dir / "data.bin").write_bytes(os.urandom(64 * 1024))
+        IncrementalBackup(store, str(source_dir))(name)
+    mtime = time.time() - 2 * 24 * 3600
+    for key in store.list(CHUNKS_DIR):
+        os.utime(os.path.join(store.root, key), (mtime, mtime))
+    return store
+
+
+def test_snapshot_retention_deletes_expired_snapshots_and_their_chunks(tmp_path):
+    source_dir = tmp_path / "lucidum"
+    source_dir.mkdir()
+    store = _take_snapshots(tmp_path / "store", source_dir, [
+        "lucidum_20240301_020000", "lucidum_20240302_020000", "lucidum_20240303_020000",
+    ])
+    chunks = len(store.list(CHUNKS_DIR))
+    result = SnapshotRetentionRunner(store.root, {"keep_last": 1})()
+    assert list_snapshots(store) == ["snapshots/lucidum_20240303_020000.json.gz"]
+    assert len(store.list(CHUNKS_DIR)) < chunks
+    assert result == {
+        "type": "lucidum-incremental", "kept": 1, "expired": 2, "deleted": 2 + chunks - len(store.list(CHUNKS_DIR)),
+        "errors": 0,
+    }
+
+
+def test_snapshot_retention_is_applied_to_store_root(monkeypatch, tmp_path):
+    source_dir = tmp_path / "lucidum"
+    source_dir.mkdir()
+    store = _take_snapshots(tmp_path / "backup" / "lucidum_store", source_dir, [
+        "lucidum_20240301_020000", "lucidum_20240302_020000",
+    ])
+    monkeypatch.setattr(retention_handler, "get_backup_dir", lambda: str(tmp_path / "backup"))
+    monkeypatch.setattr(retention_handler, "get_retention_config", lambda: {"policies": {"default": {}}})
+    result, = apply_retention(["lucidum-incremental"], dry_run=True)
+    assert result["expired"] == 1 and len(list_snapshots(store)) == 2
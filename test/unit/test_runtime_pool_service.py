@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+import runtime_pool_service
+from exceptions import AppError
+from runtime_pool_service import RuntimePool, get_runtime_pool
+
+
+class FakeContainer:
+
+    def __init__(self, name: str) -> None:
+        self.id = self.name = name
+        self.changes = []
+        self.processes = [["sleep", "infinity"]]
+        self.removed = threading.Event()
+
+    def diff(self):
+        return self.changes
+
+    def top(self):
+        return {"Processes": self.processes}
+
+    def remove(self, force=False):
+        self.removed.set()
+
+
+class FakeDockerClient:
+
+    def __init__(self, delay: float = 0) -> None:
+        self.containers = self
+        self.images = self
+        self.api = self
+        self.delay = delay
+        self.created = []
+        self.commands = []
+        self._exit_codes = {}
+
+    # images
+    def get(self, image):
+        return type("Image", (), {"attrs": {"Config": {"Entrypoint": ["/entrypoint.sh"]}}})()
+
+    # containers
+    def run(self, image, **kwargs):
+        container = FakeContainer(f"runtime-{len(self.created)}")
+        self.created.append(container)
+        return container
+
+    # api
+    def exec_create(self, container_id, command, **kwargs):
+        self.commands.append((container_id, command))
+        return {"Id": container_id}
+
+    def exec_start(self, exec_id):
+        time.sleep(self.delay)
+        return b"output"
+
+    def exec_inspect(self, exec_id):
+        return {"ExitCode": 0}
+
+
+@pytest.fixture
+def docker_client(monkeypatch):
+    client = FakeDockerClient()
+    monkeypatch.setattr(runtime_pool_service, "get_docker_client", lambda: client)
+    monkeypatch.setattr(runtime_pool_service, "get_runtime_pool_config", lambda: {"exec_timeout": 0.5})
+    return client
+
+
+def _wait_for_idle(pool: RuntimePool, key: tuple) -> None:
+    deadline = time.monotonic() + 5
+    while not pool._idle.get(key) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_runtime_pool_is_disabled_by_default(monkeypatch):
+    monkeypatch.setattr(runtime_pool_service, "get_runtime_pool_config", lambda: {})
+    assert get_runtime_pool() is None
+
+
+def test_clean_container_is_reused_with_image_entrypoint(docker_client):
+    pool = RuntimePool()
+    assert pool.run("connector-aws:1.0", 'bash -c "python lucidum_aws.py test"') == b"output"
+    pool.run("connector-aws:1.0", "true")
+    assert len(docker_client.created) == 1
+    assert docker_client.commands[0] == (
+        "runtime-0", ["/entrypoint.sh", "bash", "-c", "python lucidum_aws.py test"]
+    )
+
+
+def test_changed_container_is_replaced(docker_client):
+    pool = RuntimePool()
+    key = ("connector-aws:1.0", None, False)
+    original_run = docker_client.exec_start
+
+    def _exec_start(exec_id):
+        docker_client.created[-1].changes = [{"Path": "/tmp/result.json", "Kind": 1}]
+        return original_run(exec_id)
+
+    docker_client.exec_start = _exec_start
+    pool.run("connector-aws:1.0", "true")
+    assert docker_client.created[0].removed.wait(5)
+    _wait_for_idle(pool, key)
+    assert [runtime.container.name for runtime in pool._idle[key]] == ["runtime-1"]
+    assert pool._sizes[key] == 1
+
+
+def test_command_timeout_removes_container(docker_client):
+    docker_client.delay = 2
+    pool = RuntimePool()
+    with pytest.raises(AppError):
+        pool.run("connector-aws:1.0", "sleep 10")
+    assert docker_client.created[0].removed.is_set()
@@ -3,6 +3,7 @@ import json
 from loguru import logger
 
 from config_handler import get_images_from_ecr, get_local_images, get_images, get_key_dir_config
+from file_handler import COMPRESSION_CODECS
 from history_handler import history_command, get_install_ecr_entries, get_history_command_choices
 from install_handler import install_ecr, get_components, remove_components, list_components, install_image_from_ecr
 
@@ -19,9 +20,13 @@ def cli():
     '--archive', '-a', required=True, type=click.Path(exists=True, dir_okay=False),
     help="Archive filepath to use for lucidum installation"
 )
-def install(archive: str) -> None:
+@click.option(
+    '--stream', '-s', default=False, is_flag=True,
+    help="load docker images straight from archive without unpacking it to disk"
+)
+def install(archive: str, stream: bool) -> None:
     from install_handler import install as install_archive
-    install_archive(archive)
+    install_archive(archive, stream)
 
 
 @cli.command()
@@ -60,6 +65,14 @@ def remove(components):
     remove_components(components)
 
 
+@cli.command()
+@click.option("--keep", "-k", type=click.IntRange(min=0), help="number of most recent versions to keep per component")
+@click.option("--dry-run", default=False, is_flag=True, help="only report images to remove and reclaimable space")
+def gc(keep: int, dry_run: bool) -> None:
+    from image_gc_handler import run as run_image_gc
+    run_image_gc(keep, dry_run)
+
+
 @cli.command()
 def init() -> None:
     from init_handler import init as init_lucidum
@@ -103,14 +116,72 @@ def import_(db, source, destination):
     run(db, source, destination)
 
 
-@cli.command()
-@click.option("--data", "-d", multiple=True, default=["lucidum"], type=click.Choice(['mysql', 'mongo', 'lucidum']))
+@cli.group(invoke_without_command=True)
+@click.option(
+    "--data", "-d", multiple=True, default=["lucidum"],
+    type=click.Choice(['mysql', 'mongo', 'lucidum', 'lucidum-incremental', 'mongo-collections', 'mongo-incremental'])
+)
 @click.option("--filepath", "-f", type=click.Path())
 @click.option("--include-collection", "-i")
 @click.option("--exclude-collection", "-e", multiple=True)
-def backup(data: tuple, filepath: str, include_collection: str = None, exclude_collection: tuple = None):
+@click.option(
+    "--compression", "-z", type=click.Choice(COMPRESSION_CODECS),
+    help="compression of lucidum directory archive, defaults to BACKUP_CONFIG.compression or gzip"
+)
+@click.option(
+    "--compression-level", type=click.IntRange(min=1, max=19),
+    help="compression level of chosen codec: 1-9 for gzip (11 with pigz), 1-19 for zstd"
+)
+@click.option(
+    "--bandwidth-limit", type=click.FloatRange(min=0, min_open=True),
+    help="MiB/s limit of backup writes and uploads, defaults to BACKUP_CONFIG.bandwidth_limit"
+)
+@click.pass_context
+def backup(
+    ctx,
+    data: tuple,
+    filepath: str,
+    include_collection: str = None,
+    exclude_collection: tuple = None,
+    compression: str = None,
+    compression_level: int = None,
+    bandwidth_limit: float = None
+):
+    if ctx.invoked_subcommand is not None:
+        return
     from backup_handler import backup as backup_lucidum
-    backup_lucidum(list(data), filepath, include_collection, list(exclude_collection))
+    backup_lucidum(
+        list(data), filepath, include_collection, list(exclude_collection), compression, compression_level,
+        bandwidth_limit
+    )
+
+
+@backup.command(name="verify")
+@click.option("--filepath", "-f", multiple=True, required=True, help="local or s3 backup file to verify")
+@click.option("--deep", is_flag=True, default=False, help="always hash content, even if S3 ETag matches")
+def verify_backup(filepath: tuple, deep: bool):
+    from backup_handler import verify
+    verify(list(filepath), deep)
+
+
+@backup.command(name="schedule")
+def schedule_backup():
+    """Run backups of BACKUP_SCHEDULE_CONFIG jobs on their cron expressions in foreground."""
+    from backup_scheduler_service import run_backup_scheduler
+    run_backup_scheduler()
+
+
+@backup.command(name="prune")
+@click.option(
+    "--data", "-d", multiple=True, default=["mysql", "mongo", "mongo-collections", "lucidum", "lucidum-incremental"],
+    type=click.Choice(["mysql", "mongo", "mongo-collections", "lucidum", "lucidum-incremental"])
+)
+@click.option("--filepath", "-f", type=click.Path(), help="local directory or s3 prefix, backup directory by default")
+@click.option("--dry-run", is_flag=True, default=False, help="only log backups which would be deleted")
+def prune_backup(data: tuple, filepath: str, dry_run: bool):
+    """Delete backups expired by RETENTION_CONFIG policies and chunks of expired lucidum-incremental snapshots."""
+    from retention_handler import prune
+    prune(list(data), filepath, dry_run)
 
 
 @cli.command()
@@ -169,9 +240,16 @@ def update_action_config():
 
 @cli.command()
 @click.option("--data", "-d", multiple=True, required=True, type=(str, click.Path(dir_okay=False)))
-def restore(data):
+@click.option(
+    "--collection", "-c", multiple=True, help="mongo collection to restore, all collections are restored by default"
+)
+@click.option(
+    "--point-in-time", "-t", type=click.DateTime(),
+    help="local time mongo-incremental backup is restored to, the latest state by default"
+)
+def restore(data, collection: tuple, point_in_time=None):
     from restore_handler import restore as restore_lucidum
-    restore_lucidum(list(data))
+    restore_lucidum(list(data), list(collection), point_in_time)
 
 
 @cli.command()
@@ -213,28 +291,17 @@ def build_dh(key_dir: str) -> None:
 
 
 @cli.command()
-def run_connector_config_to_db():
+@click.option("--workers", "-w", type=click.IntRange(min=1), help="number of connectors to run concurrently")
+@click.option("--timeout", "-t", type=click.IntRange(min=1), help="timeout of every connector in seconds")
+def run_connector_config_to_db(workers: int, timeout: int):
     from api_handler import get_local_connectors, get_local_action
-    from docker_service import run_docker_container
+    from config_to_db_handler import ConfigToDbExecutor
     connectors = get_local_connectors()
     action = get_local_action()
     if action:
         connectors.append(action)
-    for connector in connectors:
-        try:
-            if connector['type'] == 'action':
-                main_image = "action-manager"
-            else:
-                main_image = f"connector-{connector['type']}"
-            image = f"{main_image}:{connector['version']}"
-            command = f'bash -c "python lucidum_{connector["type"]}.py config-to-db"'
-            out = run_docker_container(
-                image, stdout=True, stderr=True, remove=True, network="lucidum_default", command=command
-            )
-            logger.info(connector)
-            logger.info(out.decode())
-        except Exception as e:
-            logger.warning(f"config-to-db error: {e}")
+    for result in ConfigToDbExecutor(workers, timeout)(connectors):
+        logger.info("{} output:\n{}", result["image"], result["output"])
 
 
 @cli.command()